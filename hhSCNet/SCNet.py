@@ -4,8 +4,10 @@ from collections import deque
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 from .separation import SeparationNet
+from .workspace import workspace_buffer, workspace_empty
 
 
 class Swish(nn.Module):
@@ -24,6 +26,8 @@ class ConvolutionModule(nn.Module):
 		"""
 	def __init__(self, channels, depth=2, compress=4, kernel=3):
 		super().__init__()
+		# Set by `SCNet.set_recompute`.
+		self.recompute = False
 		assert kernel % 2 == 1
 		self.depth = abs(depth)
 		hidden_size = int(channels / compress)
@@ -44,10 +48,42 @@ class ConvolutionModule(nn.Module):
 			self.layers.append(layer)
 
 	def forward(self, x):
+		recompute = self.recompute and self.training and torch.is_grad_enabled()
 		for layer in self.layers:
-			x = x + layer(x)
+			x = x + (checkpoint(layer, x, use_reentrant=False) if recompute else layer(x))
 		return x
 
+	@property
+	def channels_last_ready(self):
+		"""True if `forward_channels_last` can run, i.e. the convolutions were not replaced, e.g. by `quantize_model`."""
+		return all(isinstance(layer[index], nn.Conv1d) for layer in self.layers for index in (1, 3, 6))
+
+	def forward_channels_last(self, x):
+		"""
+		Inference version of `forward` for `x` of shape `[B, C, F, T]` in channels-last memory format,
+		each frequency being one sequence, which saves folding the frequencies into the batch.
+
+		In channels-last memory the `(T, C)` values of every `(b, f)` are contiguous, so the
+		GroupNorms are `layer_norm`s over them, the convolutions are `Conv2d`s with `(1, k)`
+		kernels and the pointwise convolution is a matrix product that the residual is added to.
+		"""
+		for norm, conv, _, depthwise_conv, hidden_norm, _, pointwise_conv in self.layers:
+			y = self._layer_norm_channels_last(x, norm)
+			y = F.glu(F.conv2d(y, conv.weight.unsqueeze(2), conv.bias, padding=(0, conv.padding[0])), 1)
+			y = F.conv2d(y, depthwise_conv.weight.unsqueeze(2), depthwise_conv.bias,
+						 padding=(0, depthwise_conv.padding[0]), groups=depthwise_conv.groups)
+			y = F.silu(self._layer_norm_channels_last(y, hidden_norm))
+			out = F.linear(y.permute(0, 2, 3, 1), pointwise_conv.weight[:, :, 0], pointwise_conv.bias)
+			out += x.permute(0, 2, 3, 1)
+			x = out.permute(0, 3, 1, 2)
+		return x
+
+	@staticmethod
+	def _layer_norm_channels_last(x, norm):
+		B, C, Fr, T = x.shape
+		y = F.layer_norm(x.permute(0, 2, 3, 1), (T, C), norm.weight.expand(T, C), norm.bias.expand(T, C), norm.eps)
+		return y.permute(0, 3, 1, 2)
+
 class FusionLayer(nn.Module):
 	"""
 	A FusionLayer within the decoder.
@@ -62,15 +98,51 @@ class FusionLayer(nn.Module):
 	def __init__(self, channels, kernel_size=3, stride=1, padding=1):
 		super(FusionLayer, self).__init__()
 		self.conv = nn.Conv2d(channels * 2, channels * 2, kernel_size, stride=stride, padding=padding)
+		self.folded = False
 
 	def forward(self, x, skip=None):
 		if skip is not None:
-			x += skip
-		x = x.repeat(1, 2, 1, 1)
+			x = x + skip
+		if not self.folded:
+			x = x.repeat(1, 2, 1, 1)
 		x = self.conv(x)
 		x = F.glu(x, dim=1)
 		return x
 
+	def fold(self):
+		"""
+		Fold the weights for inference: a convolution over `x` repeated twice along the channels
+		is a convolution over `x` with the two input halves of the weights summed, so `self.conv`
+		becomes a `Conv2d(channels, channels * 2)` and `forward` no longer repeats its input.
+		"""
+		if not self.folded:
+			self.conv.weight = nn.Parameter(self._fold_weight(self.conv.weight.data))
+			self.conv.in_channels //= 2
+			self.folded = True
+		return self
+
+	@staticmethod
+	def _fold_weight(weight):
+		channels = weight.shape[1] // 2
+		return weight[:, :channels] + weight[:, channels:]
+
+	def state_dict(self, *args, destination=None, prefix='', keep_vars=False):
+		# A folded layer saves an unfolded equivalent, the folded weights halved on both input
+		# halves, so checkpoints always hold unfolded weights and load into any layer.
+		destination = super().state_dict(*args, destination=destination, prefix=prefix, keep_vars=keep_vars)
+		key = prefix + 'conv.weight'
+		if self.folded and key in destination:
+			weight = destination[key] / 2
+			destination[key] = torch.cat([weight, weight], dim=1)
+		return destination
+
+	def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+		# Checkpoints hold the unfolded weights, fold them when loaded into a folded layer.
+		key = prefix + 'conv.weight'
+		if self.folded and key in state_dict and state_dict[key].shape[1] == 2 * self.conv.in_channels:
+			state_dict[key] = self._fold_weight(state_dict[key])
+		super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
 class SDlayer(nn.Module):
 	"""
 	Implements a Sparse Down-sample Layer for processing different frequency bands separately.
@@ -98,35 +170,60 @@ class SDlayer(nn.Module):
 		# Saving rate proportions for determining splits
 		self.SR_low = band_configs['low']['SR']
 		self.SR_mid = band_configs['mid']['SR']
+		# Fr -> band plan, see `_plan`
+		self.plans = {}
+
+	def _plan(self, Fr):
+		"""
+		For `Fr` frequencies, return the `(start, end, pad_left, pad_right, offset)` of every band and
+		the number of padded rows of the bands with uneven padding, computed once per `Fr`.
+		"""
+		if Fr not in self.plans:
+			edges = [0, math.ceil(Fr * self.SR_low), math.ceil(Fr * (self.SR_low + self.SR_mid)), Fr]
+			bands = []
+			buffer_length = 0
+			for stride, kernel, start, end in zip(self.strides, self.kernels, edges[:-1], edges[1:]):
+				if stride == 1:
+					total_padding = kernel - stride
+				else:
+					total_padding = (stride - (end - start) % stride) % stride
+				pad_left = total_padding // 2
+				pad_right = total_padding - pad_left
+				bands.append((start, end, pad_left, pad_right, buffer_length))
+				if pad_left != pad_right:
+					buffer_length += pad_left + end - start + pad_right
+			self.plans[Fr] = (bands, buffer_length)
+		return self.plans[Fr]
 
 	def forward(self, x):
 		B, C, Fr, T = x.shape
-		# Define splitting points based on sampling rates
-		splits = [
-			(0, math.ceil(Fr * self.SR_low)),
-			(math.ceil(Fr * self.SR_low), math.ceil(Fr * (self.SR_low + self.SR_mid))),
-			(math.ceil(Fr * (self.SR_low + self.SR_mid)), Fr)
-		]
+		bands, buffer_length = self._plan(Fr)
+		# The bands with uneven padding are copied into one buffer, each into its own contiguous
+		# part with zero padding rows. The others are convolved where they are, with the padding
+		# of the convolution. Without a workspace the buffer is allocated on every call, so the
+		# bands are copied as `F.pad` would; only a workspace reuses it. Autograd does not allow
+		# writing into a buffer whose bands it saved, so with gradients each band is padded on its own.
+		if buffer_length and not torch.is_grad_enabled():
+			buffer = workspace_empty(self, 'bands', (B * C * buffer_length * T,), x)
+		else:
+			buffer = None
 
 		# Processing each band with the corresponding convolution
 		outputs = []
-		original_lengths=[]
-		for conv, stride, kernel, (start, end) in zip(self.convs, self.strides, self.kernels, splits):
-			extracted = x[:, :, start:end, :]
-			original_lengths.append(end-start)
-			current_length = extracted.shape[2]
-
-			# padding
-			if stride == 1:
-				total_padding = kernel - stride
+		original_lengths = []
+		for conv, (start, end, pad_left, pad_right, offset) in zip(self.convs, bands):
+			original_lengths.append(end - start)
+			if pad_left == pad_right:
+				output = F.conv2d(x[:, :, start:end, :], conv.weight, conv.bias, conv.stride, (pad_left, 0))
+			elif buffer is None:
+				output = conv(F.pad(x[:, :, start:end, :], (0, 0, pad_left, pad_right)))
 			else:
-				total_padding = (stride - current_length % stride) % stride
-			pad_left = total_padding // 2
-			pad_right = total_padding - pad_left
-
-			padded = F.pad(extracted, (0, 0, pad_left, pad_right))
-
-			output = conv(padded)
+				length = pad_left + end - start + pad_right
+				padded = buffer[B * C * offset * T:B * C * (offset + length) * T].view(B, C, length, T)
+				padded[:, :, :pad_left].zero_()
+				padded[:, :, pad_left:pad_left + end - start].copy_(x[:, :, start:end, :])
+				padded[:, :, pad_left + end - start:].zero_()
+				output = conv(padded)
 			outputs.append(output)
 
 		return outputs, original_lengths
@@ -171,8 +268,12 @@ class SUlayer(nn.Module):
 
 			outputs.append(trimmed_out)
 
-		# Concatenate trimmed outputs along the frequency dimension to return the final tensor
-		x = torch.cat(outputs, dim=2)
+		# Concatenate trimmed outputs along the frequency dimension to return the final tensor.
+		# Transposed convolutions cannot write into a slice of it, so the bands are always copied.
+		# With a workspace, the outputs of all SUlayers share one buffer instead of being allocated,
+		# as each is consumed before the next SUlayer runs.
+		out = workspace_buffer(self, 'decoder', (B, outputs[0].shape[1], sum(origin_lengths), T), outputs[0])
+		x = torch.cat(outputs, dim=2) if out is None else torch.cat(outputs, dim=2, out=out)
 
 		return x
 
@@ -200,16 +301,22 @@ class SDblock(nn.Module):
 
 	def forward(self, x):
 		bands, original_lengths = self.SDlayer(x)
-		# B, C, f, T = band.shape
-		bands = [
-			F.gelu(
-				conv(band.permute(0, 2, 1, 3).reshape(-1, band.shape[1], band.shape[3]))
-				.view(band.shape[0], band.shape[2], band.shape[1], band.shape[3])
-				.permute(0, 2, 1, 3)
-			)
-			for conv, band in zip(self.conv_modules, bands)
+		if self.training or not all(conv.channels_last_ready for conv in self.conv_modules):
+			# B, C, f, T = band.shape
+			bands = [
+				F.gelu(
+					conv(band.permute(0, 2, 1, 3).reshape(-1, band.shape[1], band.shape[3]))
+					.view(band.shape[0], band.shape[2], band.shape[1], band.shape[3])
+					.permute(0, 2, 1, 3)
+				)
+				for conv, band in zip(self.conv_modules, bands)
 
-		]
+			]
+		else:
+			bands = [
+				F.gelu(conv.forward_channels_last(band.contiguous(memory_format=torch.channels_last)))
+				for conv, band in zip(self.conv_modules, bands)
+			]
 		lengths = [band.size(-2) for band in bands]
 		full_band = torch.cat(bands, dim=2)
 		skip = full_band
@@ -238,6 +345,10 @@ class SCNet(nn.Module):
 	- conv_kernel (int): Kernel size for convolution layer in convolution module.
 	- num_dplayer (int): Number of dual-path layers.
 	- expand (int): Expansion factor in the dual-path RNN, default is 1.
+	- recompute (List[str]): Stages whose activations are recomputed in the backward pass instead of
+	  saved, to train with larger batches or segments: `encoder` (each layer of the convolution
+	  modules), `separation` (each dual-path layer) and `decoder` (each FusionLayer and SUlayer),
+	  see `set_recompute`.
 
 	"""
 	def __init__(self,
@@ -261,6 +372,7 @@ class SCNet(nn.Module):
 				# Dual-path RNN
 				num_dplayer = 6,
 				expand = 1,
+				recompute = (),
 				):
 		super().__init__()
 		self.sources = sources
@@ -310,6 +422,31 @@ class SCNet(nn.Module):
 			expand = expand,
 			num_layers = num_dplayer,
 		)
+		self.set_recompute(recompute)
+
+	stages = ('encoder', 'separation', 'decoder')
+
+	def set_recompute(self, stages):
+		"""Recompute the activations of `stages`, a subset of `SCNet.stages`, in the backward pass."""
+		unknown = [stage for stage in stages if stage not in self.stages]
+		if unknown:
+			raise ValueError(f"Unknown stages {unknown}, expected some of {list(self.stages)}")
+		self.recompute = list(stages)
+		# The encoder recomputes each layer of its convolution modules, which hold most of its
+		# activations, so that recomputing the first SDblock does not bring them all back at once.
+		for module in self.encoder.modules():
+			if isinstance(module, ConvolutionModule):
+				module.recompute = 'encoder' in self.recompute
+		self.separation_net.recompute = 'separation' in self.recompute
+
+	def _run(self, stage, function, *args):
+		if stage in self.recompute and self.training and torch.is_grad_enabled():
+			return checkpoint(function, *args, use_reentrant=False)
+		return function(*args)
+
+	@staticmethod
+	def _decode(fusion_layer, su_layer, x, skip, lengths, original_lengths):
+		return su_layer(fusion_layer(x, skip), lengths, original_lengths)
 
 
 	def forward(self, x):
@@ -320,19 +457,38 @@ class SCNet(nn.Module):
 		padding = self.hop_length - x.shape[-1] % self.hop_length
 		if (x.shape[-1] + padding) // self.hop_length % 2 == 0:
 			padding += self.hop_length
-		x = F.pad(x, (0, padding))
+		if getattr(self, 'workspace', None) is not None:
+			self.workspace.begin(x.shape)
+		padded = workspace_buffer(self, 'input', (*x.shape[:-1], x.shape[-1] + padding), x)
+		if padded is None:
+			x = F.pad(x, (0, padding))
+		else:
+			padded[..., :x.shape[-1]].copy_(x)
+			padded[..., x.shape[-1]:].zero_()
+			x = padded
 
 		# STFT
 		L = x.shape[-1]
 		x = x.reshape(-1, L)
 		x = torch.stft(x, **self.stft_config, return_complex=True)
 		x = torch.view_as_real(x)
-		x = x.permute(0, 3, 1, 2).reshape(x.shape[0]//self.audio_channels, x.shape[3]*self.audio_channels, x.shape[1], x.shape[2])
+		shape = (x.shape[0]//self.audio_channels, x.shape[3]*self.audio_channels, x.shape[1], x.shape[2])
+		# The spectrogram is consumed by the first SDblock, the output reuses its buffer.
+		spectrogram = workspace_buffer(self, 'spectrum', shape, x)
+		if spectrogram is None:
+			x = x.permute(0, 3, 1, 2).reshape(shape)
+		else:
+			x = spectrogram.view(x.shape[0], x.shape[3], x.shape[1], x.shape[2]).copy_(x.permute(0, 3, 1, 2)).view(shape)
 
 		B, C, Fr, T = x.shape
 		mean = x.mean(dim=(1, 2, 3), keepdim=True)
 		std = x.std(dim=(1, 2, 3), keepdim=True)
-		x = (x - mean) / (1e-5 + std)
+		if spectrogram is None:
+			x = (x - mean) / (1e-5 + std)
+		else:
+			x = x.sub_(mean).div_(1e-5 + std)
+		# The network runs in the dtype of its weights, the STFT and iSTFT in float32.
+		x = x.to(self.encoder[0].globalconv.weight.dtype)
 
 		save_skip = deque()
 		save_lengths = deque()
@@ -349,15 +505,22 @@ class SCNet(nn.Module):
 
 		#decoder
 		for fusion_layer, su_layer in self.decoder:
-			x = fusion_layer(x, save_skip.pop())
-			x = su_layer(x, save_lengths.pop(), save_original_lengths.pop())
+			x = self._run('decoder', self._decode, fusion_layer, su_layer, x, save_skip.pop(), save_lengths.pop(),
+						  save_original_lengths.pop())
 
 		#output
 		n = self.dims[0]
-		x = x.view(B, n, -1, Fr, T)
-		x = x * std[:, None] + mean[:, None]
-		x = x.reshape(-1, 2, Fr, T).permute(0, 2, 3, 1)
-		x = torch.view_as_complex(x.contiguous())
+		x = x.float().view(B, n, -1, Fr, T)
+		output = workspace_buffer(self, 'spectrum', (x.numel() // (2 * Fr * T), Fr, T, 2), x)
+		if output is None:
+			x = x * std[:, None] + mean[:, None]
+			x = x.reshape(-1, 2, Fr, T).permute(0, 2, 3, 1)
+			x = torch.view_as_complex(x.contiguous())
+		else:
+			# Denormalize straight into the layout of `view_as_complex`.
+			torch.addcmul(mean[:, None, None], x.view(B, n, -1, 2, Fr, T), std[:, None, None],
+						  out=output.permute(0, 3, 1, 2).view(B, n, -1, 2, Fr, T))
+			x = torch.view_as_complex(output)
 		x = torch.istft(x, **self.stft_config)
 		x = x.reshape(B, len(self.sources), self.audio_channels, -1)
 
@@ -3,6 +3,11 @@ warnings.filterwarnings('always', module='hhSCNet.*')
 
 from hhSCNet.purgatory import loadModelConfigurationYaml
 from hhSCNet.inference import runInference
+from hhSCNet.parity import runParity
+from hhSCNet.exported import runExport
+from hhSCNet.benchmark import runBenchmark
+from hhSCNet.prune import runPrune
+from hhSCNet.packed import runPack
 from hhSCNet.train import trainModel
 from hhSCNet.commandLine import processCommandLine
 
@@ -1,4 +1,5 @@
 import random
+from collections import OrderedDict
 from concurrent.futures import ThreadPoolExecutor
 
 import torch
@@ -6,7 +7,7 @@ from tqdm.auto import tqdm
 from accelerate import Accelerator
 from torch.nn import functional as F
 
-from .utils import DummyPoolExecutor, center_trim
+from .utils import DummyPoolExecutor, center_trim, memmap_zeros
 
 accelerator = Accelerator()
 
@@ -59,9 +60,177 @@ def tensor_chunk(tensor_or_chunk):
 		return TensorChunk(tensor_or_chunk)
 
 
+def transition_weight(segment, transition_power=1., device=None):
+	"""Overlap-add weight of one chunk of `segment` samples."""
+	weight = torch.cat([torch.arange(1, segment // 2 + 1, device=device),
+						torch.arange(segment - segment // 2, 0, -1, device=device)])
+	assert len(weight) == segment
+	# If the overlap < 50%, this will translate to linear transition when
+	# transition_power is 1.
+	return (weight / weight.max())**transition_power
+
+
+def shift_offsets(shifts, max_shift, deterministic=False):
+	"""Offsets of the `shifts` shifted copies: random, or evenly spaced in `[0, max_shift)`."""
+	if deterministic:
+		return [max_shift * index // shifts for index in range(shifts)]
+	return [random.randint(0, max_shift) for _ in range(shifts)]
+
+
+class ScheduledTrack:
+	def __init__(self, key, mix, pad, sum_weight):
+		self.key = key
+		self.mix = mix
+		self.pad = pad
+		self.batch = mix.shape[0]
+		self.out = None
+		self.sum_weight = sum_weight
+		self.remaining = 0
+
+
+class ChunkScheduler:
+	"""
+	Cut overlapping chunks from one or many tracks and run them through the model in batches.
+
+	Each submitted track is padded once and its chunks are views of that buffer. Chunks
+	with the same input length, from any track, are stacked into batches of `batch_size`
+	and every result is overlap-added into the output of the track it came from. Chunk
+	offsets and weights are the same as `apply_model` with `split=True`. Every shifted
+	copy of a chunk is `max_shift` longer than the chunk, so shifted chunks batch too.
+	The outputs match the per-chunk path only with `shifts=0` or `deterministic_shifts`:
+	otherwise every chunk draws its own random offsets.
+
+		scheduler = ChunkScheduler(model, batch_size=8)
+		for key, out in scheduler.submit(mix, key):
+			...
+		for key, out in scheduler.flush():
+			...
+
+	Args:
+		batch_size (int): number of chunks stacked in one call of the model.
+		max_tracks (int): number of tracks kept in flight. When a new track would exceed it,
+			the oldest track is finished with partial batches, so memory stays bounded
+			when tracks are queued from a directory.
+		shifts, deterministic_shifts, segment, samplerate, overlap, transition_power: see `apply_model`.
+		progress (bool): if True, show a progress bar of the processed chunks.
+		memmap_dir (str or None): if given, the padded input, the outputs and the overlap-add
+			weights of every track are float32 memory-mapped files in this directory, so memory
+			use depends on `segment` and `batch_size` instead of the track length.
+		device (torch.device, str, or None): device on which the model runs, the device of
+			the accelerator if None.
+	"""
+	def __init__(self, model, batch_size=8, max_tracks=2, shifts=1, segment=20, samplerate=44100,
+				overlap=0.25, transition_power=1., progress=False, memmap_dir=None,
+				deterministic_shifts=False, device=None):
+		assert transition_power >= 1, "transition_power < 1 leads to weird behavior."
+		assert batch_size >= 1
+		self.device = torch.device(device) if device is not None else accelerator.device
+		self.model = accelerator.unwrap_model(model)
+		self.model.to(self.device)
+		self.batch_size = batch_size
+		self.max_tracks = max(1, max_tracks)
+		self.shifts = shifts
+		self.deterministic_shifts = deterministic_shifts
+		self.max_shift = int(0.5 * samplerate)
+		self.segment = int(samplerate * segment)
+		self.stride = int((1 - overlap) * self.segment)
+		self.weight = transition_weight(self.segment, transition_power, self.device)
+		self.tracks = []
+		self.finished = []
+		# input length -> chunks waiting for a batch
+		self.pending = OrderedDict()
+		self.progress = tqdm(unit='chunks', ncols=120) if progress else None
+		self.memmap_dir = memmap_dir
+
+	def zeros(self, *shape, device=None):
+		if self.memmap_dir is not None:
+			return memmap_zeros(shape, self.memmap_dir)
+		return torch.zeros(*shape, device=device)
+
+	def submit(self, mix, key=None):
+		"""
+		Queue the chunks of `mix` (`[batch, channels, length]`) and run every full batch.
+		Returns the list of `(key, out)` of the tracks finished so far.
+		"""
+		batch, channels, length = mix.shape
+		pad = self.max_shift if self.shifts else 0
+		sum_weight = self.zeros(length, device=mix.device)
+		if pad:
+			padded = self.zeros(batch, channels, length + 2 * pad, device=mix.device)
+			padded[..., pad:pad + length] = mix
+		else:
+			padded = mix
+		track = ScheduledTrack(key, padded, pad, sum_weight)
+		# (input start, input length, output trim, output offset, output length) of every chunk
+		chunks = []
+		for offset in range(0, length, self.stride):
+			chunk_length = min(self.segment, length - offset)
+			sum_weight[offset:offset + chunk_length] += self.weight[:chunk_length].to(mix.device)
+			if self.shifts:
+				# Shifted copies have the same length whatever the shift, so they batch together.
+				for shift in shift_offsets(self.shifts, self.max_shift, self.deterministic_shifts):
+					chunks.append((offset + shift, chunk_length + self.max_shift,
+								   self.max_shift - shift, offset, chunk_length))
+			else:
+				chunks.append((offset, chunk_length, 0, offset, chunk_length))
+		assert sum_weight.min() > 0
+		track.remaining = len(chunks)
+		self.tracks.append(track)
+		for start, input_length, trim, offset, chunk_length in chunks:
+			items = self.pending.setdefault(input_length, [])
+			items.append((track, start, trim, offset, chunk_length))
+			if len(items) == self.batch_size:
+				self._run(input_length)
+		while len(self.tracks) > self.max_tracks:
+			self._finish_track(self.tracks[0])
+		return self._drain()
+
+	def flush(self):
+		"""Run every queued chunk, in partial batches if needed, and return the finished tracks."""
+		while self.pending:
+			self._run(next(iter(self.pending)))
+		if self.progress is not None:
+			self.progress.close()
+		return self._drain()
+
+	def _finish_track(self, track):
+		while track.remaining:
+			input_length = next(length for length, items in self.pending.items()
+								if any(item[0] is track for item in items))
+			self._run(input_length)
+
+	def _run(self, input_length):
+		items = self.pending.pop(input_length)
+		mix = torch.cat([track.mix[..., start:start + input_length] for track, start, *_ in items])
+		with torch.no_grad():
+			out = self.model(mix.to(self.device))
+		out = center_trim(out, input_length)
+		row = 0
+		for track, _, trim, offset, chunk_length in items:
+			chunk_out = out[row:row + track.batch, ..., trim:trim + chunk_length]
+			row += track.batch
+			if track.out is None:
+				track.out = self.zeros(track.batch, *chunk_out.shape[1:-1], track.sum_weight.shape[-1],
+									   device=track.mix.device)
+			if self.shifts:
+				chunk_out = chunk_out / self.shifts
+			track.out[..., offset:offset + chunk_length] += (self.weight[:chunk_length] * chunk_out).to(track.mix.device)
+			track.remaining -= 1
+			if not track.remaining:
+				track.out /= track.sum_weight
+				self.tracks.remove(track)
+				self.finished.append((track.key, track.out))
+		if self.progress is not None:
+			self.progress.update(len(items))
+
+	def _drain(self):
+		finished, self.finished = self.finished, []
+		return finished
+
+
 def apply_model(model, mix, shifts=1, split=True, segment=20, samplerate=44100,
 				overlap=0.25, transition_power=1., progress=False, device=None,
-				num_workers=0, pool=None):
+				num_workers=0, pool=None, batch_size=1, memmap_dir=None, deterministic_shifts=False):
 	"""
 	Apply model to a given mixture.
 
@@ -69,17 +238,23 @@ def apply_model(model, mix, shifts=1, split=True, segment=20, samplerate=44100,
 		shifts (int): if > 0, will shift in time `mix` by a random amount between 0 and 0.5 sec
 			and apply the opposite shift to the output. This is repeated `shifts`-times and
 			all predictions are averaged. This effectively makes the model time equivariant
-			and improves SDR by up to 0.2 points.
+			and improves SDR by up to 0.2 points. All shifted copies run in a single batch.
+		deterministic_shifts (bool): if True, the `shifts` offsets are evenly spaced instead of
+			random, so results are reproducible.
 		split (bool): if True, the input will be broken down in 8 seconds extracts
 			and predictions will be performed individually on each and concatenated.
 			Useful for model with large memory footprint like Tasnet.
 		progress (bool): if True, show a progress bar (requires split=True)
 		device (torch.device, str, or None): if provided, device on which to
-			execute the computation, otherwise `mix.device` is assumed.
+			execute the computation, otherwise the device of the accelerator.
 			When `device` is different from `mix.device`, only local computations will
 			be on `device`, while the entire tracks will be stored on `mix.device`.
+		batch_size (int): if > 1 and `split` is True, chunks are stacked in batches of
+			`batch_size` by a `ChunkScheduler` instead of being run one at a time.
+		memmap_dir (str or None): if given and `split` is True, overlap-add into memory-mapped
+			files in this directory, see `ChunkScheduler`.
 	"""
-	device = accelerator.device
+	device = torch.device(device) if device is not None else accelerator.device
 	if pool is None:
 		if num_workers > 0 and device.type == 'cpu':
 			pool = ThreadPoolExecutor(num_workers)
@@ -93,13 +268,22 @@ def apply_model(model, mix, shifts=1, split=True, segment=20, samplerate=44100,
 		'progress': progress,
 		'device': device,
 		'pool': pool,
+		'deterministic_shifts': deterministic_shifts,
 	}
 	model = accelerator.unwrap_model(model)
 	model.to(device)
 
 	assert transition_power >= 1, "transition_power < 1 leads to weird behavior."
 	batch, channels, length = mix.shape
-	if split:
+	if split and (batch_size > 1 or memmap_dir is not None):
+		scheduler = ChunkScheduler(model, batch_size=batch_size, shifts=shifts, segment=segment,
+								samplerate=samplerate, overlap=overlap,
+								transition_power=transition_power, progress=progress,
+								memmap_dir=memmap_dir, deterministic_shifts=deterministic_shifts,
+								device=device)
+		(_, out), = scheduler.submit(mix) + scheduler.flush()
+		return out
+	elif split:
 		kwargs['split'] = False
 		out = torch.zeros(batch, len(model.sources), channels, length, device=mix.device)
 		sum_weight = torch.zeros(length, device=mix.device)
@@ -107,12 +291,7 @@ def apply_model(model, mix, shifts=1, split=True, segment=20, samplerate=44100,
 		stride = int((1 - overlap) * segment)
 		offsets = range(0, length, stride)
 		scale = stride / samplerate
-		weight = torch.cat([torch.arange(1, segment // 2 + 1, device=device),
-						 torch.arange(segment - segment // 2, 0, -1, device=device)])			  
-		assert len(weight) == segment
-		# If the overlap < 50%, this will translate to linear transition when
-		# transition_power is 1.
-		weight = (weight / weight.max())**transition_power
+		weight = transition_weight(segment, transition_power, device)
 		futures = []
 		for offset in offsets:
 			chunk = TensorChunk(mix, offset, segment)
@@ -134,14 +313,18 @@ def apply_model(model, mix, shifts=1, split=True, segment=20, samplerate=44100,
 		max_shift = int(0.5 * samplerate)
 		mix = tensor_chunk(mix)
 		padded_mix = mix.padded(length + 2 * max_shift)
+		offsets = shift_offsets(shifts, max_shift, deterministic_shifts)
+		# Every shifted copy is `length + max_shift` long, so all of them run as one batch.
+		shifted = torch.cat([padded_mix[..., offset:offset + length + max_shift] for offset in offsets])
+		shifted_out = apply_model(model, shifted, **kwargs)
 
-		out = torch.tensor(0)
-
-		for _ in range(shifts):
-			offset = random.randint(0, max_shift)
-			shifted = TensorChunk(padded_mix, offset, length + max_shift - offset)
-			shifted_out = apply_model(model, shifted, **kwargs)
-			out += shifted_out[..., max_shift - offset:]
+		out = None
+		for index, offset in enumerate(offsets):
+			shift_out = shifted_out[index * batch:(index + 1) * batch, ..., max_shift - offset:max_shift - offset + length]
+			if out is None:
+				out = shift_out.clone()
+			else:
+				out += shift_out
 		out /= shifts
 		return out
 	else:
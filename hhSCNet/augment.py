@@ -99,6 +99,22 @@ class Scale(nn.Module):
 			wav *= scales
 		return wav
 
+def augment_together(augment, *wavs):
+	"""
+	Apply `augment` to each of `wavs`, tensors of the same shape, with the same random draws, e.g.
+	to the sources of a batch and to the teacher estimates of those sources.
+	"""
+	devices = [wav.device for wav in wavs if wav.device.type == 'cuda']
+	states = (random.getstate(), torch.get_rng_state(), [torch.cuda.get_rng_state(device) for device in devices])
+	outputs = []
+	for wav in wavs:
+		random.setstate(states[0])
+		torch.set_rng_state(states[1])
+		for device, state in zip(devices, states[2]):
+			torch.cuda.set_rng_state(state, device)
+		outputs.append(augment(wav))
+	return outputs
+
 # Some or all of the work in this file may be restricted by the following copyright.
 """
 MIT License
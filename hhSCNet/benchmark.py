@@ -0,0 +1,96 @@
+import copy
+import multiprocessing
+import statistics
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+
+from hhSCNet import loadModelConfigurationYaml
+
+from .SCNet import SCNet
+from .utils import load_model, peak_memory
+
+
+def time_module(module, inputs, repeats):
+	"""Median seconds of `repeats` calls of `module(*inputs)` without gradients, after one warm-up call."""
+	durations = []
+	with torch.no_grad():
+		module(*inputs)
+		for _ in range(repeats):
+			start = time.perf_counter()
+			module(*inputs)
+			durations.append(time.perf_counter() - start)
+	return statistics.median(durations)
+
+def _peak_memory(module, inputs):
+	with torch.no_grad(), peak_memory('cpu') as memory:
+		module(*inputs)
+	return memory['MB']
+
+def process_peak_memory(module, inputs):
+	"""
+	Increase in MB of the peak resident memory during one call of `module(*inputs)`, measured in a
+	new process on Linux, NaN elsewhere.
+	"""
+	if not sys.platform.startswith('linux'):
+		return float('nan')
+	with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+		return executor.submit(_peak_memory, module, inputs).result()
+
+def runBenchmark(modelConfiguration: str = "./conf/config.yaml",
+				checkpoint: str = '',
+				segment: float = 20,
+				batch_size: int = 1,
+				repeats: int = 3,
+				memory: bool = True) -> dict:
+	"""Time each SDblock, the SeparationNet and each FusionLayer in their training layout and in their inference layout.
+
+	Parameters
+		modelConfiguration: Path to model configuration YAML file
+		checkpoint: Path to model checkpoint file, random weights if empty, which take as long
+		segment: Seconds of audio in each chunk
+		batch_size: Number of chunks in each call of the model
+		repeats: Number of timed calls of each block, the median is reported
+		memory: Also measure the peak memory of one call of each block, in a new process
+	"""
+	config = loadModelConfigurationYaml(modelConfiguration)
+	model = SCNet(**config.model)
+	if checkpoint:
+		model = load_model(model, checkpoint)
+	model.eval()
+
+	# The normalized spectrogram that the first SDblock receives from `SCNet.forward`.
+	frames = int(segment * config.data.samplerate) // model.hop_length + 2
+	x = torch.randn(batch_size, 2 * model.audio_channels, model.stft_config['n_fft'] // 2 + 1, frames)
+
+	report = {}
+	print(f"{'block':>14} {'input':>22} {'training layout':>16} {'inference layout':>17} {'speedup':>8}"
+		  f"{'training MB':>12} {'inference MB':>13}")
+
+	def compare(name, training_module, inference_module, inputs):
+		shape = 'x'.join(str(size) for size in inputs[0].shape)
+		training = time_module(training_module, inputs, repeats)
+		inference = time_module(inference_module, inputs, repeats)
+		report[f'{name} training'] = training
+		report[f'{name} inference'] = inference
+		line = f"{name:>14} {shape:>22} {training:15.3f}s {inference:16.3f}s {training / inference:7.2f}x"
+		if memory:
+			report[f'{name} training MB'] = process_peak_memory(training_module, inputs)
+			report[f'{name} inference MB'] = process_peak_memory(inference_module, inputs)
+			line += f"{report[f'{name} training MB']:12.0f} {report[f'{name} inference MB']:13.0f}"
+		print(line)
+
+	skips = []
+	for index, block in enumerate(model.encoder):
+		compare(f'SDblock {index}', copy.deepcopy(block).train(), block, (x,))
+		with torch.no_grad():
+			x = block(x)[0]
+		skips.append(x)
+	compare('SeparationNet', copy.deepcopy(model.separation_net).train(), model.separation_net, (x,))
+	# The decoder levels get inputs of the size of the encoder outputs, in reverse order.
+	for index, (fusion_layer, _) in enumerate(model.decoder):
+		skip = skips[-1 - index]
+		compare(f'FusionLayer {index}', fusion_layer, copy.deepcopy(fusion_layer).fold(), (skip, skip))
+	return report
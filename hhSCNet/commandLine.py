@@ -24,6 +24,31 @@ registryCommands = [
 		name='inference',
 		module='.inference',
 		function='runInference'
+	),
+	registrantCommand(
+		name='parity',
+		module='.parity',
+		function='runParity'
+	),
+	registrantCommand(
+		name='export',
+		module='.exported',
+		function='runExport'
+	),
+	registrantCommand(
+		name='benchmark',
+		module='.benchmark',
+		function='runBenchmark'
+	),
+	registrantCommand(
+		name='prune',
+		module='.prune',
+		function='runPrune'
+	),
+	registrantCommand(
+		name='pack',
+		module='.packed',
+		function='runPack'
 	)
 ]
 
@@ -72,6 +97,11 @@ def addParameterToParser(parserCommand: argparse.ArgumentParser, nameParameter:
 	if not dictionaryParameterInfo['required']:
 		dictionaryKwargs['default'] = dictionaryParameterInfo['default']
 
+	if dictionaryParameterInfo['type'] is bool:
+		# `--flag` and `--no-flag` instead of parsing a string
+		dictionaryKwargs.pop('type')
+		dictionaryKwargs['action'] = argparse.BooleanOptionalAction
+
 	parserCommand.add_argument(f'--{nameParameter}', **dictionaryKwargs)
 
 def createParserWithCommands() -> argparse.ArgumentParser:
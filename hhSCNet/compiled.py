@@ -0,0 +1,112 @@
+import hashlib
+import os
+import time
+
+import torch
+import torch.nn as nn
+
+# Saving and loading the compiled artifacts needs torch 2.7, older versions only keep the
+# Inductor cache.
+cache_artifacts = hasattr(getattr(torch, 'compiler', None), 'save_cache_artifacts')
+
+
+class CompiledModel(nn.Module):
+	"""
+	Run `model` through `torch.compile` for one fixed input shape, and eagerly for any other.
+
+	`apply_model` calls the model with the same `[batch, channels, length]` chunks again and
+	again, so the model is compiled without dynamic shapes for `shape` and warmed up once.
+	Smaller batches of the same length are padded with zeros to use the compiled graph, and
+	other shapes, e.g. the last chunk of a track, run in eager mode.
+
+	The compiled artifacts are saved in `cache_dir` and loaded by later processes, which then
+	skip most of the compilation. If compiling or running the compiled model fails, the model
+	runs in eager mode from then on.
+
+	Args:
+		model: the separation model, already on its device and in its final precision.
+		shape (tuple of int): `(batch, channels, length)` of the compiled input.
+		cache_dir (str or None): directory of the compile cache, no persistent cache if None.
+		mode (str or None): `mode` of `torch.compile`.
+	"""
+	def __init__(self, model, shape, cache_dir=None, mode=None):
+		super().__init__()
+		self.model = model
+		self.shape = tuple(shape)
+		self.cache_dir = cache_dir
+		self.mode = mode
+		self.compiled = None
+		self._compile()
+
+	@property
+	def sources(self):
+		return self.model.sources
+
+	@property
+	def audio_channels(self):
+		return self.model.audio_channels
+
+	def _cache_path(self):
+		parameter = next(self.model.parameters())
+		key = f"{torch.__version__}-{parameter.device}-{parameter.dtype}-{self.shape}-{self.mode}-{self.model.sources}"
+		return os.path.join(self.cache_dir, f"scnet-{hashlib.sha1(key.encode()).hexdigest()[:16]}.bin")
+
+	def _load_cache(self):
+		os.makedirs(self.cache_dir, exist_ok=True)
+		# Inductor keeps its own kernels and graphs next to the saved artifacts.
+		os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.join(self.cache_dir, 'inductor'))
+		if cache_artifacts and os.path.isfile(self._cache_path()):
+			with open(self._cache_path(), 'rb') as file:
+				torch.compiler.load_cache_artifacts(file.read())
+
+	def _save_cache(self):
+		artifacts = torch.compiler.save_cache_artifacts() if cache_artifacts else None
+		if artifacts is not None:
+			temporary = self._cache_path() + f'.{os.getpid()}.tmp'
+			with open(temporary, 'wb') as file:
+				file.write(artifacts[0])
+			os.replace(temporary, self._cache_path())
+
+	def _compile(self):
+		start = time.time()
+		try:
+			if self.cache_dir is not None:
+				self._load_cache()
+			self.compiled = torch.compile(self.model.forward, dynamic=False, mode=self.mode)
+			parameter = next(self.model.parameters())
+			with torch.no_grad():
+				self.compiled(torch.zeros(self.shape, device=parameter.device))
+		except Exception as error:
+			print(f"WARNING, compiling the model failed, running in eager mode: {error!r}")
+			self.compiled = None
+			return
+		print(f"Compiled the model for inputs of shape {list(self.shape)} in {time.time() - start:.1f}s")
+		if self.cache_dir is not None:
+			# The compiled model is kept even if its artifacts cannot be saved.
+			try:
+				self._save_cache()
+			except Exception as error:
+				print(f"WARNING, saving the compile cache failed: {error!r}")
+
+	def forward(self, x):
+		batch = x.shape[0]
+		if self.compiled is None or x.shape[1:] != self.shape[1:] or batch > self.shape[0]:
+			return self.model(x)
+		if batch < self.shape[0]:
+			x = torch.cat([x, x.new_zeros((self.shape[0] - batch,) + self.shape[1:])])
+		try:
+			return self.compiled(x)[:batch]
+		except Exception as error:
+			print(f"WARNING, the compiled model failed, running in eager mode: {error!r}")
+			self.compiled = None
+			return self.model(x[:batch])
+
+	def __getstate__(self):
+		# The compiled function cannot be pickled, the worker processes compile their own.
+		state = self.__dict__.copy()
+		state['compiled'] = None
+		return state
+
+	def __setstate__(self, state):
+		super().__setstate__(state)
+		self._compile()
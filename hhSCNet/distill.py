@@ -0,0 +1,84 @@
+from pathlib import Path
+
+import soundfile as sf
+import torch
+from torch.utils.data import Dataset
+
+from hhSCNet import loadModelConfigurationYaml
+
+from .apply import apply_model
+from .log import logger
+from .packed import PackedSet
+from .SCNet import SCNet
+from .utils import load_model
+from .wav import MIXTURE, Wavset
+
+
+def load_teacher(config, device):
+	"""
+	The frozen teacher of the `distill` section of the training configuration `config`: the
+	`SCNet` of the `teacher_config` YAML file, or of the `model` section if empty, with the
+	weights of the `teacher` checkpoint.
+	"""
+	distill = config.distill
+	model_config = loadModelConfigurationYaml(distill.teacher_config).model if distill.teacher_config else config.model
+	teacher = load_model(SCNet(**model_config), distill.teacher)
+	if list(teacher.sources) != list(config.model.sources):
+		raise ValueError(f"The teacher separates {teacher.sources}, the model {list(config.model.sources)}")
+	return teacher.to(device).eval().requires_grad_(False)
+
+def precompute_teacher(teacher, dataset, directory, segment=20):
+	"""
+	Separate each track of the training `Wavset` `dataset` with `teacher` and write the estimates
+	to `directory`, one folder per track with a float32 WAV file per source, for `DistillationSet`.
+
+	The estimates are of the normalized mixture, as the model sees it, and are written denormalized,
+	so that `Wavset` normalizes them back. Tracks already in `directory` are kept.
+	"""
+	directory = Path(directory)
+	if isinstance(dataset, PackedSet):
+		mixtures = PackedSet(dataset.root, [MIXTURE])
+	for position, (name, meta) in enumerate(dataset.metadata.items()):
+		folder = directory / name
+		if all((folder / f'{source}.wav').is_file() for source in dataset.sources):
+			continue
+		if isinstance(dataset, PackedSet):
+			# One example per whole track, in the order of the tracks of `dataset`.
+			mix = mixtures[position][0]
+		else:
+			mix = Wavset(dataset.root, {name: meta}, [MIXTURE], samplerate=dataset.samplerate,
+						 channels=dataset.channels, normalize=dataset.normalize)[0][0]
+		with torch.no_grad():
+			estimates = apply_model(teacher, mix[None], shifts=0, split=True, segment=segment,
+									samplerate=dataset.samplerate)[0].cpu()
+		if dataset.normalize:
+			estimates = estimates * meta['std'] + meta['mean']
+		folder.mkdir(parents=True, exist_ok=True)
+		for source, estimate in zip(dataset.sources, estimates):
+			# Written under a temporary name, an interrupted run does not leave a partial track.
+			temporary = folder / f'{source}.tmp.wav'
+			sf.write(temporary, estimate.t().numpy(), dataset.samplerate, subtype='FLOAT')
+			temporary.replace(folder / f'{source}.wav')
+		logger.info(f'Teacher estimates of {name} written to {folder}')
+
+class DistillationSet(Dataset):
+	"""
+	The examples of the training `Wavset` `dataset`, each followed along the sources by the
+	teacher estimates of the same extract, read from the `directory` of `precompute_teacher`.
+	"""
+	def __init__(self, dataset, directory):
+		self.dataset = dataset
+		# The estimates are at the sample rate of the model and have the statistics of the mixture.
+		metadata = {name: dict(meta, samplerate=dataset.samplerate,
+							   length=sf.info(str(Path(directory) / name / f'{dataset.sources[0]}.wav')).frames)
+					for name, meta in dataset.metadata.items()}
+		self.targets = Wavset(directory, metadata, dataset.sources, segment=dataset.segment, shift=dataset.shift,
+							  normalize=dataset.normalize, samplerate=dataset.samplerate, channels=dataset.channels)
+		if self.targets.num_examples != dataset.num_examples:
+			raise ValueError(f"The teacher estimates in {directory} do not match the training tracks")
+
+	def __len__(self):
+		return len(self.dataset)
+
+	def __getitem__(self, index):
+		return torch.cat([self.dataset[index], self.targets[index]])
@@ -0,0 +1,135 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+# Stored next to the program, read back by `load_exported`.
+metadata_name = 'hhSCNet.json'
+
+class ExportedModel(nn.Module):
+	"""
+	Run a program written by `export_model` in place of an `SCNet`.
+
+	The program takes any batch size but one chunk length. Shorter chunks, i.e. the last chunk
+	of a track, are padded with zeros at the end and the output is trimmed back. As `SCNet`
+	normalizes each chunk, their output differs from the eager model, most for tracks shorter
+	than one chunk.
+
+	Args:
+		module: the module of the loaded `torch.export.ExportedProgram`.
+		metadata (dict): `sources`, `audio_channels` and `length` of the program.
+	"""
+	def __init__(self, module, metadata):
+		super().__init__()
+		self.module = module
+		self.metadata = metadata
+		self.sources = list(metadata['sources'])
+		self.audio_channels = metadata['audio_channels']
+		self.length = metadata['length']
+
+	def forward(self, x):
+		length = x.shape[-1]
+		if length > self.length:
+			raise ValueError(f"The program was exported for chunks of at most {self.length} samples, got {length}")
+		if length < self.length:
+			return self.module(F.pad(x, (0, self.length - length)))[..., :length]
+		return self.module(x)
+
+def export_model(model, path, length, max_batch=64):
+	"""
+	Export `model`, an `SCNet` in eval mode, with `torch.export` for chunks of `length` samples and
+	any batch size up to `max_batch`, and save the program and its weights to `path`.
+	"""
+	example = torch.zeros(2, model.audio_channels, length, device=next(model.parameters()).device)
+	batch = torch.export.Dim('batch', min=1, max=max_batch)
+	with torch.no_grad():
+		program = torch.export.export(model, (example,), dynamic_shapes=({0: batch},))
+	metadata = {'sources': list(model.sources), 'audio_channels': model.audio_channels,
+				'length': length, 'torch': torch.__version__}
+	torch.export.save(program, path, extra_files={metadata_name: json.dumps(metadata)})
+	return program
+
+def load_exported(path):
+	"""Load a program written by `export_model`, without the configuration or the checkpoint."""
+	extra_files = {metadata_name: ''}
+	program = torch.export.load(path, extra_files=extra_files)
+	return ExportedModel(program.module(), json.loads(extra_files[metadata_name]))
+
+# Each cold start runs in a new interpreter, prints the seconds until the model is ready and
+# until the first chunk is separated.
+_cold_start_current = """
+import time
+start = time.time()
+import torch
+from hhSCNet import loadModelConfigurationYaml
+from hhSCNet.SCNet import SCNet
+from hhSCNet.utils import load_model
+model = load_model(SCNet(**loadModelConfigurationYaml({configuration!r}).model), {checkpoint!r}).eval()
+ready = time.time() - start
+with torch.no_grad():
+	model(torch.zeros(1, model.audio_channels, {length}))
+print(ready, time.time() - start)
+"""
+
+_cold_start_exported = """
+import time
+start = time.time()
+import torch
+from hhSCNet.exported import load_exported
+model = load_exported({path!r})
+ready = time.time() - start
+with torch.no_grad():
+	model(torch.zeros(1, model.audio_channels, {length}))
+print(ready, time.time() - start)
+"""
+
+def _cold_start(script):
+	output = subprocess.run([sys.executable, '-c', script], check=True, capture_output=True, text=True).stdout
+	return [float(value) for value in output.split()[-2:]]
+
+def runExport(pathOutput: str,
+			modelConfiguration: str = "./conf/config.yaml",
+			checkpoint: str = "./result/checkpoint.th",
+			shifts: int = 1,
+			stems: str = '',
+			benchmark: bool = True) -> dict:
+	"""Export a trained model as a self-contained program for fast cold starts.
+
+	Parameters
+		pathOutput: File of the exported program, e.g. `scnet.pt2`
+		modelConfiguration: Path to model configuration YAML file
+		checkpoint: Path to model checkpoint file
+		shifts: Shifts that inference will use, which set the chunk length of the program
+		stems: Stems that inference will write, the sources that no stem needs are left out of the program, see `runInference`
+		benchmark: Compare the cold start of the program with building the model from the configuration and checkpoint
+	"""
+	from hhSCNet import loadModelConfigurationYaml
+
+	from .inference import Separator
+	from .SCNet import SCNet
+
+	config = loadModelConfigurationYaml(modelConfiguration)
+	model = SCNet(**config.model)
+	model.eval()
+	separator = Separator(model, checkpoint, shifts=shifts, stems=stems)
+	length = separator.chunk_length()
+	start = time.time()
+	export_model(separator.separator.cpu(), pathOutput, length)
+	print(f"Exported {separator.separator.sources} for chunks of {length} samples to {pathOutput} "
+		  f"in {time.time() - start:.1f}s")
+
+	report = {}
+	if benchmark:
+		current = _cold_start(_cold_start_current.format(configuration=os.path.abspath(modelConfiguration),
+														 checkpoint=os.path.abspath(checkpoint), length=length))
+		exported = _cold_start(_cold_start_exported.format(path=os.path.abspath(pathOutput), length=length))
+		report = {'ready current': current[0], 'first chunk current': current[1],
+				  'ready exported': exported[0], 'first chunk exported': exported[1]}
+		print(f"Cold start, model ready: current {current[0]:.2f}s, exported {exported[0]:.2f}s")
+		print(f"Cold start, first chunk separated: current {current[1]:.2f}s, exported {exported[1]:.2f}s")
+	return report
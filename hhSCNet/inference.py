@@ -1,31 +1,231 @@
 import os
+import queue
+import threading
 import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import soundfile as sf
 import torch
+import torch.multiprocessing as mp
 
 from hhSCNet import loadModelConfigurationYaml
 
-from .apply import apply_model
+from .apply import ChunkScheduler, apply_model
+from .compiled import CompiledModel
+from .exported import ExportedModel, load_exported
+from .quantize import quantize_model
 from .SCNet import SCNet
-from .utils import convert_audio, load_model
+from .utils import (convert_audio, convert_audio_blockwise, fold_fusion_layers, load_model, memmap_zeros, select_sources,
+					set_precision)
+from .workspace import Workspace, use_workspace
 
 
-class Separator:
-	def __init__(self, model, checkpoint_path):
-		self.separator = load_model(model, checkpoint_path)
+def parse_stems(stems, sources):
+	"""
+	Parse a `stems` option into `{stem: [sources summed into it]}`.
+
+	`stems` is a comma separated list of source names and derived mixes written as
+	`name=source+source`, e.g. `vocals,karaoke=drums+bass+other`. `instrumental` is predefined
+	as the sum of every source but `vocals`. An empty `stems` selects every source.
+	"""
+	if not stems:
+		return {source: [source] for source in sources}
+	parsed = {}
+	for entry in stems.split(','):
+		name, _, mix = (part.strip() for part in entry.partition('='))
+		if mix:
+			parts = [part.strip() for part in mix.split('+')]
+		elif name == 'instrumental' and 'instrumental' not in sources:
+			parts = [source for source in sources if source != 'vocals']
+		else:
+			parts = [name]
+		unknown = [part for part in parts if part not in sources]
+		if not name or unknown:
+			raise ValueError(f"Invalid stem {entry!r}, the sources are {sources}")
+		if name in parsed:
+			raise ValueError(f"Stem {name!r} is given twice in {stems!r}")
+		parsed[name] = parts
+	return parsed
+
+# Encodings of the written stems: extension, format and subtype of the files.
+encodings = {
+	'wav': ('.wav', 'WAV', 'PCM_16'),
+	'wav24': ('.wav', 'WAV', 'PCM_24'),
+	'float': ('.wav', 'WAV', 'FLOAT'),
+	'flac': ('.flac', 'FLAC', 'PCM_16'),
+	'flac24': ('.flac', 'FLAC', 'PCM_24'),
+}
+flac_channels = 8
+
+def save_stems(stems, sample_rates, save_dir, encoding='wav', multistem=False, block=2**20):
+	"""
+	Write the `[length]` or `[length, channels]` arrays of `stems` to `save_dir`, one file per
+	stem named after it or, if `multistem`, a single `stems` file with the channels of every stem,
+	one stem after another in the order of `stems`.
+
+	Each file is written under a temporary name and renamed once complete, so that a file with
+	its final name is always whole. Samples are clipped to [-1, 1] for the PCM encodings.
+	"""
+	extension, container, subtype = encodings[encoding]
+	os.makedirs(save_dir, exist_ok=True)
+	arrays = {name: stem.reshape(len(stem), -1) for name, stem in stems.items()}
+	if multistem:
+		files = {'stems': (list(arrays.values()), sample_rates[next(iter(stems))])}
+	else:
+		files = {name: ([array], sample_rates[name]) for name, array in arrays.items()}
+	for name, (parts, sample_rate) in files.items():
+		save_path = os.path.join(save_dir, f'{name}{extension}')
+		channels = sum(part.shape[1] for part in parts)
+		if container == 'FLAC' and channels > flac_channels:
+			raise ValueError(f"FLAC holds at most {flac_channels} channels, {name} has {channels}")
+		temporary = os.path.join(save_dir, f'{name}.tmp{extension}')
+		with sf.SoundFile(temporary, 'w', sample_rate, channels, subtype, format=container) as file:
+			# Written one block at a time, so memory-mapped stems are never copied whole.
+			for start in range(0, len(parts[0]), block):
+				data = np.concatenate([part[start:start + block] for part in parts], axis=1)
+				if subtype != 'FLOAT':
+					# Out of range samples would wrap around once converted to integers.
+					np.clip(data, -1, 1, out=data)
+				file.write(data)
+		os.replace(temporary, save_path)
+		print(f"Saved {name} to {save_path}")
+
+class BackgroundWriter:
+	"""
+	Run write jobs in a pool of `workers` threads, with at most `depth` jobs queued or running.
+	`submit` blocks while the queue is full and returns how long it waited.
+	"""
+	def __init__(self, workers=2, depth=4):
+		self.pool = ThreadPoolExecutor(max(1, workers))
+		self.slots = threading.Semaphore(max(1, depth))
+		self.futures = []
+		self.busy = 0.
+		self.lock = threading.Lock()
+
+	def submit(self, function, *args):
+		start = time.time()
+		self.slots.acquire()
+		waited = time.time() - start
+		for future in [future for future in self.futures if future.done()]:
+			self.futures.remove(future)
+			future.result()
+		self.futures.append(self.pool.submit(self._run, function, *args))
+		return waited
+
+	def _run(self, function, *args):
+		start = time.time()
+		try:
+			function(*args)
+		finally:
+			with self.lock:
+				self.busy += time.time() - start
+			self.slots.release()
+
+	def close(self):
+		try:
+			for future in self.futures:
+				future.result()
+		finally:
+			self.pool.shutdown()
 
-		if torch.cuda.device_count():
+class Separator:
+	def __init__(self, model, checkpoint_path, batch_size=1, prefetch=2, writers=2, write_queue=4,
+				memmap_dir=None, shifts=1, deterministic_shifts=False, stems=None, precision='float32',
+				compiled=False, compile_cache=None, quantize='', calibration=None, calibration_tracks=8,
+				workspace=False, encoding='wav', multistem=False):
+		if encoding not in encodings:
+			raise ValueError(f"Unknown encoding {encoding!r}, expected one of {list(encodings)}")
+		exported = isinstance(model, ExportedModel)
+		if exported and (quantize or precision != 'float32'):
+			raise ValueError("An exported program runs in the precision it was exported in")
+		if workspace and (exported or compiled):
+			raise ValueError("The workspace is for eager inference, compiled and exported models plan their own buffers")
+		# An exported program already has its weights, sources and precision.
+		self.separator = model if exported else load_model(model, checkpoint_path)
+		self.stems = parse_stems(stems, self.separator.sources)
+		# Checked before any track is separated, the writers would only fail once it is.
+		channels = len(self.stems) * self.separator.audio_channels
+		if multistem and encodings[encoding][1] == 'FLAC' and channels > flac_channels:
+			raise ValueError(f"FLAC holds at most {flac_channels} channels, a multistem file of "
+							 f"{len(self.stems)} stems has {channels}, use a WAV encoding or fewer stems")
+		# Drop the output channels of the sources that no stem needs.
+		needed = [source for source in self.separator.sources
+				  if any(source in parts for parts in self.stems.values())]
+		if needed != self.separator.sources and not exported:
+			select_sources(self.separator, needed)
+		if not exported:
+			fold_fusion_layers(self.separator)
+			set_precision(self.separator, precision)
+		self.batch_size = batch_size
+		self.shifts = shifts
+		self.deterministic_shifts = deterministic_shifts
+		self.prefetch = prefetch
+		self.writers = writers
+		self.write_queue = write_queue
+		self.encoding = encoding
+		self.multistem = multistem
+		# Decode, overlap-add, convert and write through memory-mapped files in this directory.
+		self.memmap_dir = memmap_dir or None
+
+		# Quantized models run on the CPU. The device is set first, calibration loads the mixes on it.
+		if torch.cuda.device_count() and not quantize:
 			self.device = torch.device('cuda')
 		else:
 			print("WARNING, using CPU")
 			self.device = torch.device('cpu')
+		if quantize:
+			self.quantize(quantize, calibration, calibration_tracks)
 		self.separator.to(self.device)
+		if workspace:
+			use_workspace(self.separator, Workspace())
+		# Compiled on first use, for the batches of the path that separates, see `use_compiled`.
+		self.compiled = compiled
+		self.compile_cache = compile_cache
+
+	def quantize(self, mode, calibration=None, tracks=8, segment=20):
+		"""
+		Quantize the model to int8 for CPU inference, `mode` is `dynamic` for the LSTMs and linear
+		layers or `static` to also quantize the convolutions, calibrated on one `segment` from the
+		middle of at most `tracks` tracks of the `calibration` directory.
+		"""
+		if mode not in ('dynamic', 'static'):
+			raise ValueError(f"Unknown quantization {mode!r}, expected 'dynamic' or 'static'")
+		mixes = []
+		if mode == 'static':
+			if not calibration:
+				raise ValueError("Static quantization needs a calibration directory")
+			length = int(44100 * segment)
+			for mixture_path, _ in self.list_tracks(calibration)[:tracks]:
+				mix, _ = self.load_mix(mixture_path)
+				start = max(0, (mix.shape[-1] - length) // 2)
+				mixes.append(torch.as_tensor(mix[None, :, start:start + length]).float())
+		start = time.time()
+		_, chunks = quantize_model(self.separator, static=mode == 'static', calibration=mixes)
+		print(f"Quantized the model ({mode}) with {chunks} calibration chunks in {time.time() - start:.1f}s")
+
+	def chunk_length(self, segment=20, samplerate=44100):
+		"""Length of the full chunks that `separate_mix` and `process_directory` give to the model."""
+		length = int(samplerate * segment)
+		if self.shifts:
+			# Shifted chunks are half a second longer, see `apply_model`.
+			length += int(0.5 * samplerate)
+		return length
+
+	def compile(self, batch, cache_dir=None):
+		"""Wrap the model in a `CompiledModel` for full chunks stacked in batches of `batch`."""
+		model = self.separator.model if isinstance(self.separator, CompiledModel) else self.separator
+		return CompiledModel(model, (batch, model.audio_channels, self.chunk_length()), cache_dir or None)
+
+	def use_compiled(self, batch):
+		"""If compiling was asked for, compile the model for batches of `batch` unless it already is."""
+		if self.compiled and not (isinstance(self.separator, CompiledModel) and self.separator.shape[0] == batch):
+			self.separator = self.compile(batch, self.compile_cache)
 
 	@property
 	def instruments(self):
-		return ['bass', 'drums', 'other', 'vocals']
+		return list(self.stems)
 
 	def raise_aicrowd_error(self, msg):
 		raise NameError(msg)
@@ -40,6 +240,21 @@ class Separator:
 			separated_music_arrays: Dictionary numpy array of each separated instrument
 			output_sample_rates: Dictionary of sample rates separated sequence
 		"""
+		mix, context = self.prepare_mix(mixed_sound_array, sample_rate)
+		return self.finish_estimates(self.separate_mix(mix), context)
+
+	def separate_mix(self, mix):
+		# `apply_model` stacks the shifts of a chunk, unless its `ChunkScheduler` stacks chunks in batches of `batch_size`.
+		scheduled = self.batch_size > 1 or self.memmap_dir is not None
+		self.use_compiled(self.batch_size if scheduled else max(1, self.shifts))
+		with torch.no_grad():
+			return apply_model(self.separator, mix[None], overlap=0.5, progress=False,
+							   batch_size=self.batch_size, memmap_dir=self.memmap_dir,
+							   shifts=self.shifts, deterministic_shifts=self.deterministic_shifts,
+							   device=self.device)[0]
+
+	def prepare_mix(self, mixed_sound_array, sample_rate):
+		"""Convert and normalize a decoded mixture. Returns the model input and what `finish_estimates` needs."""
 		# Convert audio to tensor and handle shape properly
 		mix = torch.from_numpy(np.asarray(mixed_sound_array.T, np.float32))
 
@@ -61,28 +276,102 @@ class Separator:
 		mean = mono.mean()
 		std = mono.std()
 		mix = (mix - mean) / std
-		# Separate
-		with torch.no_grad():
-			estimates = apply_model(self.separator, mix[None], overlap=0.5, progress=False)[0]
+		context = {'sample_rate': sample_rate, 'original_channels': original_channels,
+				   'mean': mean, 'std': std, 'start': b, 'duration': mono.shape[-1] / sample_rate,
+				   'mix_std': mix.std()}
+		return mix, context
+
+	def load_mix(self, mixture_path):
+		"""Decode a mixture file and return the same as `prepare_mix`."""
+		if self.memmap_dir is None:
+			mixed_sound_array, sample_rate = self.load_audio(mixture_path)
+			return self.prepare_mix(mixed_sound_array, sample_rate)
+		return self.load_mix_out_of_core(mixture_path)
 
-		# Printing some sanity checks.
-		print(time.time() - b, mono.shape[-1] / sample_rate, mix.std(), estimates.std())
+	def load_mix_out_of_core(self, mixture_path, block=2**20):
+		"""
+		Same as `load_audio` followed by `prepare_mix`, but the file is decoded, converted and
+		normalized one block at a time into a memory-mapped file.
+		"""
+		with sf.SoundFile(mixture_path) as file:
+			sample_rate = file.samplerate
+			original_channels = file.channels
+			length = file.frames
+			print(f"Input audio shape before processing: {[original_channels, length]}")
+			print(f"Original audio has {original_channels} channel(s)")
 
-		estimates = estimates * std + mean
+			def read(start, end):
+				file.seek(start)
+				return torch.from_numpy(file.read(end - start, dtype='float32', always_2d=True).T)
+
+			mix = memmap_zeros((self.separator.audio_channels, int(44100 * length / sample_rate)), self.memmap_dir)
+			convert_audio_blockwise(read, length, sample_rate, 44100, self.separator.audio_channels, mix, block)
+
+		b = time.time()
+		total = 0.
+		total_square = 0.
+		for start in range(0, mix.shape[-1], block):
+			mono = mix[:, start:start + block].mean(0).double()
+			total += mono.sum().item()
+			total_square += mono.square().sum().item()
+		count = mix.shape[-1]
+		mean = total / count
+		std = ((total_square - count * mean ** 2) / (count - 1)) ** 0.5
+		for start in range(0, count, block):
+			mix[:, start:start + block].sub_(mean).div_(std)
+		context = {'sample_rate': sample_rate, 'original_channels': original_channels,
+				   'mean': mean, 'std': std, 'start': b, 'duration': count / sample_rate,
+				   'mix_std': mix.std()}
+		return mix, context
+
+	def finish_estimates(self, estimates, context):
+		"""Denormalize the model output of `prepare_mix` and convert it back to the input format."""
+		sample_rate = context['sample_rate']
+		# Printing some sanity checks.
+		print(time.time() - context['start'], context['duration'], context['mix_std'], estimates.std())
 
 		print(f"Model output shape before conversion: {estimates.shape}")
-		# Convert back to original sample rate and channel count
-		estimates = convert_audio(estimates, 44100, sample_rate, original_channels)
+		estimates = self.mix_stems(estimates)
+		# A stem summing `count` normalized sources gets the mean `count` times.
+		counts = [len(parts) for parts in self.stems.values()]
+		if self.memmap_dir is None:
+			counts = torch.tensor(counts, dtype=estimates.dtype, device=estimates.device)[:, None, None]
+			estimates = estimates * context['std'] + context['mean'] * counts
+			# Convert back to original sample rate and channel count
+			estimates = convert_audio(estimates, 44100, sample_rate, context['original_channels'])
+		else:
+			# The memory-mapped output of the scheduler is ours to change in place.
+			for stem, count in zip(estimates, counts):
+				stem.mul_(context['std']).add_(context['mean'] * count)
+			if sample_rate != 44100 or estimates.shape[-2] != context['original_channels']:
+				length = estimates.shape[-1]
+				converted = memmap_zeros((estimates.shape[0], context['original_channels'],
+										  int(sample_rate * length / 44100)), self.memmap_dir)
+				estimates = convert_audio_blockwise(lambda start, end: estimates[..., start:end], length,
+													44100, sample_rate, context['original_channels'], converted)
 
 		separated_music_arrays = {}
 		output_sample_rates = {}
-		for instrument in self.instruments:
-			idx = self.separator.sources.index(instrument)
+		for idx, instrument in enumerate(self.instruments):
 			separated_music_arrays[instrument] = torch.squeeze(estimates[idx]).detach().cpu().numpy().T
 			output_sample_rates[instrument] = sample_rate
 
 		return separated_music_arrays, output_sample_rates
 
+	def mix_stems(self, estimates):
+		"""Sum the normalized source estimates into the requested stems, in `self.instruments` order."""
+		sources = self.separator.sources
+		if list(self.stems.values()) == [[source] for source in sources]:
+			return estimates
+		if self.memmap_dir is None:
+			mixed = estimates.new_zeros((len(self.stems),) + estimates.shape[1:])
+		else:
+			mixed = memmap_zeros((len(self.stems),) + tuple(estimates.shape[1:]), self.memmap_dir)
+		for stem, parts in zip(mixed, self.stems.values()):
+			for part in parts:
+				stem += estimates[sources.index(part)]
+		return mixed
+
 	def load_audio(self, file_path):
 		try:
 			data, sample_rate = sf.read(file_path, dtype='float32')
@@ -91,38 +380,181 @@ class Separator:
 			print(f"Error loading audio file {file_path}: {e}")
 			raise
 
-	def save_sources(self, sources, output_sample_rates, save_dir):
-		os.makedirs(save_dir, exist_ok=True)
-		for name, src in sources.items():
-			save_path = os.path.join(save_dir, f'{name}.wav')
-			sf.write(save_path, src, output_sample_rates[name])
-			print(f"Saved {name} to {save_path}")
+	def save_sources(self, sources, output_sample_rates, save_dir, block=2**20):
+		save_stems(sources, output_sample_rates, save_dir, self.encoding, self.multistem, block)
 
-	def process_directory(self, input_dir, output_dir):
+	def list_tracks(self, input_dir):
+		"""List `(mixture_path, entry_name)` for every track folder or WAV file in `input_dir`."""
+		tracks = []
 		for entry in os.listdir(input_dir):
 			entry_path = os.path.join(input_dir, entry)
 			if os.path.isdir(entry_path):
 				mixture_path = os.path.join(entry_path, 'mixture.wav')
 				if os.path.isfile(mixture_path):
-					print(f"Processing {mixture_path}")
 					entry_name = os.path.basename(entry)
 				else:
 					continue
 			elif os.path.isfile(entry_path) and entry_path.lower().endswith('.wav'):
-				print(f"Processing {entry_path}")
 				mixture_path = entry_path
 				entry_name = os.path.splitext(os.path.basename(entry))[0]
 			else:
 				continue
+			tracks.append((mixture_path, entry_name))
+		return tracks
+
+	def process_track(self, mixture_path, save_dir):
+		mix, context = self.load_mix(mixture_path)
+		separated_music_arrays, output_sample_rates = self.finish_estimates(self.separate_mix(mix), context)
+		self.save_sources(separated_music_arrays, output_sample_rates, save_dir)
+
+	def process_directory(self, input_dir, output_dir, workers=0):
+		if workers > 1:
+			return self.process_directory_parallel(input_dir, output_dir, workers)
+		# Three stages: a thread decodes and resamples the next tracks, this thread runs the model,
+		# and a pool of threads converts and writes the stems. Chunks of consecutive tracks share
+		# batches, so the tail of one track fills the batch of the next.
+		waits = defaultdict(float)
+		decoded = queue.Queue(maxsize=max(1, self.prefetch))
+		decoder = threading.Thread(target=self._decode_tracks, args=(self.list_tracks(input_dir), output_dir, decoded, waits), daemon=True)
+		decoder.start()
+		writer = BackgroundWriter(self.writers, self.write_queue)
+		# The scheduler stacks chunks, shifted or not, in batches of `batch_size`.
+		self.use_compiled(self.batch_size)
+		scheduler = ChunkScheduler(self.separator, batch_size=self.batch_size, overlap=0.5,
+								   memmap_dir=self.memmap_dir, shifts=self.shifts,
+								   deterministic_shifts=self.deterministic_shifts, device=self.device)
+		try:
+			while True:
+				start = time.time()
+				item = decoded.get()
+				waits['model waiting for decode'] += time.time() - start
+				if item is None:
+					break
+				if isinstance(item, BaseException):
+					raise item
+				mix, context = item
+				print(f"Processing {context['mixture_path']}")
+				start = time.time()
+				finished = scheduler.submit(mix[None], key=context)
+				waits['model busy'] += time.time() - start
+				for context, estimates in finished:
+					waits['model waiting for writers'] += writer.submit(self._write_estimates, estimates[0], context)
+			start = time.time()
+			finished = scheduler.flush()
+			waits['model busy'] += time.time() - start
+			for context, estimates in finished:
+				waits['model waiting for writers'] += writer.submit(self._write_estimates, estimates[0], context)
+		finally:
+			writer.close()
+		waits['write busy'] = writer.busy
+		print("Pipeline times: " + ", ".join(f"{stage} {seconds:.2f} s" for stage, seconds in waits.items()))
+		return dict(waits)
+
+	def _decode_tracks(self, tracks, output_dir, decoded, waits):
+		for mixture_path, entry_name in tracks:
+			start = time.time()
+			try:
+				mix, context = self.load_mix(mixture_path)
+			except Exception as error:
+				decoded.put(error)
+				return
+			context['mixture_path'] = mixture_path
+			context['save_dir'] = os.path.join(output_dir, entry_name)
+			waits['decode busy'] += time.time() - start
+			start = time.time()
+			decoded.put((mix, context))
+			waits['decode waiting for model'] += time.time() - start
+		decoded.put(None)
+
+	def _write_estimates(self, estimates, context):
+		separated_music_arrays, output_sample_rates = self.finish_estimates(estimates, context)
+		self.save_sources(separated_music_arrays, output_sample_rates, context['save_dir'])
+
+	def process_directory_parallel(self, input_dir, output_dir, workers):
+		"""
+		Separate the tracks of `input_dir` in `workers` processes.
 
-			mixed_sound_array, sample_rate = self.load_audio(mixture_path)
-			separated_music_arrays, output_sample_rates = self.separate_music_file(mixed_sound_array, sample_rate)
-			save_dir = os.path.join(output_dir, entry_name)
-			self.save_sources(separated_music_arrays, output_sample_rates, save_dir)
+		The weights are moved to shared memory once and every worker maps the same copy. The
+		CPUs are split evenly: each worker is pinned to its own CPUs and uses as many torch
+		threads. Workers take the next track from a queue as soon as they are done with one.
+		"""
+		tracks = self.list_tracks(input_dir)
+		self.separator.share_memory()
+		cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+		threads = max(1, len(cpus) // workers)
+
+		context = mp.get_context('spawn')
+		tasks = context.Queue()
+		results = context.Queue()
+		for mixture_path, entry_name in tracks:
+			tasks.put((mixture_path, os.path.join(output_dir, entry_name)))
+		processes = []
+		for index in range(workers):
+			tasks.put(None)
+			pinned = cpus[index * threads:(index + 1) * threads] if threads * workers <= len(cpus) else []
+			process = context.Process(target=_separation_worker, args=(self, threads, pinned, tasks, results))
+			process.start()
+			processes.append(process)
+
+		failures = 0
+		pending = {mixture_path for mixture_path, _ in tracks}
+		while pending:
+			# Checked before waiting: once every worker is gone, their results are all in the queue.
+			stopped = not any(process.is_alive() for process in processes)
+			try:
+				mixture_path, error = results.get(timeout=1)
+			except queue.Empty:
+				if stopped:
+					break
+				continue
+			pending.discard(mixture_path)
+			if error is None:
+				print(f"Finished {mixture_path}")
+			else:
+				failures += 1
+				print(f"Error separating {mixture_path}: {error}")
+		for process in processes:
+			process.join()
+		# A worker killed by the system, e.g. when out of memory, never reports its track.
+		exitcodes = [process.exitcode for process in processes if process.exitcode]
+		for mixture_path in sorted(pending):
+			failures += 1
+			print(f"Error separating {mixture_path}: no result, workers exited with codes {exitcodes}")
+		if failures:
+			raise RuntimeError(f"{failures} of {len(tracks)} tracks could not be separated")
+
+def _separation_worker(separator, threads, cpus, tasks, results):
+	torch.set_num_threads(threads)
+	if cpus and hasattr(os, 'sched_setaffinity'):
+		os.sched_setaffinity(0, cpus)
+	for mixture_path, save_dir in iter(tasks.get, None):
+		try:
+			separator.process_track(mixture_path, save_dir)
+			results.put((mixture_path, None))
+		except Exception as error:
+			results.put((mixture_path, repr(error)))
 
 def runInference(pathInput: str, pathOutput: str,
 				modelConfiguration: str = "./conf/config.yaml",
-				checkpoint: str = "./result/checkpoint.th") -> None:
+				checkpoint: str = "./result/checkpoint.th",
+				batch_size: int = 1,
+				workers: int = 0,
+				prefetch: int = 2,
+				writers: int = 2,
+				write_queue: int = 4,
+				memmap_dir: str = '',
+				shifts: int = 1,
+				deterministic_shifts: bool = False,
+				stems: str = '',
+				precision: str = 'float32',
+				compiled: bool = False,
+				compile_cache: str = '',
+				quantize: str = '',
+				calibration: str = '',
+				exported: str = '',
+				workspace: bool = False,
+				encoding: str = 'wav',
+				multistem: bool = False) -> None:
 	"""Run inference on audio files.
 
 	Parameters
@@ -130,16 +562,41 @@ def runInference(pathInput: str, pathOutput: str,
 		pathOutput: Output directory to save separated sources
 		modelConfiguration: Path to model configuration YAML file
 		checkpoint: Path to model checkpoint file
+		batch_size: Number of chunks, from one or several tracks, in each call of the model
+		workers: Number of processes separating whole tracks in parallel, sharing one copy of the weights
+		prefetch: Number of decoded tracks queued ahead of the model
+		writers: Number of threads writing stems in the background
+		write_queue: Number of tracks queued or being written before the model waits
+		memmap_dir: Directory for memory-mapped decode and overlap-add buffers, so memory use does not grow with track length
+		shifts: Number of time-shifted copies of each chunk averaged together, run as one batch
+		deterministic_shifts: Use evenly spaced instead of random shift offsets, for reproducible output
+		stems: Comma separated stems to write, as source names or mixes like `karaoke=drums+bass+other`; `instrumental` is every source but vocals. Empty writes every source
+		precision: Dtype of the convolutions and LSTMs, `float32`, `bfloat16` or `float16`; the STFT and FFTs stay in float32. Check the loss of quality with the `parity` command
+		compiled: Compile the model with torch.compile for the shape of full chunks and warm it up before separating
+		compile_cache: Directory where compiled artifacts are saved, so later runs skip most of the compilation
+		quantize: Quantize the model to int8 for CPU inference, `dynamic` for the LSTMs and linear layers, `static` to also quantize the convolutions
+		calibration: Directory of tracks used to calibrate `static` quantization, pathInput if empty
+		exported: Program written by the `export` command, used instead of modelConfiguration and checkpoint
+		workspace: Reuse the intermediate buffers of the model from chunk to chunk instead of allocating them in every call
+		encoding: Encoding of the written stems, `wav` (16-bit PCM), `wav24`, `float` (32-bit float WAV), `flac` or `flac24`
+		multistem: Write a single `stems` file per track holding the channels of every stem, in the order of the stems
 	"""
-	config = loadModelConfigurationYaml(modelConfiguration)
-
 	if not os.path.exists(pathOutput):
 		os.mkdir(pathOutput)
 
-	model = SCNet(**config.model)
-	model.eval()
-	separator = Separator(model, checkpoint)
-	separator.process_directory(pathInput, pathOutput)
+	if exported:
+		model = load_exported(exported)
+	else:
+		config = loadModelConfigurationYaml(modelConfiguration)
+		model = SCNet(**config.model)
+		model.eval()
+	separator = Separator(model, checkpoint, batch_size=batch_size,
+						prefetch=prefetch, writers=writers, write_queue=write_queue,
+						memmap_dir=memmap_dir, shifts=shifts, deterministic_shifts=deterministic_shifts,
+						stems=stems, precision=precision, compiled=compiled, compile_cache=compile_cache,
+						quantize=quantize, calibration=calibration or pathInput, workspace=workspace,
+						encoding=encoding, multistem=multistem)
+	separator.process_directory(pathInput, pathOutput, workers=workers)
 
 # Some or all of the work in this file may be restricted by the following copyright.
 """
@@ -0,0 +1,131 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import torch as th
+from tqdm.auto import tqdm
+
+from hhSCNet import loadModelConfigurationYaml
+
+from .wav import MIXTURE, Wavset, get_wav_datasets
+
+dtypes = ('int16', 'float16')
+
+def pack_dataset(dataset, directory, dtype='float16'):
+	"""
+	Write the tracks of the `Wavset` `dataset` to `directory` for `PackedSet`: one `{track}.npy`
+	array of shape `[stems, channels, frames]` per track and a `metadata.json`. The stems are the
+	mixture and the sources, as `dataset` returns them: resampled, with its channels and
+	normalized if it normalizes, so that an example only has to be dequantized.
+
+	`float16` keeps the samples, with about 11 bits of precision. `int16` scales the samples of each
+	track so that its peak is 32767, a finer precision than `float16` for all but its quietest
+	parts, but the examples then take a multiplication, twice as long as a conversion.
+	"""
+	if dtype not in dtypes:
+		raise ValueError(f"Unknown dtype {dtype!r}, expected one of {list(dtypes)}")
+	directory = Path(directory)
+	stems = [MIXTURE] + [source for source in dataset.sources if source != MIXTURE]
+	tracks = {}
+	for name, meta in tqdm(dataset.metadata.items(), ncols=120):
+		track = Wavset(dataset.root, {name: meta}, stems, samplerate=dataset.samplerate, channels=dataset.channels,
+					   normalize=dataset.normalize)[0]
+		scale = 1.
+		if dtype == 'int16':
+			scale = max(track.abs().max().item(), 1e-8) / 32767
+			array = (track / scale).round().to(th.int16)
+		else:
+			array = track.to(th.float16)
+		path = directory / f'{name}.npy'
+		path.parent.mkdir(parents=True, exist_ok=True)
+		temporary = path.with_suffix('.tmp.npy')
+		np.save(temporary, array.numpy())
+		temporary.replace(path)
+		tracks[name] = {'length': track.shape[-1], 'samplerate': dataset.samplerate, 'mean': meta['mean'],
+						'std': meta['std'], 'scale': scale}
+	(directory / 'metadata.json').write_text(json.dumps({
+		'stems': stems, 'samplerate': dataset.samplerate, 'channels': dataset.channels, 'normalize': dataset.normalize,
+		'dtype': dtype, 'tracks': tracks}))
+
+class PackedSet(Wavset):
+	"""
+	The examples of the `Wavset` packed into `root` by `pack_dataset`. An example is a slice of
+	the memory-mapped array of its track, dequantized by one multiplication into the float32
+	example, with no decoding, resampling, channel conversion or normalization.
+
+	Args:
+		root (Path or str): directory written by `pack_dataset`.
+		sources (list[str]): stems of each example, sources or `mixture`.
+		segment, shift: see `Wavset`, the normalization is the one of the packed `Wavset`.
+	"""
+	def __init__(self, root, sources, segment=None, shift=None):
+		packed = json.loads((Path(root) / 'metadata.json').read_text())
+		missing = [source for source in sources if source not in packed['stems']]
+		if missing:
+			raise ValueError(f"The dataset in {root} has no {missing}, only {packed['stems']}")
+		self.stems = [packed['stems'].index(source) for source in sources]
+		super().__init__(root, packed['tracks'], sources, segment=segment, shift=shift, normalize=packed['normalize'],
+						 samplerate=packed['samplerate'], channels=packed['channels'], ext='.npy')
+		self._arrays = {}
+
+	def __getstate__(self):
+		state = super().__getstate__()
+		state['_arrays'] = {}
+		return state
+
+	def _array(self, name):
+		# The memory-mapped array of the track `name`, mapped once per process.
+		if self._pid != os.getpid():
+			self._arrays = {}
+			self._pid = os.getpid()
+		if name not in self._arrays:
+			# Copy-on-write, to be viewed by tensors, which cannot be read-only. Nothing writes to it.
+			self._arrays[name] = np.load(self.root / f'{name}{self.ext}', mmap_mode='c')
+		return self._arrays[name]
+
+	def __getitem__(self, index):
+		name, index = self._locate(index)
+		meta = self.metadata[name]
+		array = self._array(name)
+		offset = 0
+		length = meta['length']
+		if self.segment:
+			offset = int(self.samplerate * self.shift * index)
+			length = int(self.segment * self.samplerate)
+		frames = min(length, meta['length'] - offset)
+		example = th.empty(len(self.stems), self.channels, length)
+		for position, stem in enumerate(self.stems):
+			extract = array[stem, :, offset:offset + frames]
+			if meta['scale'] == 1:
+				example[position, :, :frames].copy_(th.from_numpy(extract))
+			else:
+				np.multiply(extract, np.float32(meta['scale']), out=example[position, :, :frames].numpy())
+		example[..., frames:] = 0
+		return example
+
+def get_packed_datasets(args):
+	"""`get_wav_datasets` for the training and validation sets packed in `args.packed` by `runPack`."""
+	datasets = []
+	for split, sources, segment in [('train', args.sources, args.segment), ('valid', [MIXTURE] + list(args.sources), None)]:
+		dataset = PackedSet(Path(args.packed) / split, sources, segment=segment, shift=args.shift)
+		packed = (dataset.samplerate, dataset.channels, dataset.normalize)
+		if packed != (args.samplerate, args.channels, args.normalize):
+			raise ValueError(f"{args.packed} was packed with (samplerate, channels, normalize) {packed}, "
+							 f"the configuration asks for {(args.samplerate, args.channels, args.normalize)}")
+		datasets.append(dataset)
+	return datasets
+
+def runPack(pathOutput: str, modelConfiguration: str = "./conf/config.yaml", dtype: str = 'float16') -> None:
+	"""Pack the WAV training and validation sets of a configuration into memory-mapped arrays, for `data.packed`.
+
+	Parameters
+		pathOutput: Directory of the packed dataset, then set as `packed` in the `data` section of the configuration
+		modelConfiguration: Path to the YAML configuration file whose `data` section lists the dataset
+		dtype: Storage of the samples, `int16` or `float16`
+	"""
+	config = loadModelConfigurationYaml(modelConfiguration)
+	train_set, valid_set = get_wav_datasets(config.data)
+	for split, dataset in [('train', train_set), ('valid', valid_set)]:
+		pack_dataset(dataset, Path(pathOutput) / split, dtype)
+		print(f"Packed {len(dataset.metadata)} {split} tracks into {Path(pathOutput) / split}")
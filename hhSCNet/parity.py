@@ -0,0 +1,87 @@
+import io
+import os
+import time
+
+import numpy as np
+import torch
+
+from hhSCNet import loadModelConfigurationYaml
+
+from .inference import Separator
+from .SCNet import SCNet
+from .utils import new_sdr, set_precision
+
+
+def sdr(reference, estimate):
+	"""`new_sdr` in dB of `estimate` against `reference`, both `[samples, channels]` arrays."""
+	reference, estimate = (torch.as_tensor(np.asarray(array), dtype=torch.float64)[None, None] for array in (reference, estimate))
+	return new_sdr(reference, estimate).item()
+
+def model_size(model):
+	"""Size in MB of the serialized weights of `model`."""
+	buffer = io.BytesIO()
+	torch.save(model.state_dict(), buffer)
+	return buffer.getbuffer().nbytes / 2**20
+
+def runParity(pathTrack: str,
+			modelConfiguration: str = "./conf/config.yaml",
+			checkpoint: str = "./result/checkpoint.th",
+			precision: str = 'bfloat16',
+			batch_size: int = 1,
+			quantize: str = '',
+			calibration: str = '') -> dict:
+	"""Compare the separation of one track in a reduced precision or int8 with float32.
+
+	Parameters
+		pathTrack: A WAV file, or a track folder with `mixture.wav` and optionally one WAV file per source
+		modelConfiguration: Path to model configuration YAML file
+		checkpoint: Path to model checkpoint file
+		precision: Precision to compare with float32, `bfloat16` or `float16`
+		batch_size: Number of chunks in each call of the model
+		quantize: Compare the int8 model instead of `precision`, `dynamic` or `static`, see `runInference`
+		calibration: Directory of tracks used to calibrate `static` quantization, the folder of pathTrack if empty
+	"""
+	config = loadModelConfigurationYaml(modelConfiguration)
+	# Both passes separate the same decoded mixture with the same shifts.
+	separator = Separator(SCNet(**config.model).eval(), checkpoint, batch_size=batch_size, shifts=0)
+	mixture_path = os.path.join(pathTrack, 'mixture.wav') if os.path.isdir(pathTrack) else pathTrack
+	mix, context = separator.load_mix(mixture_path)
+
+	variant = f'int8 {quantize}' if quantize else precision
+	separators = {'float32': separator, variant: separator}
+	if quantize:
+		# The int8 model runs on the CPU, so it gets a Separator of its own.
+		separators[variant] = Separator(SCNet(**config.model).eval(), checkpoint, batch_size=batch_size, shifts=0,
+										quantize=quantize, calibration=calibration or os.path.dirname(os.path.abspath(pathTrack)))
+	estimates = {}
+	durations = {}
+	sizes = {}
+	for name in ['float32', variant]:
+		separator = separators[name]
+		if not quantize:
+			set_precision(separator.separator, name)
+		sizes[name] = model_size(separator.separator)
+		start = time.time()
+		separated = separator.separate_mix(mix)
+		durations[name] = time.time() - start
+		estimates[name], _ = separator.finish_estimates(separated, context)
+
+	report = {'seconds float32': durations['float32'], f'seconds {variant}': durations[variant],
+			  'MB float32': sizes['float32'], f'MB {variant}': sizes[variant]}
+	print(f"{'stem':>12} {'parity SDR':>12} {'SDR float32':>12} {'SDR ' + variant:>14} {'SDR delta':>10}")
+	for stem in separator.instruments:
+		reduced = estimates[variant][stem]
+		parity = sdr(estimates['float32'][stem], reduced)
+		report[f'parity_{stem}'] = parity
+		reference_path = os.path.join(pathTrack, f'{stem}.wav')
+		if os.path.isdir(pathTrack) and os.path.isfile(reference_path):
+			reference, _ = separator.load_audio(reference_path)
+			sdr_float32 = sdr(reference, estimates['float32'][stem])
+			sdr_reduced = sdr(reference, reduced)
+			report[f'sdr_delta_{stem}'] = sdr_reduced - sdr_float32
+			print(f"{stem:>12} {parity:12.3f} {sdr_float32:12.3f} {sdr_reduced:14.3f} {sdr_reduced - sdr_float32:10.3f}")
+		else:
+			print(f"{stem:>12} {parity:12.3f} {'-':>12} {'-':>14} {'-':>10}")
+	print(f"Separation time: float32 {durations['float32']:.2f}s, {variant} {durations[variant]:.2f}s")
+	print(f"Weights: float32 {sizes['float32']:.2f} MB, {variant} {sizes[variant]:.2f} MB")
+	return report
@@ -0,0 +1,237 @@
+import os
+import time
+
+import torch
+import torch.nn as nn
+from ruamel.yaml import YAML
+
+from hhSCNet import loadModelConfigurationYaml
+
+from .benchmark import time_module
+from .SCNet import SCNet
+from .utils import load_model
+
+
+def _importance(*slices):
+	"""
+	Importance of each channel from the weights that read or write it: the L2 norm of its slices,
+	divided by the mean over the channels so that every weight counts the same.
+
+	Each slice is `(weight, dim, groups)`: the channels are along `dim` of `weight`, which holds
+	`groups` consecutive blocks of them, e.g. the gates of an LSTM or the two halves of a GLU.
+	"""
+	total = 0
+	for weight, dim, groups in slices:
+		weight = weight.detach().float().movedim(dim, 0)
+		norms = weight.reshape(groups, weight.shape[0] // groups, -1).square().sum(dim=(0, 2)).sqrt()
+		total = total + norms / norms.mean().clamp_min(1e-12)
+	return total
+
+def _keep(scores, count):
+	"""Indices of the `count` most important channels, in their original order."""
+	return scores.topk(count).indices.sort().values
+
+def _blocks(index, size, groups=2):
+	"""`index` in each of the `groups` consecutive blocks of `size` channels."""
+	return torch.cat([index + group * size for group in range(groups)])
+
+def _take(tensor, *indices):
+	"""`tensor` with only the `indices` along each dimension, None keeps a dimension whole."""
+	for dim, index in enumerate(indices):
+		if index is not None:
+			tensor = tensor.index_select(dim, index)
+	return tensor
+
+def _copy(target, source, *indices):
+	# Copy the weight of `source` at `indices` into `target`, and its bias at the output channels.
+	target.weight.copy_(_take(source.weight, *indices))
+	if source.bias is not None:
+		outputs = indices[1] if isinstance(source, nn.ConvTranspose2d) else indices[0]
+		target.bias.copy_(_take(source.bias, outputs))
+
+def _level_importance(model, level):
+	"""Importance of the channels of `dims[level]`, shared by an encoder block, its decoder level and their neighbours."""
+	levels = len(model.dims) - 1
+	block = model.encoder[level - 1]
+	fusion_layer, su_layer = model.decoder[levels - level]
+	slices = [(conv.weight, 0, 1) for conv in block.SDlayer.convs]
+	for conv_module in block.conv_modules:
+		for layer in conv_module.layers:
+			slices += [(layer[0].weight, 0, 1), (layer[1].weight, 1, 1), (layer[6].weight, 0, 1)]
+	slices += [(block.globalconv.weight, 0, 1), (block.globalconv.weight, 1, 1)]
+	slices += [(fusion_layer.conv.weight, 0, 2), (fusion_layer.conv.weight, 1, 2)]
+	slices += [(convtr.weight, 0, 1) for convtr in su_layer.convtrs]
+	if level < levels:
+		slices += [(conv.weight, 1, 1) for conv in model.encoder[level].SDlayer.convs]
+		slices += [(convtr.weight, 1, 1) for convtr in model.decoder[levels - level - 1][1].convtrs]
+	else:
+		for index, dp_module in enumerate(model.separation_net.dp_modules):
+			# The odd layers hold the real parts and then the imaginary parts of the channels.
+			groups = 1 + index % 2
+			for norm, lstm, linear in zip(dp_module.norm_layers, dp_module.lstm_layers, dp_module.linear_layers):
+				slices += [(norm.weight, 0, groups), (linear.weight, 0, groups)]
+				slices += [(weight, 1, groups) for name, weight in lstm.named_parameters() if name.startswith('weight_ih')]
+	return _importance(*slices)
+
+def _prune_layer(target, source, channels, hidden):
+	# A layer of a `ConvolutionModule`, keeping `channels` of its stream and `hidden` of its own.
+	norm, conv, _, depthwise_conv, hidden_norm, _, pointwise_conv = source
+	scores = _importance((conv.weight, 0, 2), (depthwise_conv.weight, 0, 1), (hidden_norm.weight, 0, 1),
+						 (pointwise_conv.weight, 1, 1))
+	keep = _keep(scores, hidden)
+	_copy(target[0], norm, channels)
+	_copy(target[1], conv, _blocks(keep, conv.out_channels // 2), channels)
+	_copy(target[3], depthwise_conv, keep)
+	_copy(target[4], hidden_norm, keep)
+	_copy(target[6], pointwise_conv, channels, keep)
+
+def _prune_path(target, source, channels, hidden):
+	# One path of a `DualPathRNN`: its GroupNorm, LSTM and Linear, keeping `channels` and `hidden` units per direction.
+	(target_norm, target_lstm, target_linear), (norm, lstm, linear) = target, source
+	_copy(target_norm, norm, channels)
+	size = lstm.hidden_size
+	units = []
+	for direction, suffix in enumerate(['', '_reverse'][:1 + lstm.bidirectional]):
+		weights = {name: getattr(lstm, f'{name}_l0{suffix}') for name in ('weight_ih', 'weight_hh', 'bias_ih', 'bias_hh')}
+		scores = _importance((weights['weight_ih'], 0, 4), (weights['weight_hh'], 0, 4), (weights['weight_hh'], 1, 1),
+							 (linear.weight[:, direction * size:(direction + 1) * size], 1, 1))
+		keep = _keep(scores, hidden)
+		gates = _blocks(keep, size, 4)
+		getattr(target_lstm, f'weight_ih_l0{suffix}').copy_(_take(weights['weight_ih'], gates, channels))
+		getattr(target_lstm, f'weight_hh_l0{suffix}').copy_(_take(weights['weight_hh'], gates, keep))
+		getattr(target_lstm, f'bias_ih_l0{suffix}').copy_(_take(weights['bias_ih'], gates))
+		getattr(target_lstm, f'bias_hh_l0{suffix}').copy_(_take(weights['bias_hh'], gates))
+		units.append(keep + direction * size)
+	_copy(target_linear, linear, channels, torch.cat(units))
+
+def prune_model(model, config, ratio):
+	"""
+	Remove the least important `ratio` of the channels of a trained `SCNet`, built from the model
+	configuration `config`, and return the smaller `SCNet` and its configuration.
+
+	Every level of `dims` but the first keeps `1 - ratio` of its channels, ranked by the weights of
+	the `SDblock`s, `FusionLayer`s, `SUlayer`s and, for the last level, `DualPathRNN`s that read or
+	write them. The hidden channels of each `ConvolutionModule` layer and the hidden units of each
+	LSTM direction are ranked by their own weights, and `compress` and `expand` keep their values,
+	so the smaller model is `SCNet(**config)` with only `dims` changed.
+
+	Args:
+		model: the trained `SCNet`, unfolded and with all its sources.
+		config (dict): the keyword arguments of `model`, e.g. the `model` section of a configuration.
+		ratio (float): fraction of the channels to remove, in [0, 1).
+	"""
+	if not 0 <= ratio < 1:
+		raise ValueError(f"The pruning ratio must be in [0, 1), got {ratio}")
+	config = dict(config)
+	config['dims'] = [model.dims[0]] + [max(1, round(channels * (1 - ratio))) for channels in model.dims[1:]]
+	pruned = SCNet(**config)
+	levels = len(model.dims) - 1
+	keeps = [torch.arange(model.dims[0])]
+	keeps += [_keep(_level_importance(model, level), pruned.dims[level]) for level in range(1, levels + 1)]
+	# The last SUlayer writes the fixed channels of every source.
+	outputs = torch.arange(model.dims[0] * len(model.sources))
+
+	with torch.no_grad():
+		for level in range(1, levels + 1):
+			channels, inputs = keeps[level], keeps[level - 1]
+			block, target = model.encoder[level - 1], pruned.encoder[level - 1]
+			for target_conv, conv in zip(target.SDlayer.convs, block.SDlayer.convs):
+				_copy(target_conv, conv, channels, inputs)
+			for target_module, conv_module in zip(target.conv_modules, block.conv_modules):
+				for target_layer, layer in zip(target_module.layers, conv_module.layers):
+					_prune_layer(target_layer, layer, channels, target_layer[3].out_channels)
+			_copy(target.globalconv, block.globalconv, channels, channels)
+
+			(fusion_layer, su_layer), (target_fusion, target_su) = model.decoder[levels - level], pruned.decoder[levels - level]
+			fused = _blocks(channels, model.dims[level])
+			_copy(target_fusion.conv, fusion_layer.conv, fused, fused)
+			for target_convtr, convtr in zip(target_su.convtrs, su_layer.convtrs):
+				_copy(target_convtr, convtr, channels, inputs if level > 1 else outputs)
+
+		for index, (target, dp_module) in enumerate(zip(pruned.separation_net.dp_modules, model.separation_net.dp_modules)):
+			channels = keeps[-1] if index % 2 == 0 else _blocks(keeps[-1], model.dims[-1])
+			for path in range(2):
+				paths = (target.norm_layers[path], target.lstm_layers[path], target.linear_layers[path])
+				_prune_path(paths, (dp_module.norm_layers[path], dp_module.lstm_layers[path], dp_module.linear_layers[path]),
+							channels, target.hidden_size)
+	return pruned, config
+
+def count_parameters(model):
+	return sum(parameter.numel() for parameter in model.parameters())
+
+def save_pruned(model, config, path):
+	"""Write the checkpoint of a pruned `model` to `path`, and beside it `config.yaml`, the training configuration `config` with the pruned model section."""
+	os.makedirs(path, exist_ok=True)
+	state = model.state_dict()
+	torch.save({'state': state, 'best_state': state}, os.path.join(path, 'pruned.th'))
+	with open(os.path.join(path, 'config.yaml'), 'w') as file:
+		YAML(typ='safe').dump(config, file)
+
+def _mean_sdr(model, checkpoint, pathTrack):
+	# Mean SDR over the stems of the track folder `pathTrack` separated by `model` with the weights of `checkpoint`.
+	from .inference import Separator
+	from .parity import sdr
+	separator = Separator(model, checkpoint, shifts=0)
+	mix, context = separator.load_mix(os.path.join(pathTrack, 'mixture.wav'))
+	estimates, _ = separator.finish_estimates(separator.separate_mix(mix), context)
+	scores = [sdr(separator.load_audio(os.path.join(pathTrack, f'{stem}.wav'))[0], estimates[stem])
+			  for stem in separator.instruments]
+	return sum(scores) / len(scores)
+
+def runPrune(checkpoint: str,
+			modelConfiguration: str = "./conf/config.yaml",
+			pathSave: str = "./pruned/",
+			ratios: str = "0.25,0.5",
+			epochs: int = 0,
+			pathTrack: str = '',
+			segment: float = 20) -> dict:
+	"""Prune the channels of a trained model at each ratio, optionally fine-tune it, and compare the speed and SDR.
+
+	Parameters
+		checkpoint: Path to the trained model checkpoint file
+		modelConfiguration: Path to the configuration YAML file the model was trained with
+		pathSave: Directory where each ratio gets a folder with its `config.yaml`, `pruned.th` and, if fine-tuned, `tuned.th`
+		ratios: Comma-separated fractions of the channels to remove
+		epochs: Epochs of fine-tuning of each pruned model with `train` and the training configuration, none if 0
+		pathTrack: Track folder with `mixture.wav` and one WAV file per source to measure the mean SDR, skipped if empty
+		segment: Seconds of audio in the chunk that is timed
+	"""
+	from .train import trainModel
+	config = loadModelConfigurationYaml(modelConfiguration)
+	model = load_model(SCNet(**config.model), checkpoint).eval()
+	x = torch.randn(1, model.audio_channels, int(segment * config.data.samplerate))
+	baseline = time_module(model, (x,), 3)
+
+	report = {}
+	print(f"{'ratio':>6} {'dims':>18} {'parameters':>11} {'seconds':>8} {'speedup':>8} {'SDR':>7} {'tuned SDR':>10}")
+	for ratio in [0.] + [float(ratio) for ratio in ratios.split(',') if ratio.strip()]:
+		if ratio:
+			pruned, model_config = prune_model(model, config.model.to_dict(), ratio)
+			path = os.path.join(pathSave, f'ratio_{ratio:g}')
+			training_config = config.to_dict()
+			training_config['model'] = model_config
+			training_config['epochs'] = epochs
+			save_pruned(pruned, training_config, path)
+			pruned_checkpoint = os.path.join(path, 'pruned.th')
+			seconds = time_module(pruned.eval(), (x,), 3)
+		else:
+			pruned, model_config, pruned_checkpoint, seconds = model, config.model.to_dict(), checkpoint, baseline
+		row = {'dims': pruned.dims, 'parameters': count_parameters(pruned), 'seconds': seconds, 'sdr': float('nan'),
+			   'tuned sdr': float('nan')}
+		if pathTrack:
+			row['sdr'] = _mean_sdr(SCNet(**model_config), pruned_checkpoint, pathTrack)
+		if ratio and epochs:
+			start = time.time()
+			trainModel(os.path.join(path, 'config.yaml'), path, checkpointInitial=pruned_checkpoint)
+			row['tuning seconds'] = time.time() - start
+			# The solver keeps no best state until the validation nSDR is positive, the last one is used then.
+			package = torch.load(os.path.join(path, 'checkpoint.th'), map_location='cpu')
+			tuned_checkpoint = os.path.join(path, 'tuned.th')
+			torch.save({'best_state': package['best_state'] or package['state']}, tuned_checkpoint)
+			if pathTrack:
+				row['tuned sdr'] = _mean_sdr(SCNet(**model_config), tuned_checkpoint, pathTrack)
+		report[ratio] = row
+		dims = ','.join(str(channels) for channels in row['dims'])
+		print(f"{ratio:6.2f} {dims:>18} {row['parameters']:11d} {seconds:7.3f}s {baseline / seconds:7.2f}x "
+			  f"{row['sdr']:7.3f} {row['tuned sdr']:10.3f}")
+	return report
@@ -0,0 +1,60 @@
+import torch
+import torch.nn as nn
+from torch.ao.quantization import DeQuantStub, QuantStub, convert, get_default_qconfig, prepare, quantize_dynamic
+
+from .SCNet import ConvolutionModule
+
+
+class QuantizedConvolution(nn.Module):
+	"""
+	A convolution that runs in int8 after `quantize_model`: its input is quantized with the range
+	observed during calibration and its output is dequantized back to float32.
+	"""
+	def __init__(self, conv):
+		super().__init__()
+		self.quant = QuantStub()
+		self.conv = conv
+		self.dequant = DeQuantStub()
+
+	def forward(self, x):
+		return self.dequant(self.conv(self.quant(x)))
+
+def quantize_model(model, static=False, calibration=(), engine='x86'):
+	"""
+	Quantize a float32 `SCNet` in place for CPU inference.
+
+	The LSTMs and linear layers of the `DualPathRNN`s get dynamic int8 quantization: their
+	weights are stored in int8 and their activations are quantized on the fly. If `static`, the
+	convolutions of every `ConvolutionModule` are also quantized to int8, with the activation
+	ranges observed while the model runs on `calibration`.
+
+	Args:
+		model: the `SCNet` to quantize, on CPU.
+		static (bool): also quantize the `ConvolutionModule` convolutions.
+		calibration (iterable of Tensor): normalized `[batch, channels, length]` mixtures.
+		engine (str): quantized backend, see `torch.backends.quantized.supported_engines`.
+
+	Returns the model and the number of calibration chunks.
+	"""
+	torch.backends.quantized.engine = engine
+	model.cpu().float().eval()
+	chunks = 0
+	if static:
+		qconfig = get_default_qconfig(engine)
+		for module in model.modules():
+			if isinstance(module, ConvolutionModule):
+				for layer in module.layers:
+					for index, child in enumerate(layer):
+						if isinstance(child, nn.Conv1d):
+							layer[index] = QuantizedConvolution(child)
+							layer[index].qconfig = qconfig
+		prepare(model, inplace=True)
+		with torch.no_grad():
+			for mix in calibration:
+				model(mix)
+				chunks += 1
+		if not chunks:
+			raise ValueError("Static quantization needs at least one calibration mixture")
+		convert(model, inplace=True)
+	quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=torch.qint8, inplace=True)
+	return model, chunks
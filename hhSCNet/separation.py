@@ -1,6 +1,9 @@
 import torch
 import torch.nn as nn
 from torch.nn.modules.rnn import LSTM
+from torch.utils.checkpoint import checkpoint
+
+from .workspace import workspace_buffer, workspace_empty
 
 class FeatureConversion(nn.Module):
 	"""
@@ -15,21 +18,47 @@ class FeatureConversion(nn.Module):
 		self.inverse = inverse
 		self.channels= channels
 
+	@property
+	def buffer_name(self):
+		# The conversions alternate, each reads the output of the previous one and writes into the other buffer.
+		return 'inverse conversion' if self.inverse else 'conversion'
+
 	def forward(self, x):
 		# B, C, F, T = x.shape
+		# The FFTs run in float32 whatever the dtype of the network.
+		dtype = x.dtype
 		if self.inverse:
 			x = x.float()
 			x_r = x[:, :self.channels//2, :, :]
 			x_i = x[:, self.channels//2:, :, :]
-			x = torch.complex(x_r, x_i)
+			out = workspace_buffer(self, 'complex', x_r.shape, x_r, dtype=torch.complex64)
+			x = torch.complex(x_r, x_i) if out is None else torch.complex(x_r, x_i, out=out)
 			x = torch.fft.irfft(x, dim=3, norm="ortho")
 		else:
 			x = x.float()
 			x = torch.fft.rfft(x, dim=3, norm="ortho")
 			x_real = x.real
 			x_imag = x.imag
-			x = torch.cat([x_real, x_imag], dim=1)
-		return x
+			out = workspace_buffer(self, self.buffer_name, (x.shape[0], 2 * x.shape[1], *x.shape[2:]), x_real)
+			x = torch.cat([x_real, x_imag], dim=1) if out is None else torch.cat([x_real, x_imag], dim=1, out=out)
+		return x.to(dtype)
+
+	def forward_inference(self, x):
+		"""`forward` for `x` of shape `[F, B, T, C]`, the layout of `SeparationNet.forward_inference`."""
+		dtype = x.dtype
+		x = x.float()
+		if self.inverse:
+			x_r, x_i = x[..., :self.channels//2], x[..., self.channels//2:]
+			x = torch.complex(x_r, x_i, out=workspace_empty(self, 'complex', x_r.shape, x_r, dtype=torch.complex64))
+			x = torch.fft.irfft(x, dim=2, norm="ortho")
+			x = workspace_empty(self, self.buffer_name, x.shape, x).copy_(x)
+		else:
+			x = torch.fft.rfft(x, dim=2, norm="ortho")
+			# The real parts and then the imaginary parts of the channels.
+			out = workspace_empty(self, self.buffer_name, (*x.shape[:-1], 2 * x.shape[-1]), x.real)
+			out.view(*x.shape[:-1], 2, x.shape[-1]).copy_(torch.view_as_real(x).transpose(-1, -2))
+			x = out
+		return x.to(dtype)
 
 
 class DualPathRNN(nn.Module):
@@ -79,6 +108,74 @@ class DualPathRNN(nn.Module):
 
 		return x
 
+	@property
+	def inference_ready(self):
+		"""True if `forward_inference` can run, i.e. the layers were not replaced, e.g. by `quantize_model`."""
+		return all(type(lstm) is LSTM and type(linear) is nn.Linear
+				   for lstm, linear in zip(self.lstm_layers, self.linear_layers))
+
+	def forward_inference(self, x):
+		"""
+		`forward` for `x` of shape `[F, B, T, C]`, which is updated in place and returned.
+
+		The frequency-path runs on `x` as it is, the time-path on a `[T, B, F, C]` buffer, so each
+		LSTM reads its sequences without a copy. The layout change to the buffer happens within
+		the GroupNorm. On CPU the directions of each LSTM run as separate oneDNN layers, whose
+		outputs are projected by one matrix product each instead of being concatenated, and the
+		projections are added into `x` or written into the buffer.
+		"""
+		Fr, B, T, C = x.shape
+
+		# Frequency-path
+		y = self._group_norm(x, self.norm_layers[0], workspace_empty(self, 'dual-path', x.shape, x))
+		outputs = self._lstm(self.lstm_layers[0], y.view(Fr, B * T, C))
+		self._linear(outputs, self.linear_layers[0], x.view(-1, C), accumulate=True)
+
+		# Time-path
+		buffer = workspace_empty(self, 'dual-path', (T, B, Fr, C), x)
+		y = self._group_norm(x.permute(2, 1, 0, 3), self.norm_layers[1], buffer)
+		outputs = self._lstm(self.lstm_layers[1], y.view(T, B * Fr, C))
+		self._linear(outputs, self.linear_layers[1], buffer.view(-1, C), accumulate=False)
+		x += buffer.permute(2, 1, 0, 3)
+
+		return x
+
+	@staticmethod
+	def _group_norm(x, norm, out):
+		# GroupNorm(1, C) of a `[., B, ., C]` tensor, written to `out`. `var_mean` is several times
+		# slower here, the sums over the channels are accumulated in float64 instead.
+		count = x.numel() // x.shape[1]
+		mean = x.sum(dim=3).sum(dim=(0, 2), keepdim=True, dtype=torch.float64) / count
+		out = torch.sub(x, mean[..., None].to(x.dtype), out=out)
+		var = torch.linalg.vector_norm(out, dim=3).double().square_().sum(dim=(0, 2), keepdim=True) / count
+		scale = norm.weight * torch.rsqrt(var[..., None] + norm.eps).to(x.dtype)
+		return torch.addcmul(norm.bias, out, scale, out=out)
+
+	def _lstm(self, lstm, x):
+		# Outputs of the LSTM for the sequence first `x`, one per direction or concatenated.
+		if x.device.type == 'cpu' and x.dtype == torch.float32 and torch.backends.mkldnn.is_available() \
+				and torch.backends.mkldnn.enabled:
+			state = x.new_zeros(x.shape[1], self.hidden_size)
+			return [
+				torch.ops.aten.mkldnn_rnn_layer(
+					x, *[getattr(lstm, f'{name}_l0{suffix}') for name in ('weight_ih', 'weight_hh', 'bias_ih', 'bias_hh')],
+					state, state, suffix == '_reverse', [], 2, self.hidden_size, 1, True, self.bidirectional, False,
+					False)[0]
+				for suffix in ['', '_reverse'][:1 + self.bidirectional]
+			]
+		# The LSTMs are batch first, a batch first view of a sequence first tensor is run without copies.
+		return [lstm(x.transpose(0, 1))[0].transpose(0, 1)]
+
+	@staticmethod
+	def _linear(outputs, linear, out, accumulate):
+		# Write `linear` of the concatenated `outputs` to `out`, or add it if `accumulate`.
+		start = 0
+		for output in outputs:
+			end = start + output.shape[-1]
+			out.addmm_(output.reshape(-1, end - start), linear.weight[:, start:end].t(), beta=1 if accumulate or start else 0)
+			start = end
+		return out.add_(linear.bias)
+
 
 
 
@@ -91,11 +188,13 @@ class SeparationNet(nn.Module):
 	- channels (int): Number input channels.
 	- expand (int): Expansion factor used to calculate the hidden_size of LSTM.
 	- num_layers (int): Number of dual-path layers.
+	- recompute (bool): Recompute the activations of each dual-path layer in the backward pass instead of saving them.
 	"""
-	def __init__(self, channels, expand=1, num_layers=6):
+	def __init__(self, channels, expand=1, num_layers=6, recompute=False):
 		super(SeparationNet, self).__init__()
 
 		self.num_layers = num_layers
+		self.recompute = recompute
 
 		self.dp_modules = nn.ModuleList([
 				DualPathRNN(channels * (2 if i % 2 == 1 else 1), expand) for i in range(num_layers)
@@ -105,11 +204,33 @@ class SeparationNet(nn.Module):
 			FeatureConversion(channels * 2 , inverse = False if i % 2 == 0 else True) for i in range(num_layers)
 		])
 	def forward(self, x):
+		# The inference path writes into buffers, which autograd does not support.
+		if not self.training and not torch.is_grad_enabled() and all(dp_module.inference_ready for dp_module in self.dp_modules):
+			return self.forward_inference(x)
 		for i in range(self.num_layers):
-			x = self.dp_modules[i](x)
+			if self.recompute and self.training and torch.is_grad_enabled():
+				x = checkpoint(self.dp_modules[i], x, use_reentrant=False)
+			else:
+				x = self.dp_modules[i](x)
 			x = self.feature_conversion[i](x)
 		return x
 
+	def forward_inference(self, x):
+		"""
+		Inference version of `forward`. The layers work on one `[F, B, T, C]` tensor, with the
+		channels of each frequency and frame contiguous, see `DualPathRNN.forward_inference`.
+		"""
+		B, C, Fr, T = x.shape
+		# The first conversion does not write into the buffer of the second one.
+		first = self.feature_conversion[1].buffer_name if self.num_layers > 1 else 'separation'
+		x = workspace_empty(self, first, (Fr, B, T, C), x).copy_(x.permute(2, 0, 3, 1))
+		for i in range(self.num_layers):
+			x = self.dp_modules[i].forward_inference(x)
+			x = self.feature_conversion[i].forward_inference(x)
+		Fr, B, T, C = x.shape
+		last = 'conversion' if self.feature_conversion[-1].inverse else 'inverse conversion'
+		return workspace_empty(self, last, (B, C, Fr, T), x).copy_(x.permute(1, 3, 0, 2))
+
 # Some or all of the work in this file may be restricted by the following copyright.
 """
 MIT License
@@ -1,3 +1,6 @@
+import copy
+import time
+from contextlib import nullcontext
 from pathlib import Path
 
 import torch
@@ -6,20 +9,25 @@ from torch.cuda.amp import GradScaler, autocast
 from tqdm.auto import tqdm
 
 from . import augment
+from .augment import augment_together
 from .apply import apply_model
 from .ema import ModelEMA
 from .log import logger
 from .loss import spec_rmse_loss
-from .utils import EMA, copy_state, new_sdr
+from .utils import EMA, copy_state, new_sdr, peak_memory, saved_activations
 
 
 def _summary(metrics):
 	return " | ".join(f"{key.capitalize()}={val}" for key, val in metrics.items())
 
 class Solver(object):
-	def __init__(self, loaders, model, optimizer, config, args):
+	def __init__(self, loaders, model, optimizer, config, args, teacher=None):
 		self.config = config
 		self.loaders = loaders
+		# Distillation: the training examples are followed by the teacher estimates if they were
+		# precomputed, otherwise the frozen `teacher` separates each augmented batch.
+		self.teacher = teacher
+		self.cached_targets = 'distill' in config and bool(config.distill.teacher) and bool(config.distill.cache)
 
 		self.model = model
 		self.optimizer = optimizer
@@ -60,6 +68,7 @@ class Solver(object):
 		self.best_state = None
 		self.best_nsdr = 0
 		self.epoch = -1
+		self.probed = False
 		self._reset()
 
 	def _serialize(self, epoch, steps=0):
@@ -145,28 +154,22 @@ class Solver(object):
 			logger.info('Cross validation...')
 			self.model.eval()  # Turn off Batchnorm & Dropout
 			with torch.no_grad():
-				valid = self._run_one_epoch(epoch, train=False)
-				bvalid = valid
+				valid = self._validate(epoch)
+				bvalid = valid['main']
 				bname = 'main'
 				state = copy_state(self.model.state_dict())
-				metrics['valid'] = {}
-				metrics['valid']['main'] = valid
+				metrics['valid'] = valid
 				for kind, emas in self.emas.items():
 					for k, ema in enumerate(emas):
-						with ema.swap():
-							valid = self._run_one_epoch(epoch, train=False)
 						name = f'ema_{kind}_{k}'
-						metrics['valid'][name] = valid
-						a = valid['nsdr']
+						a = valid[name]['nsdr']
 						b = bvalid['nsdr']
 						if a > b:
-							bvalid = valid
+							bvalid = valid[name]
 							state = ema.state
 							bname = name
-					metrics['valid'].update(bvalid)
-					metrics['valid']['bname'] = bname
-
-
+				metrics['valid'].update(bvalid)
+				metrics['valid']['bname'] = bname
 
 			formatted = self._format_train(metrics['valid'])
 			logger.info(
@@ -185,14 +188,102 @@ class Solver(object):
 				break
 
 
-	def _run_one_epoch(self, epoch, train=True):
-		config = self.config
-		data_loader = self.loaders['train'] if train else self.loaders['valid']
+	def _candidates(self):
+		# The name, the model and the context giving it its weights of each model validated: the main
+		# model, then each EMA, either as a replica with its weights or swapped in the main model.
+		candidates = [('main', self.model, nullcontext)]
+		replicas = self.config.ema.get('replicas', True)
+		for kind, emas in self.emas.items():
+			for k, ema in enumerate(emas):
+				if replicas:
+					replica = copy.deepcopy(self.accelerator.unwrap_model(self.model))
+					replica.load_state_dict(ema.state, strict=True)
+					candidates.append((f'ema_{kind}_{k}', replica, nullcontext))
+				else:
+					candidates.append((f'ema_{kind}_{k}', self.model, ema.swap))
+		return candidates
+
+	def _validate(self, epoch):
+		"""
+		Validate the main model and every EMA in one pass over the validation set: each track is
+		loaded once and separated by each of them. Returns the metrics of each, by name.
+		"""
+		data_loader = self.loaders['valid']
 		data_loader.sampler.epoch = epoch
+		candidates = self._candidates()
+		averagers = {name: EMA() for name, _, _ in candidates}
+		metrics = {}
+		start = time.time()
 
-		label = ["Valid", "Train"][train]
-		name = label + f" | Epoch {epoch + 1}"
-		total = len(data_loader)
+		if self.accelerator.is_main_process:
+			data_loader = tqdm(data_loader)
+
+		for sources in data_loader:
+			sources = sources.to(self.device)
+			mix = sources[:, 0]
+			sources = sources[:, 1:]
+			losses = []
+			nsdrs = []
+			for name, model, weights in candidates:
+				with weights():
+					estimate = apply_model(model, mix, split=True, overlap=0)
+				assert estimate.shape == sources.shape, (estimate.shape, sources.shape)
+				losses.append(spec_rmse_loss(estimate, sources, self.stft_config))
+				nsdrs.append(new_sdr(sources, estimate.detach()).mean(0))
+				del estimate
+			# One reduction for the nSDRs of all the models.
+			nsdrs = self.accelerator.reduce(torch.stack(nsdrs), reduction="mean")
+			for (name, _, _), loss, nsdr in zip(candidates, losses, nsdrs):
+				track = {'loss': loss}
+				for source, value in zip(self.config.model.sources, nsdr):
+					track[f'nsdr_{source}'] = value
+				track['nsdr'] = nsdr.mean()
+				metrics[name] = averagers[name](track)
+
+		logger.info(f'Validated {len(candidates)} models in {time.time() - start:.1f}s')
+		return metrics
+
+	def _step_cost(self, model, mix, sources, recompute):
+		# MB of the activations saved for the backward pass, peak MB and seconds of one training
+		# step of `model` recomputing the stages `recompute`.
+		model.set_recompute(recompute)
+		try:
+			with peak_memory(self.device) as peak:
+				start = time.time()
+				with autocast(), saved_activations() as saved:
+					loss = spec_rmse_loss(model(mix), sources, self.stft_config)
+				loss.backward()
+				duration = time.time() - start
+			return saved['MB'], peak['MB'], duration
+		except torch.cuda.OutOfMemoryError:
+			return float('nan'), float('inf'), float('nan')
+		finally:
+			model.zero_grad(set_to_none=True)
+			if torch.cuda.is_available():
+				torch.cuda.empty_cache()
+
+	def _probe_recompute(self, mix, sources):
+		"""Log the memory saved and the compute added by recomputing activations, on one training batch."""
+		model = self.accelerator.unwrap_model(self.model)
+		stages = list(model.recompute)
+		self._step_cost(model, mix, sources, stages)
+		saved, peak, duration = self._step_cost(model, mix, sources, [])
+		recomputed_saved, recomputed_peak, recomputed_duration = self._step_cost(model, mix, sources, stages)
+		model.set_recompute(stages)
+		message = (f"Recomputing {', '.join(stages)}: activations {saved:.0f} MB -> {recomputed_saved:.0f} MB "
+				   f"({100 * (1 - recomputed_saved / saved):.0f}% saved), ")
+		# The peak resident memory of the CPU is blurred by the memory that the allocator keeps.
+		if self.device.type == 'cuda':
+			message += f"peak memory {peak:.0f} MB -> {recomputed_peak:.0f} MB, "
+		message += (f"training step {duration:.2f}s -> {recomputed_duration:.2f}s "
+					f"({100 * (recomputed_duration / duration - 1):+.0f}% compute)")
+		logger.info(message)
+
+	def _run_one_epoch(self, epoch):
+		"""Train the model for one epoch, validation is `_validate`."""
+		config = self.config
+		data_loader = self.loaders['train']
+		data_loader.sampler.epoch = epoch
 
 		averager = EMA()
 
@@ -202,62 +293,58 @@ class Solver(object):
 		losses = {}
 		for idx, sources in enumerate(data_loader):
 			sources = sources.to(self.device)
-			if train:
-				sources = self.augment(sources)
-				mix = sources.sum(dim=1)
+			targets = None
+			if self.cached_targets:
+				sources, targets = augment_together(self.augment, *sources.chunk(2, dim=1))
 			else:
-				mix = sources[:, 0]
-				sources = sources[:, 1:]
+				sources = self.augment(sources)
+			mix = sources.sum(dim=1)
+			if self.teacher is not None:
+				with torch.no_grad(), autocast():
+					targets = self.teacher(mix)
+			if not self.probed and self.accelerator.unwrap_model(self.model).recompute:
+				self._probe_recompute(mix, sources)
+			self.probed = True
 
-			if not train:
-				estimate = apply_model(self.model, mix, split=True, overlap=0)
-			else:
-				with autocast():
-					estimate = self.model(mix)
+			with autocast():
+				estimate = self.model(mix)
 
 			assert estimate.shape == sources.shape, (estimate.shape, sources.shape)
 
 			loss = spec_rmse_loss(estimate, sources, self.stft_config)
+			if targets is not None:
+				weight = config.distill.weight
+				loss = (1 - weight) * loss + weight * spec_rmse_loss(estimate, targets.float(), self.stft_config)
 
 			losses = {}
 
 			losses['loss'] = loss
-			if not train:
-				nsdrs = new_sdr(sources, estimate.detach()).mean(0)
-				nsdrs = self.accelerator.reduce(nsdrs, reduction="mean")
-				total = 0
-				for source, nsdr in zip(self.config.model.sources, nsdrs):
-					losses[f'nsdr_{source}'] = nsdr
-					total += nsdr
-				losses['nsdr'] = total / len(self.config.model.sources)
-
-			# optimize model in training mode
-			if train:
-				scaled_loss = self.scaler.scale(loss)
-				self.accelerator.backward(scaled_loss)
-				grad_norm = 0
-				grads = []
-				for p in self.model.parameters():
-					if p.grad is not None:
-						grad_norm += p.grad.data.norm()**2
-						grads.append(p.grad.data)
-				losses['grad'] = grad_norm ** 0.5
-
-				self.scaler.step(self.optimizer)
-				self.scaler.update()
-				self.optimizer.zero_grad()
-				for ema in self.emas['batch']:
-					ema.update()
-				if self.config.save_every and (idx+1) % self.config.save_every == 0:
-					self._serialize(epoch, idx+1)
+
+			# optimize model
+			scaled_loss = self.scaler.scale(loss)
+			self.accelerator.backward(scaled_loss)
+			grad_norm = 0
+			grads = []
+			for p in self.model.parameters():
+				if p.grad is not None:
+					grad_norm += p.grad.data.norm()**2
+					grads.append(p.grad.data)
+			losses['grad'] = grad_norm ** 0.5
+
+			self.scaler.step(self.optimizer)
+			self.scaler.update()
+			self.optimizer.zero_grad()
+			for ema in self.emas['batch']:
+				ema.update()
+			if self.config.save_every and (idx+1) % self.config.save_every == 0:
+				self._serialize(epoch, idx+1)
 
 			losses = averager(losses)
 
 			del loss, estimate
 
-		if train:
-			for ema in self.emas['epoch']:
-				ema.update()
+		for ema in self.emas['epoch']:
+			ema.update()
 		return losses
 
 # Some or all of the work in this file may be restricted by the following copyright.
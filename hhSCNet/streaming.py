@@ -0,0 +1,140 @@
+import torch
+from accelerate import Accelerator
+
+from .apply import transition_weight
+from .utils import center_trim
+
+accelerator = Accelerator()
+
+class StreamingSeparator:
+	"""
+	Separate audio that arrives in blocks, e.g. a live feed or a recording too long to decode at once.
+
+	Samples are pushed with `push` and kept in a ring buffer of one `segment`. Each time the
+	buffer holds a full segment, the chunk is separated and overlap-added into an output ring
+	buffer, and the first `stride = (1 - overlap) * segment` samples, which no later chunk
+	covers, are returned. `flush` separates the remaining tail, so the chunks and weights are
+	those of `apply_model` with `split=True` and `shifts=0`. The latency is one `segment`.
+
+		streaming = StreamingSeparator(model)
+		for block in blocks:
+			stems = streaming.push(block)
+			...
+		stems = streaming.flush()
+
+	Normalization uses the running mean and standard deviation of the mono mix, updated with
+	every pushed sample, unless `mean` and `std` are given.
+
+	Args:
+		model: the separation model. Blocks must be at `samplerate` with `model.audio_channels`.
+		segment (float): chunk length in seconds.
+		overlap (float): overlap between consecutive chunks.
+		transition_power (float): see `apply_model`.
+		samplerate (int): sample rate of the model.
+		mean (float or None): fixed normalization mean.
+		std (float or None): fixed normalization standard deviation.
+	"""
+	def __init__(self, model, segment=20, overlap=0.5, transition_power=1., samplerate=44100,
+				mean=None, std=None):
+		assert transition_power >= 1, "transition_power < 1 leads to weird behavior."
+		self.device = accelerator.device
+		self.model = accelerator.unwrap_model(model)
+		self.model.to(self.device)
+		self.channels = self.model.audio_channels
+		self.sources = self.model.sources
+		self.segment = int(samplerate * segment)
+		self.stride = int((1 - overlap) * self.segment)
+		assert 0 < self.stride <= self.segment
+		self.weight = transition_weight(self.segment, transition_power, self.device)
+		self.fixed_statistics = None if mean is None else (float(mean), float(std))
+
+		# Sample `position` of the stream lives at index `position % segment` of the ring buffers.
+		self.mix = torch.zeros(self.channels, self.segment, device=self.device)
+		self.out = torch.zeros(len(self.sources), self.channels, self.segment, device=self.device)
+		self.sum_weight = torch.zeros(self.segment, device=self.device)
+		# Start of the oldest unfinished sample, and number of samples buffered from there.
+		self.offset = 0
+		self.filled = 0
+		# Welford's running statistics of the mono mix.
+		self.count = 0
+		self.running_mean = 0.
+		self.running_m2 = 0.
+
+	@property
+	def latency(self):
+		"""Number of samples between pushing a sample and getting its separated value."""
+		return self.segment
+
+	def push(self, block):
+		"""
+		Add `block` (`[channels, samples]`) to the stream.
+		Returns the finished samples as a `[sources, channels, samples]` tensor, possibly empty.
+		"""
+		block = torch.as_tensor(block, dtype=torch.float32, device=self.device)
+		if block.dim() != 2 or block.shape[0] != self.channels:
+			raise ValueError(f"Expected a block of shape [{self.channels}, samples], got {list(block.shape)}.")
+		finished = []
+		position = 0
+		while position < block.shape[-1]:
+			take = min(block.shape[-1] - position, self.segment - self.filled)
+			piece = block[:, position:position + take]
+			self.mix[:, self._ring(self.offset + self.filled, take)] = piece
+			self._update_statistics(piece)
+			self.filled += take
+			position += take
+			if self.filled == self.segment:
+				self._separate(self.offset, self.segment)
+				finished.append(self._emit(self.stride))
+		return self._concatenate(finished)
+
+	def flush(self):
+		"""Separate the buffered tail of the stream and return every remaining sample."""
+		end = self.offset + self.filled
+		for offset in range(self.offset, end, self.stride):
+			self._separate(offset, min(self.segment, end - offset))
+		return self._emit(self.filled)
+
+	def _ring(self, start, length):
+		return torch.arange(start, start + length, device=self.device) % self.segment
+
+	def _statistics(self):
+		if self.fixed_statistics is not None:
+			return self.fixed_statistics
+		std = (self.running_m2 / (self.count - 1)) ** 0.5 if self.count > 1 else 0.
+		return self.running_mean, std or 1.
+
+	def _update_statistics(self, piece):
+		mono = piece.mean(0).double()
+		count = mono.numel()
+		mean = mono.mean().item()
+		m2 = ((mono - mean) ** 2).sum().item()
+		total = self.count + count
+		delta = mean - self.running_mean
+		self.running_mean += delta * count / total
+		self.running_m2 += m2 + delta ** 2 * self.count * count / total
+		self.count = total
+
+	def _separate(self, offset, length):
+		index = self._ring(offset, length)
+		mean, std = self._statistics()
+		mix = (self.mix[:, index] - mean) / std
+		with torch.no_grad():
+			out = center_trim(self.model(mix[None]), length)[0]
+		out = out * std + mean
+		weight = self.weight[:length]
+		self.out.index_add_(-1, index, weight * out)
+		self.sum_weight.index_add_(0, index, weight)
+
+	def _emit(self, length):
+		index = self._ring(self.offset, length)
+		finished = self.out[..., index] / self.sum_weight[index]
+		self.out[..., index] = 0
+		self.sum_weight[index] = 0
+		self.offset += length
+		self.filled -= length
+		return finished
+
+	def _concatenate(self, finished):
+		if not finished:
+			return torch.zeros(len(self.sources), self.channels, 0, device=self.device)
+		return torch.cat(finished, dim=-1)
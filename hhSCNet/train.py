@@ -1,12 +1,17 @@
+from types import SimpleNamespace
+
 import torch
 from accelerate import Accelerator
 from torch.utils.data import DataLoader
 
 from hhSCNet import loadModelConfigurationYaml
 
+from .distill import DistillationSet, load_teacher, precompute_teacher
 from .log import logger
+from .packed import get_packed_datasets
 from .SCNet import SCNet
 from .solver import Solver
+from .utils import load_model
 from .wav import get_wav_datasets
 
 accelerator = Accelerator()
@@ -17,11 +22,15 @@ def get_model(config):
 	logger.info(f"Total number of parameters: {total_params}")
 	return model
 
-def get_solver(modelConfiguration, pathSave):
+def get_solver(modelConfiguration, pathSave, checkpointInitial=''):
 	config = loadModelConfigurationYaml(modelConfiguration)
 	
 	torch.manual_seed(config.seed)
 	model = get_model(config)
+	if checkpointInitial:
+		# A checkpoint of the solver in pathSave still takes precedence, see `Solver._reset`.
+		logger.info(f'Initializing the model with {checkpointInitial}')
+		load_model(model, checkpointInitial)
 
 	# torch also initialize cuda seed if available
 	if torch.cuda.is_available():
@@ -39,7 +48,20 @@ def get_solver(modelConfiguration, pathSave):
 			betas=(config.optim.optim.momentum, config.optim.beta2),
 			weight_decay=config.optim.weight_decay)
 
-	train_set, valid_set = get_wav_datasets(config.data)
+	if 'packed' in config.data and config.data.packed:
+		train_set, valid_set = get_packed_datasets(config.data)
+	else:
+		train_set, valid_set = get_wav_datasets(config.data)
+	teacher = None
+	if 'distill' in config and config.distill.teacher:
+		teacher = load_teacher(config, accelerator.device)
+		if config.distill.cache:
+			if accelerator.is_main_process:
+				precompute_teacher(teacher, train_set, config.distill.cache)
+			accelerator.wait_for_everyone()
+			train_set = DistillationSet(train_set, config.distill.cache)
+			# The estimates are read with the training examples.
+			teacher = None
 
 	logger.info("train/valid set size: %d %d", len(train_set), len(valid_set))
 	train_loader = DataLoader(
@@ -56,14 +78,16 @@ def get_solver(modelConfiguration, pathSave):
 
 	model, optimizer = accelerator.prepare(model, optimizer)
 
-	return Solver(loaders, model, optimizer, config, pathSave)
+	return Solver(loaders, model, optimizer, config, SimpleNamespace(save_path=pathSave), teacher=teacher)
 
-def trainModel(modelConfiguration: str = "./conf/config.yaml", pathSave: str = "./result/") -> None:
+def trainModel(modelConfiguration: str = "./conf/config.yaml", pathSave: str = "./result/",
+			   checkpointInitial: str = '') -> None:
 	"""Train the music source separation model.
 	
 	Parameters
 		modelConfiguration: Path to the YAML configuration file
 		pathSave: Directory path where checkpoints will be saved
+		checkpointInitial: Checkpoint whose weights start the training, e.g. a pruned model, random weights if empty
 	"""
 	import os
 	import sys
@@ -74,7 +98,7 @@ def trainModel(modelConfiguration: str = "./conf/config.yaml", pathSave: str = "
 		print(f"Error: config file {modelConfiguration} does not exist.")
 		sys.exit(1)
 
-	solver = get_solver(modelConfiguration, pathSave)
+	solver = get_solver(modelConfiguration, pathSave, checkpointInitial)
 	accelerator.wait_for_everyone()
 	solver.train()
 
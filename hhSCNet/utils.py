@@ -1,4 +1,6 @@
+import math
 import os
+import sys
 import tempfile
 import typing as tp
 from collections import defaultdict
@@ -9,6 +11,8 @@ import julius
 import numpy as np
 import torch
 
+from .SCNet import FusionLayer
+
 
 # Audio
 def convert_audio_channels(wav, channels=2):
@@ -109,6 +113,48 @@ def convert_audio(wav, from_samplerate, to_samplerate, channels):
 		wav = julius.resample_frac(wav, from_samplerate, to_samplerate)
 	return wav
 
+def match_channels(wav, channels):
+	"""Same conversion as `convert_audio_channels`, on the second to last dimension, without the debug output."""
+	src_channels = wav.shape[-2]
+	if src_channels == channels:
+		return wav
+	if channels == 1:
+		return wav.mean(dim=-2, keepdim=True)
+	if src_channels == 1:
+		return wav.expand(*wav.shape[:-2], channels, wav.shape[-1])
+	if src_channels > channels:
+		return wav.narrow(-2, 0, channels)
+	return wav[..., torch.arange(channels) % src_channels, :]
+
+def convert_audio_blockwise(read, length, from_samplerate, to_samplerate, channels, out, block=2**20):
+	"""
+	Same as `convert_audio`, but one block at a time, so that neither the input nor the output
+	has to fit in memory.
+
+	Args:
+		read (callable): `read(start, end)` returns the input samples `[..., channels, end - start]`.
+		length (int): number of input samples.
+		out (Tensor): `[..., channels, int(to_samplerate * length / from_samplerate)]`, e.g. from `memmap_zeros`.
+
+	Each block is resampled with enough context on both sides that the result matches
+	resampling the whole signal.
+	"""
+	resample = julius.ResampleFrac(from_samplerate, to_samplerate)
+	old, new = resample.old_sr, resample.new_sr
+	margin = math.ceil((getattr(resample, '_width', 0) + old) / old) * old
+	block = max(old, block // old * old)
+	out_length = out.shape[-1]
+	for start in range(0, length, block):
+		end = min(length, start + block)
+		context_start = max(0, start - margin)
+		wav = match_channels(read(context_start, min(length, end + margin)), channels)
+		wav = resample(wav, full=True)
+		out_start = start * new // old
+		out_end = end * new // old if end < length else out_length
+		first = out_start - context_start * new // old
+		out[..., out_start:out_end] = wav[..., first:first + out_end - out_start]
+	return out
+
 
 # model
 def load_model(model, checkpoint_path):
@@ -133,6 +179,49 @@ def load_model(model, checkpoint_path):
 		model.load_state_dict(new_state_dict)
 		return model
 
+def select_sources(model, sources):
+	"""
+	Prune an `SCNet` in place so that it only outputs `sources`, in that order.
+
+	Each source owns `dims[0]` consecutive output channels of the last `SUlayer`; the other
+	channels are removed, so unused sources are neither computed nor inverted by the iSTFT.
+	"""
+	missing = [source for source in sources if source not in model.sources]
+	if missing:
+		raise ValueError(f"Unknown sources {missing}, the model has {model.sources}")
+	width = model.dims[0]
+	index = torch.cat([torch.arange(model.sources.index(source) * width, (model.sources.index(source) + 1) * width)
+					   for source in sources])
+	su_layer = model.decoder[-1][1]
+	for convtr in su_layer.convtrs:
+		convtr.weight = torch.nn.Parameter(convtr.weight.data[:, index].clone())
+		if convtr.bias is not None:
+			convtr.bias = torch.nn.Parameter(convtr.bias.data[index].clone())
+		convtr.out_channels = len(index)
+	model.sources = list(sources)
+	return model
+
+def fold_fusion_layers(model):
+	"""
+	Fold the weights of every `FusionLayer` of an `SCNet` in place for inference, see
+	`FusionLayer.fold`. Call it after `load_model`; the folded model still loads checkpoints.
+	"""
+	for module in model.modules():
+		if isinstance(module, FusionLayer):
+			module.fold()
+	return model
+
+precisions = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}
+
+def set_precision(model, precision):
+	"""
+	Cast the weights of an `SCNet` to `precision`, one of `precisions`. The convolutions and
+	LSTMs then run in that dtype, while the STFT, iSTFT and FFTs stay in float32.
+	"""
+	if precision not in precisions:
+		raise ValueError(f"Unknown precision {precision!r}, expected one of {list(precisions)}")
+	return model.to(precisions[precision])
+
 def copy_state(state):
 	return {k: v.cpu().clone() for k, v in state.items()}
 
@@ -154,6 +243,69 @@ def swap_state(model, state):
 		model.load_state_dict(old_state)
 
 #other
+def memmap_zeros(shape, directory=None):
+	"""
+	Zero-filled float32 tensor backed by an anonymous temporary file in `directory`, so the
+	operating system can page it out. The file is removed when the tensor is released.
+	"""
+	with tempfile.TemporaryFile(dir=directory) as file:
+		# The mapping keeps its own handle on the file.
+		array = np.memmap(file, dtype=np.float32, mode='w+', shape=tuple(shape))
+	return torch.from_numpy(array)
+
+def _resident_memory(field):
+	with open('/proc/self/status') as status:
+		for line in status:
+			if line.startswith(field):
+				return int(line.split()[1]) / 2**10
+
+@contextmanager
+def peak_memory(device):
+	"""
+	Context manager measuring the increase of the peak memory in MB within it, e.g:
+
+		with peak_memory(device) as memory:
+			loss = model(mix).mean()
+		print(memory['MB'])
+
+	On CUDA this counts the tensors allocated on `device`, on Linux the resident memory of the
+	process, whose peak is reset on entry, see proc(5). NaN elsewhere.
+	"""
+	device = torch.device(device)
+	memory = {'MB': float('nan')}
+	if device.type == 'cuda':
+		torch.cuda.reset_peak_memory_stats(device)
+		before = torch.cuda.memory_allocated(device)
+		yield memory
+		memory['MB'] = (torch.cuda.max_memory_allocated(device) - before) / 2**20
+	elif sys.platform.startswith('linux'):
+		with open('/proc/self/clear_refs', 'w') as clear_refs:
+			clear_refs.write('5')
+		before = _resident_memory('VmRSS')
+		yield memory
+		memory['MB'] = _resident_memory('VmHWM') - before
+	else:
+		yield memory
+
+@contextmanager
+def saved_activations():
+	"""
+	Context manager measuring the MB of the tensors saved for the backward pass within it, each
+	storage counted once, e.g. the activations that `torch.utils.checkpoint` does not keep.
+	"""
+	memory = {'MB': 0.}
+	storages = set()
+
+	def pack(tensor):
+		storage = tensor.untyped_storage()
+		if storage.data_ptr() not in storages:
+			storages.add(storage.data_ptr())
+			memory['MB'] += storage.nbytes() / 2**20
+		return tensor
+
+	with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+		yield memory
+
 @contextmanager
 def temp_filenames(count: int, delete=True):
 	names = []
@@ -1,24 +1,46 @@
+from bisect import bisect_right
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import accumulate
 import hashlib
-import math
 import json
+import math
 import os
 from pathlib import Path
 from tqdm.auto import tqdm
 
 import julius
+import numpy as np
+import soundfile as sf
 import torch as th
-import torchaudio as ta
 from torch.nn import functional as F
 
 from .utils import convert_audio_channels
 from accelerate import Accelerator
+from accelerate.utils import gather_object
 
 accelerator = Accelerator()
 
 MIXTURE = "mixture"
 EXT = ".wav"
 
+def _mixture_statistics(file, block=2**18):
+	"""
+	Mean and standard deviation of the mono mixture `file`, read by blocks of `block` frames whose
+	statistics are merged with the parallel form of Welford's algorithm, in bounded memory.
+	"""
+	count, mean, m2 = 0, 0., 0.
+	for wav in sf.blocks(str(file), blocksize=block, dtype='float32', always_2d=True):
+		wav = wav.mean(1, dtype=np.float64)
+		block_mean = wav.mean()
+		total = count + len(wav)
+		delta = block_mean - mean
+		mean += delta * len(wav) / total
+		m2 += np.square(wav - block_mean).sum() + delta ** 2 * count * len(wav) / total
+		count = total
+	# Unbiased, as `torch.std`.
+	return float(mean), math.sqrt(m2 / (count - 1)) if count > 1 else 0.
+
 def _track_metadata(track, sources, normalize=True, ext=EXT):
 	track_length = None
 	track_samplerate = None
@@ -28,62 +50,106 @@ def _track_metadata(track, sources, normalize=True, ext=EXT):
 	for source in sources + [MIXTURE]:
 		file = track / f"{source}{ext}"
 		try:
-			info = ta.info(str(file))
+			info = sf.info(str(file))
 		except RuntimeError:
 			print(file)
 			raise
-		length = info.num_frames
+		length = info.frames
 		if track_length is None:
 			track_length = length
-			track_samplerate = info.sample_rate
+			track_samplerate = info.samplerate
 		elif track_length != length:
 			raise ValueError(
 				f"Invalid length for file {file}: "
 				f"expecting {track_length} but got {length}.")
-		elif info.sample_rate != track_samplerate:
+		elif info.samplerate != track_samplerate:
 			raise ValueError(
 				f"Invalid sample rate for file {file}: "
-				f"expecting {track_samplerate} but got {info.sample_rate}.")
+				f"expecting {track_samplerate} but got {info.samplerate}.")
 		if source == MIXTURE and normalize:
 			try:
-				wav, _ = ta.load(str(file))
+				mean, std = _mixture_statistics(file)
 			except RuntimeError:
 				print(file)
 				raise
-			wav = wav.mean(0)
-			mean = wav.mean().item()
-			std = wav.std().item()
 
 	return {"length": length, "mean": mean, "std": std, "samplerate": track_samplerate}
 
 
-def build_metadata(path, sources, normalize=True, ext=EXT):
+def _track_key(track, sources, normalize=True, ext=EXT):
+	"""
+	What the metadata of `track` depends on: `normalize` and the name, size and modification
+	time of each of its audio files. A track whose key is unchanged needs not be read again.
+	Made of lists, the key is the same after a round trip through the JSON cache.
+	"""
+	files = []
+	for source in sources + [MIXTURE]:
+		stat = (track / f"{source}{ext}").stat()
+		files.append([f"{source}{ext}", stat.st_size, stat.st_mtime_ns])
+	return [normalize, files]
+
+
+def _track_names(path):
+	names = []
+	for root, folders, files in os.walk(path, followlinks=True):
+		root = Path(root)
+		if root.name.startswith('.') or folders or root == path:
+			continue
+		names.append(str(root.relative_to(path)))
+	# Every rank lists the tracks in the same order.
+	return sorted(names)
+
+
+def update_metadata(path, sources, cache, normalize=True, ext=EXT, workers=8, rank=0, world_size=1):
+	"""
+	Update the metadata `cache` of the dataset in `path` to its current tracks: the tracks
+	whose files are unchanged keep their entry, new or changed tracks are read again and
+	deleted ones are dropped.
+
+	Args:
+		cache (dict): maps each track to the list of its key, see `_track_key`, and metadata,
+			as returned by an earlier call, or empty.
+		others: see `build_metadata`.
+	Returns:
+		The updated cache, sorted by track.
+	"""
+	path = Path(path)
+	entries = {}
+	stale = []
+	for name in _track_names(path)[rank::world_size]:
+		key = _track_key(path / name, sources, normalize, ext)
+		if name in cache and cache[name][0] == key:
+			entries[name] = cache[name]
+		else:
+			stale.append((name, key))
+	if stale and not workers:
+		for name, key in tqdm(stale, ncols=120):
+			entries[name] = [key, _track_metadata(path / name, sources, normalize, ext)]
+	elif stale:
+		with ProcessPoolExecutor(workers) as pool:
+			pendings = [(name, key, pool.submit(_track_metadata, path / name, sources, normalize, ext))
+						for name, key in stale]
+			for name, key, pending in tqdm(pendings, ncols=120):
+				entries[name] = [key, pending.result()]
+	return dict(sorted(entries.items()))
+
+
+def build_metadata(path, sources, normalize=True, ext=EXT, workers=8, rank=0, world_size=1):
 	"""
 	Build the metadata for `Wavset`.
 
 	Args:
 		path (str or Path): path to dataset.
 		sources (list[str]): list of sources to look for.
-		normalize (bool): if True, loads full track and store normalization
-			values based on the mixture file.
+		normalize (bool): if True, streams the mixture file and stores normalization
+			values based on it.
 		ext (str): extension of audio files (default is .wav).
+		workers (int): number of processes reading the tracks, 0 to read them in this one.
+		rank, world_size (int): only the metadata of every `world_size`-th track from the
+			`rank`-th is built, so that several processes split the tracks.
 	"""
-
-	meta = {}
-	path = Path(path)
-	pendings = []
-	from concurrent.futures import ThreadPoolExecutor
-	with ThreadPoolExecutor(8) as pool:
-		for root, folders, files in os.walk(path, followlinks=True):
-			root = Path(root)
-			if root.name.startswith('.') or folders or root == path:
-				continue
-			name = str(root.relative_to(path))
-			pendings.append((name, pool.submit(_track_metadata, root, sources, normalize, ext)))
-			# meta[name] = _track_metadata(root, sources, normalize, ext)
-		for name, pending in tqdm(pendings, ncols=120):
-			meta[name] = pending.result()
-	return meta
+	entries = update_metadata(path, sources, {}, normalize, ext, workers, rank, world_size)
+	return {name: meta for name, (key, meta) in entries.items()}
 
 
 class Wavset:
@@ -91,7 +157,7 @@ class Wavset:
 			self,
 			root, metadata, sources,
 			segment=None, shift=None, normalize=True,
-			samplerate=44100, channels=2, ext=EXT):
+			samplerate=44100, channels=2, ext=EXT, handles=64):
 		"""
 		Waveset (or mp3 set for that matter). Can be used to train
 		with arbitrary sources. Each track should be one folder inside of `path`.
@@ -110,6 +176,8 @@ class Wavset:
 			channels (int): target nb of channels. if different, will be
 				changed on the fly.
 			ext (str): extension for audio files (default is .wav).
+			handles (int): number of audio files kept open by each process, the least
+				recently read are closed first.
 
 		samplerate and channels are converted on the fly.
 		"""
@@ -130,56 +198,102 @@ class Wavset:
 			else:
 				examples = int(math.ceil((track_duration - self.segment) / self.shift) + 1)
 			self.num_examples.append(examples)
+		# The examples of the track `names[k]` end before `ends[k]`, found by binary search.
+		self.names = list(self.metadata)
+		self.ends = list(accumulate(self.num_examples))
+		self.handles = handles
+		self._files = OrderedDict()
+		self._pid = os.getpid()
 
 	def __len__(self):
-		return sum(self.num_examples)
+		return self.ends[-1] if self.ends else 0
+
+	def __getstate__(self):
+		# Open files are not sent to the DataLoader workers, each opens its own.
+		state = dict(self.__dict__)
+		state['_files'] = OrderedDict()
+		return state
 
 	def get_file(self, name, source):
 		return self.root / name / f"{source}{self.ext}"
 
+	def _open(self, file):
+		# An open `SoundFile` of this process, from a cache of at most `handles` files.
+		if self._pid != os.getpid():
+			# Forked workers share the position of the parent's files, they open their own.
+			self._files = OrderedDict()
+			self._pid = os.getpid()
+		if file in self._files:
+			self._files.move_to_end(file)
+		else:
+			self._files[file] = sf.SoundFile(str(file))
+			while len(self._files) > self.handles:
+				self._files.popitem(last=False)[1].close()
+		return self._files[file]
+
+	def _read(self, file, offset, num_frames):
+		# `ta.load(file, frame_offset=offset, num_frames=num_frames)` from a cached file.
+		audio = self._open(file)
+		audio.seek(offset)
+		wav = audio.read(num_frames, dtype='float32', always_2d=True)
+		return th.from_numpy(wav.T)
+
+	def _locate(self, index):
+		# The track of the example `index` and the index of the example in the track.
+		if not 0 <= index < len(self):
+			raise IndexError(f"Example {index} of a Wavset of {len(self)}")
+		track = bisect_right(self.ends, index)
+		return self.names[track], index - (self.ends[track - 1] if track else 0)
+
 	def __getitem__(self, index):
-		for name, examples in zip(self.metadata, self.num_examples):
-			if index >= examples:
-				index -= examples
-				continue
-			meta = self.metadata[name]
-			num_frames = -1
-			offset = 0
-			if self.segment is not None:
-				offset = int(meta['samplerate'] * self.shift * index)
-				num_frames = int(math.ceil(meta['samplerate'] * self.segment))
-			wavs = []
-			for source in self.sources:
-				file = self.get_file(name, source)
-				wav, _ = ta.load(str(file), frame_offset=offset, num_frames=num_frames)
-				wav = convert_audio_channels(wav, self.channels)
-				wavs.append(wav)
-
-			example = th.stack(wavs)
-			example = julius.resample.resample_frac(example, meta['samplerate'], self.samplerate)
-			if self.normalize:
-				example = (example - meta['mean']) / meta['std']
-			if self.segment:
-				length = int(self.segment * self.samplerate)
-				example = example[..., :length]
-				example = F.pad(example, (0, length - example.shape[-1]))
-			return example
+		name, index = self._locate(index)
+		meta = self.metadata[name]
+		num_frames = -1
+		offset = 0
+		if self.segment is not None:
+			offset = int(meta['samplerate'] * self.shift * index)
+			num_frames = int(math.ceil(meta['samplerate'] * self.segment))
+		wavs = []
+		for source in self.sources:
+			wav = self._read(self.get_file(name, source), offset, num_frames)
+			wav = convert_audio_channels(wav, self.channels)
+			wavs.append(wav)
+
+		example = th.stack(wavs)
+		example = julius.resample.resample_frac(example, meta['samplerate'], self.samplerate)
+		if self.normalize:
+			example = (example - meta['mean']) / meta['std']
+		if self.segment:
+			length = int(self.segment * self.samplerate)
+			example = example[..., :length]
+			example = F.pad(example, (0, length - example.shape[-1]))
+		return example
 
 
 def get_wav_datasets(args):
 	"""Extract the wav datasets from the XP arguments."""
 	sig = hashlib.sha1(str(args.wav).encode()).hexdigest()[:8]
-	metadata_file = Path(args.metadata) / ('wav_' + sig + ".json")
+	cache_file = Path(args.metadata) / ('wav_' + sig + ".json")
 	train_path = Path(args.wav) / "train"
 	valid_path = Path(args.wav) / "valid"
-	if not metadata_file.is_file() and accelerator.is_main_process:
-		metadata_file.parent.mkdir(exist_ok=True, parents=True)
-		train = build_metadata(train_path, args.sources)
-		valid = build_metadata(valid_path, args.sources)
-		metadata_file.write_text(json.dumps([train, valid]))
+	cache = [{}, {}]
+	if cache_file.is_file():
+		cache = json.loads(cache_file.read_text())
+	# Each rank updates the entries of its share of the tracks, the main one writes them all.
+	workers = args.get('metadata_workers', 8)
+	shares = gather_object([[update_metadata(split_path, args.sources, split_cache, workers=workers,
+											 rank=accelerator.process_index, world_size=accelerator.num_processes)
+							 for split_path, split_cache in zip([train_path, valid_path], cache)]])
+	cache_updated = [dict(sorted(item for share in shares for item in share[split].items())) for split in range(2)]
+	if accelerator.is_main_process and cache_updated != cache:
+		cache_file.parent.mkdir(exist_ok=True, parents=True)
+		# Written under a temporary name, an interrupted run does not leave a partial cache.
+		temporary = cache_file.with_suffix('.tmp.json')
+		temporary.write_text(json.dumps(cache_updated))
+		temporary.replace(cache_file)
 	accelerator.wait_for_everyone()
 
-	train, valid = json.loads(metadata_file.read_text())
+	train, valid = [{name: meta for name, (key, meta) in entries.items()} for entries in cache_updated]
 	kw_cv = {}
 
 	train_set = Wavset(train_path, train, args.sources,
@@ -0,0 +1,86 @@
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+class Workspace:
+	"""
+	Intermediate buffers of an `SCNet` forward pass, reused by the calls with the same input shape.
+
+	`apply_model` calls the model with the same chunk shape again and again, so the buffers are
+	planned by the first call of each input shape and the next calls write into them instead of
+	allocating. A buffer is named after its role, and the tensors of one role are never alive at
+	the same time, e.g. the outputs of the `SUlayer`s, so they share the memory of the largest.
+	The buffers of the `shapes` most recent input shapes are kept, e.g. for full chunks and for
+	the last chunk of a track, and each thread has its own, as `apply_model` may call the model
+	from several threads.
+
+	Args:
+		shapes (int): number of input shapes whose buffers are kept.
+	"""
+	def __init__(self, shapes=2):
+		self.shapes = shapes
+		self.local = threading.local()
+
+	def begin(self, shape):
+		"""Select the buffers of the input `shape`, called at the start of each forward pass."""
+		plans = self.local.__dict__.setdefault('plans', OrderedDict())
+		shape = tuple(shape)
+		if shape in plans:
+			plans.move_to_end(shape)
+		else:
+			plans[shape] = {}
+			while len(plans) > self.shapes:
+				plans.popitem(last=False)
+		self.local.plan = plans[shape]
+
+	def get(self, name, shape, dtype, device):
+		"""A tensor of `shape` in the buffer `name`, which grows to the largest shape asked for."""
+		if not hasattr(self.local, 'plan'):
+			self.begin(())
+		key = (name, dtype, device)
+		numel = 1
+		for size in shape:
+			numel *= size
+		plan = self.local.plan
+		if key not in plan or plan[key].numel() < numel:
+			plan[key] = torch.empty(numel, dtype=dtype, device=device)
+		return plan[key][:numel].view(shape)
+
+	@property
+	def size(self):
+		"""Bytes held by the buffers of this thread."""
+		plans = self.local.__dict__.get('plans', {})
+		return sum(buffer.numel() * buffer.element_size() for plan in plans.values() for buffer in plan.values())
+
+	def __getstate__(self):
+		# Buffers are not copied to other processes.
+		return {'shapes': self.shapes}
+
+	def __setstate__(self, state):
+		self.__init__(**state)
+
+def workspace_buffer(module, name, shape, like, dtype=None):
+	"""
+	A tensor of `shape` in the buffer `name` of the workspace of `module`, with the device and dtype of `like` unless
+	`dtype` is given. None if the module has no workspace or if gradients are enabled, as the
+	buffers are written by `out=` and in-place operations.
+	"""
+	workspace = getattr(module, 'workspace', None)
+	if workspace is None or torch.is_grad_enabled():
+		return None
+	return workspace.get(name, shape, dtype or like.dtype, like.device)
+
+def workspace_empty(module, name, shape, like, dtype=None):
+	"""`workspace_buffer`, or a new tensor if there is none."""
+	buffer = workspace_buffer(module, name, shape, like, dtype)
+	if buffer is None:
+		buffer = like.new_empty(shape, dtype=dtype)
+	return buffer
+
+def use_workspace(model, workspace):
+	"""Give `workspace`, a `Workspace` or None to disable it, to `model` and all its submodules."""
+	for module in model.modules():
+		module.workspace = workspace
+	return model
@@ -0,0 +1,23 @@
+from hhSCNet.SCNet import SCNet
+import pytest
+import torch
+
+samplerate = 44100
+
+@pytest.fixture(scope="session")
+def configSmall():
+	"""The keyword arguments of a small SCNet."""
+	return {'dims': [4, 8, 16, 32], 'num_dplayer': 2}
+
+@pytest.fixture(scope="module")
+def modelSmall(configSmall):
+	"""A small, randomly initialized SCNet, one per test module."""
+	torch.manual_seed(0)
+	return SCNet(**configSmall).eval()
+
+@pytest.fixture(scope="module")
+def listMixtures():
+	"""Two mixtures whose last chunks have different lengths."""
+	generator = torch.Generator().manual_seed(1)
+	return [torch.randn(1, 2, samplerate * 3 + 3000, generator=generator),
+			torch.randn(1, 2, samplerate * 2 + 5000, generator=generator)]
@@ -0,0 +1,129 @@
+from hhSCNet.SCNet import SCNet
+from hhSCNet.utils import fold_fusion_layers
+from hhSCNet.workspace import Workspace, use_workspace
+import copy
+import math
+import pytest
+import torch
+import torch.nn.functional as F
+
+@pytest.mark.parametrize("Fr", [2049, 616, 100])
+def test_sdlayer_matches_padded_bands(modelSmall, Fr):
+	"""The planned band split gives the output of padding and convolving every band separately."""
+	sd_layer = modelSmall.encoder[0].SDlayer
+	x = torch.randn(2, 4, Fr, 7)
+	edges = [0, math.ceil(Fr * sd_layer.SR_low), math.ceil(Fr * (sd_layer.SR_low + sd_layer.SR_mid)), Fr]
+	with torch.no_grad():
+		outputs, lengths = sd_layer(x)
+		for conv, stride, kernel, start, end, output in zip(sd_layer.convs, sd_layer.strides, sd_layer.kernels,
+															edges[:-1], edges[1:], outputs):
+			total_padding = kernel - stride if stride == 1 else (stride - (end - start) % stride) % stride
+			expected = conv(F.pad(x[:, :, start:end], (0, 0, total_padding // 2, total_padding - total_padding // 2)))
+			assert torch.equal(output, expected)
+	assert lengths == [end - start for start, end in zip(edges[:-1], edges[1:])]
+
+def test_training_backward(configSmall):
+	"""A training step of SCNet runs its backward pass and gives gradients to every parameter."""
+	torch.manual_seed(0)
+	model = SCNet(**configSmall).train()
+	model(torch.randn(2, 2, 44100)).square().mean().backward()
+	assert all(parameter.grad is not None for parameter in model.parameters())
+
+def test_sdblock_inference_layout_matches_training_layout(modelSmall):
+	"""The channels-last inference path of SDblock gives the output of the training path."""
+	block = modelSmall.encoder[0]
+	x = torch.randn(2, 4, 300, 9)
+	with torch.no_grad():
+		block.train()
+		expected = block(x)
+		block.eval()
+		output = block(x)
+	assert torch.allclose(output[0], expected[0], atol=1e-5)
+	assert torch.allclose(output[1], expected[1], atol=1e-5)
+	assert output[2:] == expected[2:]
+
+def test_folded_fusion_layer(modelSmall):
+	"""A folded FusionLayer gives the output of the original one, leaves its inputs alone and loads unfolded weights."""
+	fusion_layer = modelSmall.decoder[0][0]
+	folded = copy.deepcopy(fusion_layer).fold()
+	assert folded.conv.weight.shape[1] == fusion_layer.conv.weight.shape[1] // 2
+	x = torch.randn(2, 32, 12, 9)
+	skip = torch.randn(2, 32, 12, 9)
+	x_before = x.clone()
+	with torch.no_grad():
+		expected = fusion_layer(x, skip)
+		assert torch.allclose(folded(x, skip), expected, atol=1e-5)
+		assert torch.equal(x, x_before)
+		folded.conv.weight.zero_()
+		folded.load_state_dict(fusion_layer.state_dict())
+		assert torch.allclose(folded(x, skip), expected, atol=1e-5)
+
+def test_folded_fusion_layer_state_dict(modelSmall):
+	"""The checkpoint of a folded model holds unfolded weights, which load into unfolded and folded models alike."""
+	folded = fold_fusion_layers(copy.deepcopy(modelSmall))
+	state = folded.state_dict()
+	assert state['decoder.0.0.conv.weight'].shape == modelSmall.state_dict()['decoder.0.0.conv.weight'].shape
+	unfolded = copy.deepcopy(modelSmall)
+	refolded = fold_fusion_layers(copy.deepcopy(modelSmall))
+	for model in [unfolded, refolded]:
+		for parameter in model.parameters():
+			parameter.data.zero_()
+		model.load_state_dict(state)
+	mix = torch.randn(1, 2, 20000, generator=torch.Generator().manual_seed(0))
+	with torch.no_grad():
+		expected = folded(mix)
+		assert torch.allclose(unfolded(mix), expected, atol=1e-5)
+		assert torch.equal(refolded(mix), expected)
+
+@pytest.mark.parametrize("mkldnn", [True, False])
+def test_separation_net_inference_matches_training(modelSmall, mkldnn):
+	"""The inference path of SeparationNet, with or without the oneDNN LSTM layers, gives the output of the training path."""
+	separation_net = modelSmall.separation_net
+	x = torch.randn(2, 32, 5, 12)
+	with torch.no_grad(), torch.backends.mkldnn.flags(enabled=mkldnn):
+		separation_net.train()
+		expected = separation_net(x)
+		separation_net.eval()
+		output = separation_net(x)
+	assert output.shape == expected.shape
+	assert torch.allclose(output, expected, atol=1e-5)
+
+def test_eval_with_gradients(modelSmall):
+	"""An SCNet in eval mode still runs, and is differentiable, with gradients enabled."""
+	output = modelSmall(torch.randn(1, 2, 44100))
+	assert output.requires_grad
+
+def test_workspace_reuses_buffers(configSmall):
+	"""With a workspace, SCNet gives the same output, reuses its buffers for the same input shape and keeps its outputs apart."""
+	torch.manual_seed(0)
+	model = SCNet(**configSmall).eval()
+	workspace_model = use_workspace(copy.deepcopy(model), Workspace(shapes=1))
+	x = torch.randn(2, 2, 44100)
+	with torch.no_grad():
+		expected = model(x)
+		first = workspace_model(x)
+		size = workspace_model.workspace.size
+		copied = first.clone()
+		second = workspace_model(x)
+		assert workspace_model.workspace.size == size
+		workspace_model(torch.randn(1, 2, 30000))
+	assert torch.allclose(first, expected, atol=1e-5)
+	assert torch.equal(first, copied)
+	assert torch.equal(second, first)
+	assert workspace_model.workspace.size != size
+
+def test_recompute_matches_saved_activations(configSmall):
+	"""Recomputing the activations of every stage gives the gradients of saving them."""
+	torch.manual_seed(0)
+	model = SCNet(**configSmall).train()
+	mix = torch.randn(2, 2, 44100)
+	gradients = []
+	for stages in [[], SCNet.stages]:
+		model.set_recompute(stages)
+		model.zero_grad()
+		model(mix).square().mean().backward()
+		gradients.append([parameter.grad for parameter in model.parameters()])
+	for saved, recomputed in zip(*gradients):
+		torch.testing.assert_close(recomputed, saved)
+	with pytest.raises(ValueError):
+		model.set_recompute(['bottleneck'])
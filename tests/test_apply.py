@@ -0,0 +1,92 @@
+from hhSCNet import apply
+from hhSCNet.apply import ChunkScheduler, apply_model
+from hhSCNet.streaming import StreamingSeparator
+import math
+import pytest
+import types
+import torch
+
+@pytest.mark.parametrize("batch_size", [2, 3])
+def test_apply_model_batched_matches_per_chunk(modelSmall, listMixtures, batch_size):
+	"""Batched chunks give the same output as one model call per chunk."""
+	mix = listMixtures[0]
+	expected = apply_model(modelSmall, mix, shifts=0, segment=1, overlap=0.5)
+	actual = apply_model(modelSmall, mix, shifts=0, segment=1, overlap=0.5, batch_size=batch_size)
+	assert torch.allclose(actual, expected, atol=1e-5)
+
+def test_chunk_scheduler_across_tracks(modelSmall, listMixtures):
+	"""Chunks from several tracks share batches and each output goes back to its own track."""
+	expected = [apply_model(modelSmall, mix, shifts=0, segment=1, overlap=0.5) for mix in listMixtures]
+	scheduler = ChunkScheduler(modelSmall, batch_size=4, max_tracks=1, shifts=0, segment=1, overlap=0.5)
+	finished = []
+	for index, mix in enumerate(listMixtures):
+		finished += scheduler.submit(mix, key=index)
+	finished += scheduler.flush()
+	assert [key for key, _ in finished] == [0, 1]
+	for (_, actual), reference in zip(finished, expected):
+		assert torch.allclose(actual, reference, atol=1e-5)
+
+def test_chunk_scheduler_batches_random_shifts(modelSmall, listMixtures):
+	"""Chunks with random shifts have one input length per chunk length, so they fill whole batches."""
+	calls = []
+	def record(module, inputs):
+		calls.append(inputs[0].shape[0])
+	handle = modelSmall.register_forward_pre_hook(record)
+	try:
+		scheduler = ChunkScheduler(modelSmall, batch_size=4, shifts=2, segment=1, overlap=0.5)
+		mix = listMixtures[0]
+		(_, out), = scheduler.submit(mix) + scheduler.flush()
+	finally:
+		handle.remove()
+	lengths = [min(scheduler.segment, mix.shape[-1] - offset) for offset in range(0, mix.shape[-1], scheduler.stride)]
+	assert len(calls) == sum(math.ceil(2 * lengths.count(length) / 4) for length in set(lengths))
+	assert out.shape == (1, len(modelSmall.sources), 2, mix.shape[-1])
+
+def test_streaming_separator_matches_apply_model(modelSmall, listMixtures):
+	"""Blocks pushed through the stream give the same output as separating the whole mixture."""
+	mix = listMixtures[0]
+	expected = apply_model(modelSmall, mix, shifts=0, segment=1, overlap=0.5)[0]
+	streaming = StreamingSeparator(modelSmall, segment=1, overlap=0.5, mean=0, std=1)
+	blocks = []
+	for start in range(0, mix.shape[-1], 10000):
+		blocks.append(streaming.push(mix[0, :, start:start + 10000]))
+	blocks.append(streaming.flush())
+	actual = torch.cat(blocks, dim=-1)
+	assert actual.shape == expected.shape
+	assert torch.allclose(actual, expected, atol=1e-5)
+
+def test_streaming_separator_running_statistics(modelSmall, listMixtures):
+	"""The running statistics equal the statistics of the whole mono mixture."""
+	mix = listMixtures[1][0]
+	streaming = StreamingSeparator(modelSmall, segment=1, overlap=0.5)
+	for start in range(0, mix.shape[-1], 7000):
+		streaming.push(mix[:, start:start + 7000])
+	mean, std = streaming._statistics()
+	mono = mix.mean(0)
+	assert mean == pytest.approx(mono.mean().item(), abs=1e-6)
+	assert std == pytest.approx(mono.std().item(), rel=1e-5)
+
+def test_chunk_scheduler_memmap(modelSmall, listMixtures, tmp_path):
+	"""Overlap-adding into memory-mapped files gives the same output as in memory."""
+	mix = listMixtures[1]
+	expected = apply_model(modelSmall, mix, shifts=0, segment=1, overlap=0.5)
+	actual = apply_model(modelSmall, mix, shifts=0, segment=1, overlap=0.5, memmap_dir=tmp_path)
+	assert torch.allclose(actual, expected, atol=1e-5)
+
+@pytest.mark.parametrize("shifts", [1, 3])
+def test_apply_model_deterministic_shifts(modelSmall, listMixtures, shifts):
+	"""Evenly spaced shifts are reproducible and the batched path matches the per-chunk path."""
+	mix = listMixtures[0]
+	expected = apply_model(modelSmall, mix, shifts=shifts, segment=1, overlap=0.5, deterministic_shifts=True)
+	again = apply_model(modelSmall, mix, shifts=shifts, segment=1, overlap=0.5, deterministic_shifts=True)
+	batched = apply_model(modelSmall, mix, shifts=shifts, segment=1, overlap=0.5, deterministic_shifts=True, batch_size=4)
+	assert torch.equal(again, expected)
+	assert torch.allclose(batched, expected, atol=1e-5)
+
+@pytest.mark.parametrize("batch_size", [1, 2])
+def test_apply_model_runs_on_the_given_device(modelSmall, listMixtures, monkeypatch, batch_size):
+	"""The `device` argument wins over the device of the accelerator, with and without the scheduler."""
+	expected = apply_model(modelSmall, listMixtures[1], shifts=0, segment=1, overlap=0.5)
+	monkeypatch.setattr(apply, 'accelerator', types.SimpleNamespace(device=torch.device('meta'), unwrap_model=lambda model: model))
+	actual = apply_model(modelSmall, listMixtures[1], shifts=0, segment=1, overlap=0.5, device='cpu', batch_size=batch_size)
+	assert torch.allclose(actual, expected, atol=1e-5)
@@ -0,0 +1,73 @@
+from hhSCNet import augment
+from hhSCNet.augment import augment_together
+from hhSCNet.distill import DistillationSet, precompute_teacher
+from hhSCNet.packed import PackedSet, pack_dataset
+from hhSCNet.wav import MIXTURE, Wavset, build_metadata
+import numpy as np
+import pytest
+import soundfile as sf
+import torch
+
+class ScalingTeacher(torch.nn.Module):
+	"""A teacher whose estimate of each source is the mixture times a scale of its own."""
+	sources = ['bass', 'drums']
+
+	def __init__(self):
+		super().__init__()
+		self.register_buffer('scales', torch.tensor([0.5, 2.]))
+
+	def forward(self, mix):
+		return mix[:, None] * self.scales[:, None, None]
+
+@pytest.fixture(scope="module")
+def pathDataset(tmp_path_factory):
+	"""Two tracks of 2.5 s and 1 s at 100 Hz, with a noisy mixture and two sources. Returns the path and the metadata."""
+	path = tmp_path_factory.mktemp("distill")
+	rng = np.random.default_rng(0)
+	for name, seconds in [('a', 2.5), ('b', 1)]:
+		(path / name).mkdir()
+		for source in ['bass', 'drums', 'mixture']:
+			sf.write(path / name / f'{source}.wav', rng.uniform(-0.5, 0.5, (int(seconds * 100), 2)) + 0.1, 100, subtype='FLOAT')
+	return path, build_metadata(path, ['bass', 'drums'], workers=0)
+
+def test_augment_together_draws_the_same_augmentation():
+	"""The sources and the teacher estimates of a batch get the same shifts, flips, scales and remix."""
+	augmentation = torch.nn.Sequential(augment.Shift(4410), augment.FlipChannels(), augment.FlipSign(),
+									   augment.Scale(), augment.Remix(group_size=4))
+	sources = torch.randn(8, 4, 2, 44100)
+	teacher = sources.clone()
+	sources, teacher = augment_together(augmentation, sources, teacher)
+	torch.testing.assert_close(teacher, sources)
+
+@pytest.mark.parametrize("packed", [False, True])
+def test_distillation_set_targets_line_up(pathDataset, tmp_path, packed):
+	"""Each example is followed by the teacher estimates of the mixture of the same extract, for WAV and packed datasets."""
+	path, metadata = pathDataset
+	dataset = Wavset(path, metadata, ['bass', 'drums'], segment=1, shift=0.5, samplerate=100)
+	mixtures = Wavset(path, metadata, [MIXTURE], segment=1, shift=0.5, samplerate=100)
+	if packed:
+		pack_dataset(dataset, tmp_path / 'packed', 'float16')
+		dataset = PackedSet(tmp_path / 'packed', ['bass', 'drums'], segment=1, shift=0.5)
+		mixtures = PackedSet(tmp_path / 'packed', [MIXTURE], segment=1, shift=0.5)
+	precompute_teacher(ScalingTeacher(), dataset, tmp_path / 'teacher', segment=1)
+	for name, meta in metadata.items():
+		estimates = [sf.read(tmp_path / 'teacher' / name / f'{source}.wav', dtype='float32')[0] for source in ['bass', 'drums']]
+		assert all(estimate.shape == (meta['length'], 2) for estimate in estimates)
+	distillation = DistillationSet(dataset, tmp_path / 'teacher')
+	assert len(distillation) == len(dataset)
+	for index in range(len(dataset)):
+		example = distillation[index]
+		torch.testing.assert_close(example[:2], dataset[index])
+		expected = mixtures[index][0] * ScalingTeacher().scales[:, None, None]
+		torch.testing.assert_close(example[2:], expected, atol=1e-5, rtol=1e-5)
+
+def test_precompute_teacher_keeps_written_tracks(pathDataset, tmp_path):
+	"""Tracks whose estimates are already written are not separated again."""
+	path, metadata = pathDataset
+	dataset = Wavset(path, metadata, ['bass', 'drums'], segment=1, shift=0.5, samplerate=100)
+	precompute_teacher(ScalingTeacher(), dataset, tmp_path, segment=1)
+	written = {file: file.stat().st_mtime_ns for file in tmp_path.rglob('*.wav')}
+	(tmp_path / 'b' / 'drums.wav').unlink()
+	precompute_teacher(ScalingTeacher(), dataset, tmp_path, segment=1)
+	assert all(file.stat().st_mtime_ns == mtime for file, mtime in written.items() if file.parent.name == 'a')
+	assert (tmp_path / 'b' / 'drums.wav').is_file()
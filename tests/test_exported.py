@@ -0,0 +1,20 @@
+from hhSCNet.exported import export_model, load_exported
+import torch
+import torch.nn.functional as F
+
+samplerate = 44100
+
+def test_exported_model_matches_eager(modelSmall, listMixtures, tmp_path):
+	"""A reloaded program gives the eager output of full chunks, and of short chunks padded with zeros."""
+	path = tmp_path / 'scnet.pt2'
+	export_model(modelSmall, path, samplerate, max_batch=4)
+	exported = load_exported(path)
+	assert exported.sources == modelSmall.sources
+	full = listMixtures[0][..., :samplerate].repeat(3, 1, 1)
+	short = listMixtures[1][..., :samplerate // 3]
+	with torch.no_grad():
+		assert torch.allclose(exported(full), modelSmall(full), atol=1e-4)
+		expected = modelSmall(F.pad(short, (0, samplerate - short.shape[-1])))[..., :short.shape[-1]]
+		actual = exported(short)
+	assert actual.shape == (1, len(modelSmall.sources), 2, samplerate // 3)
+	assert torch.allclose(actual, expected, atol=1e-4)
@@ -0,0 +1,199 @@
+from hhSCNet import compiled as compiled_module
+from hhSCNet.apply import apply_model
+from hhSCNet.compiled import CompiledModel
+from hhSCNet.inference import BackgroundWriter, Separator, encodings, parse_stems, save_stems
+from hhSCNet.quantize import quantize_model
+from hhSCNet.SCNet import SCNet
+from hhSCNet.utils import new_sdr
+import copy
+import numpy as np
+import os
+import pytest
+import soundfile as sf
+import torch
+
+samplerate = 44100
+
+class CrashingSeparator(Separator):
+	"""Exits without a word on the tracks named `crash`, as a worker killed by the system would."""
+	def process_track(self, mixture_path, save_dir):
+		if os.path.basename(mixture_path) == 'crash.wav':
+			os._exit(9)
+
+@pytest.fixture
+def pathCheckpoint(modelSmall, tmp_path):
+	"""A checkpoint of the small model."""
+	path = tmp_path / 'checkpoint.th'
+	torch.save({'best_state': modelSmall.state_dict()}, path)
+	return path
+
+sources = ['drums', 'bass', 'other', 'vocals']
+
+def test_parse_stems():
+	"""Sources, derived mixes and the predefined instrumental, in the order given."""
+	assert parse_stems('', sources) == {source: [source] for source in sources}
+	assert parse_stems('vocals, karaoke = drums+bass , instrumental', sources) == {
+		'vocals': ['vocals'], 'karaoke': ['drums', 'bass'], 'instrumental': ['drums', 'bass', 'other']}
+
+@pytest.mark.parametrize("stems, message", [
+	('vocals,guitar', "Invalid stem 'guitar'"),
+	('karaoke=drums+piano', "Invalid stem 'karaoke=drums\\+piano'"),
+	('karaoke=drums+', "Invalid stem 'karaoke=drums\\+'"),
+	('=drums+bass', "Invalid stem '=drums\\+bass'"),
+	('vocals,,bass', "Invalid stem ''"),
+	('vocals,bass,vocals', "Stem 'vocals' is given twice"),
+	('mix=drums+bass,mix=other', "Stem 'mix' is given twice"),
+])
+def test_parse_stems_errors(stems, message):
+	"""Unknown sources, empty names and duplicate stems are refused."""
+	with pytest.raises(ValueError, match=message):
+		parse_stems(stems, sources)
+
+@pytest.mark.parametrize("encoding", list(encodings))
+@pytest.mark.parametrize("multistem", [False, True])
+def test_save_stems(tmp_path, encoding, multistem):
+	"""The stems read back as written, up to the precision of the encoding, and no temporary file is left."""
+	rng = np.random.default_rng(0)
+	stems = {'vocals': rng.uniform(-0.9, 0.9, (1000, 2)).astype(np.float32),
+			 'bass': rng.uniform(-0.9, 0.9, (1000, 2)).astype(np.float32)}
+	stems['bass'][0] = 1.5
+	save_stems(stems, {'vocals': 100, 'bass': 100}, tmp_path, encoding, multistem, block=300)
+	extension = encodings[encoding][0]
+	files = {'stems': np.concatenate(list(stems.values()), axis=1)} if multistem else stems
+	assert sorted(os.listdir(tmp_path)) == sorted(f'{name}{extension}' for name in files)
+	precision = 2e-4 if encodings[encoding][2] == 'PCM_16' else 1e-6
+	for name, expected in files.items():
+		data, samplerate = sf.read(tmp_path / f'{name}{extension}', dtype='float32')
+		assert samplerate == 100
+		if encoding != 'float':
+			expected = expected.clip(-1, 1)
+		np.testing.assert_allclose(data, expected, atol=precision)
+
+@pytest.mark.parametrize("prefetch, writers", [(1, 1), (3, 3)])
+def test_process_directory_matches_process_track(configSmall, pathCheckpoint, listMixtures, tmp_path, prefetch, writers):
+	"""The pipelined directory writes the stems that separating each track on its own writes."""
+	(tmp_path / 'input').mkdir()
+	for index, mix in enumerate(listMixtures):
+		sf.write(tmp_path / 'input' / f'{index}.wav', 0.1 * mix[0].T.numpy(), samplerate, subtype='FLOAT')
+	separator = Separator(SCNet(**configSmall), pathCheckpoint, shifts=0, prefetch=prefetch, writers=writers,
+						  write_queue=writers, encoding='float')
+	separator.process_directory(tmp_path / 'input', tmp_path / 'directory')
+	for index in range(len(listMixtures)):
+		separator.process_track(str(tmp_path / 'input' / f'{index}.wav'), tmp_path / 'track' / str(index))
+		assert sorted(os.listdir(tmp_path / 'directory' / str(index))) == sorted(os.listdir(tmp_path / 'track' / str(index)))
+		for name in os.listdir(tmp_path / 'track' / str(index)):
+			expected, _ = sf.read(tmp_path / 'track' / str(index) / name)
+			actual, _ = sf.read(tmp_path / 'directory' / str(index) / name)
+			np.testing.assert_allclose(actual, expected, atol=1e-5)
+
+def test_background_writer_raises_the_error_of_a_write():
+	"""An exception raised by a write job surfaces from `close`, after the other jobs ran."""
+	written = []
+	def write(name):
+		if name == 'broken':
+			raise OSError("disk full")
+		written.append(name)
+	writer = BackgroundWriter(workers=2, depth=4)
+	for name in ['a', 'broken', 'b']:
+		writer.submit(write, name)
+	with pytest.raises(OSError, match="disk full"):
+		writer.close()
+	assert sorted(written) == ['a', 'b']
+
+def test_parallel_inference_survives_a_dead_worker(configSmall, pathCheckpoint, tmp_path):
+	"""A worker that dies without reporting its track fails the run instead of hanging it. The results it had not sent yet are lost with it."""
+	(tmp_path / 'input').mkdir()
+	for name in ['crash', 'a', 'b']:
+		(tmp_path / 'input' / f'{name}.wav').touch()
+	separator = CrashingSeparator(SCNet(**configSmall), pathCheckpoint)
+	with pytest.raises(RuntimeError, match="of 3 tracks could not be separated"):
+		separator.process_directory_parallel(tmp_path / 'input', tmp_path / 'output', workers=2)
+
+def test_compiled_batch_follows_the_path(configSmall, pathCheckpoint, tmp_path, monkeypatch):
+	"""The model is compiled for the batches of the scheduler in process_directory, and of the shifts in separate_mix."""
+	monkeypatch.setattr(torch, 'compile', lambda function, **kwargs: function)
+	(tmp_path / 'input').mkdir()
+	sf.write(tmp_path / 'input' / 'a.wav', np.random.default_rng(0).uniform(-0.5, 0.5, (20000, 2)), 44100)
+	separator = Separator(SCNet(**configSmall), pathCheckpoint, shifts=2, compiled=True)
+	separator.process_directory(tmp_path / 'input', tmp_path / 'output')
+	assert separator.separator.shape[0] == 1
+	mix, _ = separator.load_mix(tmp_path / 'input' / 'a.wav')
+	separator.separate_mix(mix)
+	assert separator.separator.shape[0] == 2
+
+def test_compiled_batch_with_memmap(configSmall, pathCheckpoint, tmp_path, monkeypatch):
+	"""With memory-mapped buffers, separate_mix goes through the scheduler, so the shifts are not stacked."""
+	monkeypatch.setattr(torch, 'compile', lambda function, **kwargs: function)
+	sf.write(tmp_path / 'a.wav', np.random.default_rng(0).uniform(-0.5, 0.5, (20000, 2)), 44100)
+	(tmp_path / 'memmap').mkdir()
+	separator = Separator(SCNet(**configSmall), pathCheckpoint, shifts=2, compiled=True, memmap_dir=tmp_path / 'memmap')
+	mix, _ = separator.load_mix(tmp_path / 'a.wav')
+	assert separator.separate_mix(mix).shape == (4, 2, 20000)
+	assert separator.separator.shape[0] == 1
+
+def test_separator_static_quantization(configSmall, pathCheckpoint, tmp_path):
+	"""A Separator loads a checkpoint, quantizes it calibrated on a directory of tracks and separates."""
+	(tmp_path / 'calibration').mkdir()
+	sf.write(tmp_path / 'calibration' / 'a.wav', np.random.default_rng(0).uniform(-0.5, 0.5, (20000, 2)), 44100)
+	separator = Separator(SCNet(**configSmall), pathCheckpoint, shifts=0, quantize='static',
+						  calibration=tmp_path / 'calibration', calibration_tracks=1)
+	assert separator.device.type == 'cpu'
+	mix, _ = separator.load_mix(tmp_path / 'calibration' / 'a.wav')
+	assert separator.separate_mix(mix).shape == (4, 2, 20000)
+
+def test_separator_rejects_wide_flac(configSmall, pathCheckpoint):
+	"""A multistem FLAC file wider than FLAC allows is refused before any track is separated."""
+	stems = 'drums,bass,other,vocals,karaoke=drums+bass+other'
+	with pytest.raises(ValueError, match="at most 8 channels"):
+		Separator(SCNet(**configSmall), pathCheckpoint, stems=stems, encoding='flac', multistem=True)
+	Separator(SCNet(**configSmall), pathCheckpoint, stems=stems, encoding='wav', multistem=True)
+	Separator(SCNet(**configSmall), pathCheckpoint, encoding='flac', multistem=True)
+
+def test_compiled_model_dispatch(modelSmall, listMixtures, monkeypatch):
+	"""Full chunks, padded to the compiled batch, go through the compiled function and the rest runs eagerly."""
+	calls = []
+	def compile_recording(function, **kwargs):
+		def compiled(x):
+			calls.append(tuple(x.shape))
+			return function(x)
+		return compiled
+	monkeypatch.setattr(torch, 'compile', compile_recording)
+	compiled = CompiledModel(modelSmall, (3, 2, samplerate))
+	mix = listMixtures[0]
+	expected = apply_model(modelSmall, mix, shifts=0, segment=1, overlap=0.5, batch_size=2)
+	actual = apply_model(compiled, mix, shifts=0, segment=1, overlap=0.5, batch_size=2)
+	assert torch.allclose(actual, expected, atol=1e-5)
+	assert set(calls) == {(3, 2, samplerate)}
+
+def test_compiled_model_falls_back_to_eager(modelSmall, listMixtures, monkeypatch):
+	"""A model that cannot be compiled runs in eager mode."""
+	def compile_failing(function, **kwargs):
+		raise RuntimeError("no compiler")
+	monkeypatch.setattr(torch, 'compile', compile_failing)
+	compiled = CompiledModel(modelSmall, (1, 2, samplerate))
+	assert compiled.compiled is None
+	mix = listMixtures[1][..., :samplerate]
+	with torch.no_grad():
+		assert torch.equal(compiled(mix), modelSmall(mix))
+
+@pytest.mark.parametrize("artifacts", [False, True])
+def test_compiled_model_without_cache_artifacts(modelSmall, monkeypatch, tmp_path, artifacts):
+	"""A compiled model is kept when torch cannot save its artifacts, or has no API for them."""
+	monkeypatch.setattr(torch, 'compile', lambda function, **kwargs: function)
+	monkeypatch.setattr(compiled_module, 'cache_artifacts', artifacts)
+	def save_failing():
+		raise RuntimeError("no artifacts")
+	monkeypatch.setattr(torch.compiler, 'save_cache_artifacts', save_failing)
+	compiled = CompiledModel(modelSmall, (1, 2, samplerate), cache_dir=str(tmp_path))
+	assert compiled.compiled is not None
+
+@pytest.mark.parametrize("static", [False, True])
+def test_quantize_model(modelSmall, listMixtures, static):
+	"""The int8 model stays close to the float32 model."""
+	mix = listMixtures[1][..., :samplerate]
+	quantized, chunks = quantize_model(copy.deepcopy(modelSmall), static=static, calibration=[mix])
+	assert chunks == (1 if static else 0)
+	with torch.no_grad():
+		expected = modelSmall(mix)
+		actual = quantized(mix)
+	assert new_sdr(expected, actual).min() > 10
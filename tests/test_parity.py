@@ -0,0 +1,56 @@
+from hhSCNet.parity import runParity, sdr
+from hhSCNet.utils import new_sdr
+import numpy as np
+import pytest
+import soundfile as sf
+import torch
+
+@pytest.fixture
+def pathTrack(tmp_path):
+	"""A track folder with a short mixture."""
+	path = tmp_path / 'track'
+	path.mkdir()
+	sf.write(path / 'mixture.wav', np.random.default_rng(0).uniform(-0.5, 0.5, (20000, 2)), 44100)
+	return path
+
+@pytest.fixture
+def pathConfiguration(configSmall, modelSmall, tmp_path):
+	"""A configuration with the small model and a checkpoint of it. Returns both paths."""
+	path = tmp_path / 'config.yaml'
+	path.write_text(f"model: {{dims: {configSmall['dims']}, num_dplayer: {configSmall['num_dplayer']}}}\n")
+	checkpoint = tmp_path / 'checkpoint.th'
+	torch.save({'best_state': modelSmall.state_dict()}, checkpoint)
+	return path, checkpoint
+
+@pytest.fixture
+def pathTrackWithSources(pathTrack):
+	"""The track folder with a WAV file per source."""
+	rng = np.random.default_rng(1)
+	for stem in ['drums', 'bass', 'other', 'vocals']:
+		sf.write(pathTrack / f'{stem}.wav', rng.uniform(-0.2, 0.2, (20000, 2)), 44100)
+	return pathTrack
+
+def test_sdr_is_new_sdr():
+	"""The SDR of one stem is the one of `new_sdr`."""
+	rng = np.random.default_rng(2)
+	reference = rng.uniform(-1, 1, (1000, 2)).astype(np.float32)
+	estimate = reference + rng.uniform(-0.1, 0.1, (1000, 2)).astype(np.float32)
+	expected = new_sdr(torch.from_numpy(reference)[None, None], torch.from_numpy(estimate)[None, None]).item()
+	assert sdr(reference, estimate) == pytest.approx(expected, rel=1e-5)
+
+def test_parity_precision(pathTrackWithSources, pathConfiguration):
+	"""A bfloat16 model separates the track close to float32, and is scored against the reference stems."""
+	modelConfiguration, checkpoint = pathConfiguration
+	report = runParity(str(pathTrackWithSources), str(modelConfiguration), str(checkpoint))
+	for stem in ['drums', 'bass', 'other', 'vocals']:
+		assert report[f'parity_{stem}'] > 20
+		assert abs(report[f'sdr_delta_{stem}']) < 0.1
+	assert report['MB bfloat16'] < report['MB float32']
+
+def test_parity_quantized(pathTrack, pathConfiguration):
+	"""The int8 model separates the track on the CPU and is compared with float32 on every stem."""
+	modelConfiguration, checkpoint = pathConfiguration
+	report = runParity(str(pathTrack), str(modelConfiguration), str(checkpoint), quantize='dynamic')
+	assert report['MB int8 dynamic'] < report['MB float32']
+	for stem in ['drums', 'bass', 'other', 'vocals']:
+		assert np.isfinite(report[f'parity_{stem}'])
@@ -0,0 +1,22 @@
+from hhSCNet.prune import prune_model
+from hhSCNet.SCNet import SCNet
+import pytest
+import torch
+
+def test_prune_nothing_keeps_the_model(modelSmall, configSmall):
+	"""Pruning no channel copies every weight to its place."""
+	pruned, config = prune_model(modelSmall, configSmall, 0)
+	assert config['dims'] == modelSmall.dims
+	mix = torch.randn(1, 2, 44100)
+	with torch.no_grad():
+		torch.testing.assert_close(pruned(mix), modelSmall(mix))
+
+def test_pruned_model_matches_its_config(modelSmall, configSmall):
+	"""The pruned model is the SCNet of its configuration, with fewer channels at each level."""
+	pruned, config = prune_model(modelSmall, configSmall, 0.5)
+	assert config['dims'] == [4, 4, 8, 16]
+	SCNet(**config).load_state_dict(pruned.state_dict())
+	with torch.no_grad():
+		assert pruned(torch.randn(1, 2, 44100)).shape == (1, 4, 2, 44100)
+	with pytest.raises(ValueError):
+		prune_model(modelSmall, configSmall, 1)
@@ -0,0 +1,107 @@
+from hhSCNet import loadModelConfigurationYaml, solver
+from hhSCNet.apply import apply_model
+from hhSCNet.loss import spec_rmse_loss
+from hhSCNet.SCNet import SCNet
+from hhSCNet.solver import Solver
+import copy
+import functools
+import pathlib
+import pytest
+import torch
+import types
+
+def _configuration(configSmall, batch=(), epoch=()):
+	"""The packaged configuration with the small model and the given EMA decays."""
+	config = loadModelConfigurationYaml(pathlib.Path(solver.__file__).parent / 'config.yaml')
+	config.model.update(configSmall)
+	config.ema.batch = list(batch)
+	config.ema.epoch = list(epoch)
+	return config
+
+def _solver(config, model, loaders, tmp_path):
+	optimizer = torch.optim.Adam(model.parameters())
+	return Solver(loaders, model, optimizer, config, types.SimpleNamespace(save_path=str(tmp_path)))
+
+@pytest.fixture
+def loadersValid():
+	"""A validation loader of three tracks of one second, mixture then sources."""
+	generator = torch.Generator().manual_seed(2)
+	tracks = [torch.randn(5, 2, 44100, generator=generator) for _ in range(3)]
+	return {'valid': torch.utils.data.DataLoader(tracks, batch_size=1)}
+
+@pytest.fixture(autouse=True)
+def applyWithoutShifts(monkeypatch):
+	"""The validation separates without random shifts, so passes can be compared."""
+	monkeypatch.setattr(solver, 'apply_model', functools.partial(apply_model, shifts=0))
+
+def test_validate_in_one_pass_matches_separate_passes(configSmall, loadersValid, tmp_path):
+	"""Validating the main model and every EMA in one pass gives the metrics of validating each alone."""
+	torch.manual_seed(0)
+	model = SCNet(**configSmall)
+	trainer = _solver(_configuration(configSmall, batch=[0.5], epoch=[0.8]), model, loadersValid, tmp_path)
+	# The EMAs keep the initial weights, the main model moves away from them.
+	with torch.no_grad():
+		for parameter in model.parameters():
+			parameter.add_(0.1 * torch.randn_like(parameter))
+	metrics = trainer._validate(0)
+	assert sorted(metrics) == ['ema_batch_0', 'ema_epoch_0', 'main']
+	assert metrics['main']['loss'] != pytest.approx(metrics['ema_batch_0']['loss'])
+	weights = {'main': model.state_dict(), 'ema_batch_0': trainer.emas['batch'][0].state,
+			   'ema_epoch_0': trainer.emas['epoch'][0].state}
+	for name, state in weights.items():
+		alone = SCNet(**configSmall)
+		alone.load_state_dict(state)
+		expected = _solver(_configuration(configSmall), alone, loadersValid, tmp_path)._validate(0)['main']
+		assert metrics[name].keys() == expected.keys()
+		for key, value in expected.items():
+			assert float(metrics[name][key]) == pytest.approx(float(value), rel=1e-5, abs=1e-6)
+
+@pytest.mark.parametrize("replicas", [False, True])
+def test_validate_swap_or_replicas(configSmall, loadersValid, tmp_path, replicas):
+	"""The EMAs validated by swapping their weights into the main model score as their replicas do."""
+	torch.manual_seed(0)
+	model = SCNet(**configSmall)
+	config = _configuration(configSmall, batch=[0.5])
+	config.ema.replicas = replicas
+	trainer = _solver(config, model, loadersValid, tmp_path)
+	with torch.no_grad():
+		for parameter in model.parameters():
+			parameter.add_(0.1 * torch.randn_like(parameter))
+	reference = copy.deepcopy(model.state_dict())
+	metrics = trainer._validate(0)
+	assert all(torch.equal(model.state_dict()[key], value) for key, value in reference.items())
+	replica = SCNet(**configSmall)
+	replica.load_state_dict(trainer.emas['batch'][0].state)
+	expected = _solver(_configuration(configSmall), replica, loadersValid, tmp_path)._validate(0)['main']
+	assert float(metrics['ema_batch_0']['nsdr']) == pytest.approx(float(expected['nsdr']), rel=1e-5)
+
+class ScalingTeacher(torch.nn.Module):
+	"""A teacher whose estimate of each source is the mixture times a scale of its own."""
+	def forward(self, mix):
+		return mix[:, None] * torch.tensor([0.5, 1., 1.5, 2.])[:, None, None]
+
+@pytest.mark.parametrize("cached", [False, True])
+def test_distillation_loss_mixes_both_targets(configSmall, tmp_path, cached):
+	"""The training loss is `(1 - weight)` times the loss to the sources plus `weight` times the loss to the teacher estimates, run each batch or cached."""
+	config = _configuration(configSmall)
+	config.distill.weight = 0.25
+	sources = torch.randn(1, 4, 2, 44100, generator=torch.Generator().manual_seed(3))
+	targets = ScalingTeacher()(sources.sum(dim=1))
+	if cached:
+		config.distill.teacher = 'teacher.th'
+		config.distill.cache = str(tmp_path / 'teacher')
+		examples, teacher = torch.cat([sources, targets], dim=1), None
+	else:
+		examples, teacher = sources, ScalingTeacher()
+	torch.manual_seed(0)
+	model = SCNet(**configSmall)
+	expected_model = copy.deepcopy(model)
+	loaders = {'train': torch.utils.data.DataLoader(examples, batch_size=1)}
+	optimizer = torch.optim.Adam(model.parameters())
+	trainer = Solver(loaders, model, optimizer, config, types.SimpleNamespace(save_path=str(tmp_path)), teacher=teacher)
+	trainer.augment = torch.nn.Sequential()
+	metrics = trainer._run_one_epoch(0)
+	estimate = expected_model(sources.sum(dim=1))
+	expected = 0.75 * spec_rmse_loss(estimate, sources, trainer.stft_config) + 0.25 * spec_rmse_loss(estimate, targets, trainer.stft_config)
+	assert float(metrics['loss']) == pytest.approx(expected.item(), rel=1e-5)
+	assert float(metrics['loss']) != pytest.approx(spec_rmse_loss(estimate, sources, trainer.stft_config).item(), rel=1e-3)
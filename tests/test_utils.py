@@ -0,0 +1,39 @@
+from hhSCNet.utils import convert_audio, convert_audio_blockwise, memmap_zeros, new_sdr, select_sources, set_precision
+import copy
+import pytest
+import torch
+
+@pytest.mark.parametrize("from_samplerate, to_samplerate, channels", [
+	(48000, 44100, 2),
+	(44100, 48000, 1),
+	(22050, 44100, 2),
+	(44100, 44100, 2),
+])
+def test_convert_audio_blockwise_matches_convert_audio(from_samplerate, to_samplerate, channels, tmp_path):
+	"""Converting one block at a time gives the same samples as converting the whole signal."""
+	wav = torch.randn(1, 54321, generator=torch.Generator().manual_seed(0))
+	expected = convert_audio(wav, from_samplerate, to_samplerate, channels)
+	out = memmap_zeros(expected.shape, tmp_path)
+	convert_audio_blockwise(lambda start, end: wav[..., start:end], wav.shape[-1],
+							from_samplerate, to_samplerate, channels, out, block=4000)
+	assert torch.allclose(out, expected, atol=1e-6)
+
+def test_select_sources_matches_full_model(modelSmall, listMixtures):
+	"""A model pruned to some sources outputs exactly those sources of the full model."""
+	mix = listMixtures[1]
+	pruned = select_sources(copy.deepcopy(modelSmall), ['vocals', 'drums'])
+	with torch.no_grad():
+		expected = modelSmall(mix)
+		actual = pruned(mix)
+	assert pruned.sources == ['vocals', 'drums']
+	assert torch.allclose(actual, expected[:, [modelSmall.sources.index('vocals'), modelSmall.sources.index('drums')]], atol=1e-5)
+
+def test_set_precision_bfloat16(modelSmall, listMixtures):
+	"""A bfloat16 network returns float32 audio close to the float32 network."""
+	mix = listMixtures[1]
+	reduced = set_precision(copy.deepcopy(modelSmall), 'bfloat16')
+	with torch.no_grad():
+		expected = modelSmall(mix)
+		actual = reduced(mix)
+	assert actual.dtype == torch.float32
+	assert new_sdr(expected, actual).min() > 20
@@ -0,0 +1,107 @@
+from hhSCNet.packed import PackedSet, pack_dataset
+from hhSCNet import wav
+from hhSCNet.wav import Wavset, _mixture_statistics, build_metadata, get_wav_datasets, update_metadata
+from ml_collections import config_dict
+import json
+import numpy as np
+import pytest
+import shutil
+import soundfile as sf
+import torch
+
+@pytest.fixture(scope="module")
+def pathDataset(tmp_path_factory):
+	"""Three tracks of 2.5 s, 1 s and 3 s, at 100 Hz, with a mixture and two sources whose samples count up from the start of the track."""
+	path = tmp_path_factory.mktemp("wavset")
+	metadata = {}
+	for name, seconds in [('a', 2.5), ('b', 1), ('c', 3)]:
+		(path / name).mkdir()
+		length = int(seconds * 100)
+		for index, source in enumerate(['bass', 'drums', 'mixture']):
+			ramp = (np.arange(length) + 1000 * index) / 2**12
+			sf.write(path / name / f'{source}.wav', np.stack([ramp, -ramp], 1), 100, subtype='FLOAT')
+		metadata[name] = {'length': length, 'mean': 0, 'std': 1, 'samplerate': 100}
+	return path, metadata
+
+@pytest.mark.parametrize("handles", [1, 64])
+def test_wavset_finds_each_example(pathDataset, handles):
+	"""Each index reads the extract of its track, at its offset, whatever the open files."""
+	path, metadata = pathDataset
+	dataset = Wavset(path, metadata, ['bass', 'drums'], segment=1, shift=0.5, samplerate=100, normalize=False,
+					 handles=handles)
+	assert dataset.num_examples == [4, 1, 5]
+	examples = [(name, index) for name, count in zip(metadata, dataset.num_examples) for index in range(count)]
+	assert len(dataset) == len(examples)
+	for index in [0, 3, 4, 5, 9, 2, 4]:
+		name, local = examples[index]
+		ramp = torch.arange(metadata[name]['length'], dtype=torch.float32)
+		track = torch.stack([torch.stack([ramp + 1000 * source, -ramp - 1000 * source]) for source in range(2)])
+		expected = track[..., 50 * local:50 * local + 100]
+		expected = torch.nn.functional.pad(expected, (0, 100 - expected.shape[-1]))
+		torch.testing.assert_close(dataset[index] * 2**12, expected)
+	with pytest.raises(IndexError):
+		dataset[len(dataset)]
+
+@pytest.mark.parametrize("dtype", ['int16', 'float16'])
+def test_packed_set_matches_wavset(pathDataset, tmp_path, dtype):
+	"""A packed dataset gives the examples of the Wavset it was packed from, up to its precision."""
+	path, metadata = pathDataset
+	dataset = Wavset(path, metadata, ['bass', 'drums'], segment=1, shift=0.5, samplerate=100, normalize=False)
+	pack_dataset(dataset, tmp_path, dtype)
+	packed = PackedSet(tmp_path, ['drums', 'bass'], segment=1, shift=0.5)
+	assert len(packed) == len(dataset)
+	for index in range(len(dataset)):
+		torch.testing.assert_close(packed[index], dataset[index][[1, 0]], atol=1e-3, rtol=1e-3)
+
+def test_mixture_statistics_by_blocks(pathDataset):
+	"""The statistics merged over blocks are the ones of the whole mono mixture."""
+	path, _ = pathDataset
+	mono = sf.read(path / 'c' / 'mixture.wav')[0].mean(1)
+	mean, std = _mixture_statistics(path / 'c' / 'mixture.wav', block=7)
+	assert mean == pytest.approx(mono.mean())
+	assert std == pytest.approx(mono.std(ddof=1))
+
+def test_build_metadata_split_across_ranks(pathDataset):
+	"""The shares of the tracks built by each rank together make the metadata built by one."""
+	path, metadata = pathDataset
+	whole = build_metadata(path, ['bass', 'drums'], workers=0)
+	shares = [build_metadata(path, ['bass', 'drums'], workers=2, rank=rank, world_size=2) for rank in range(2)]
+	assert sorted(shares[0]) == ['a', 'c'] and sorted(shares[1]) == ['b']
+	assert {**shares[0], **shares[1]} == whole
+	assert [whole[name]['length'] for name in metadata] == [metadata[name]['length'] for name in metadata]
+
+def test_update_metadata_reads_changed_tracks(pathDataset, tmp_path, monkeypatch):
+	"""Only the new and changed tracks are read again, the deleted ones are dropped."""
+	path, _ = pathDataset
+	shutil.copytree(path, tmp_path, dirs_exist_ok=True)
+	# As loaded from the cache file.
+	cache = json.loads(json.dumps(update_metadata(tmp_path, ['bass', 'drums'], {}, workers=0)))
+	ramp = -np.arange(100) / 2**12
+	sf.write(tmp_path / 'b' / 'mixture.wav', np.stack([ramp, ramp], 1), 100, subtype='FLOAT')
+	shutil.rmtree(tmp_path / 'c')
+	shutil.copytree(tmp_path / 'a', tmp_path / 'd')
+	read = []
+	track_metadata = wav._track_metadata
+	monkeypatch.setattr(wav, '_track_metadata', lambda track, *args: read.append(track.name) or track_metadata(track, *args))
+	updated = update_metadata(tmp_path, ['bass', 'drums'], cache, workers=0)
+	assert sorted(read) == ['b', 'd'] and list(updated) == ['a', 'b', 'd']
+	assert updated['a'] == cache['a'] and updated['d'][1] == cache['a'][1]
+	assert updated['b'][1]['mean'] == pytest.approx(ramp.mean())
+
+def test_metadata_cache_is_json(pathDataset, tmp_path):
+	"""The metadata is cached in a JSON file, which a second run reads without writing it again."""
+	path, metadata = pathDataset
+	for split in ['train', 'valid']:
+		shutil.copytree(path, tmp_path / 'data' / split)
+	args = config_dict.ConfigDict({'wav': str(tmp_path / 'data'), 'metadata': str(tmp_path / 'metadata'),
+								   'sources': ['bass', 'drums'], 'segment': 1, 'shift': 0.5, 'samplerate': 100,
+								   'channels': 2, 'normalize': False, 'metadata_workers': 0})
+	train_set, _ = get_wav_datasets(args)
+	cache_file, = (tmp_path / 'metadata').iterdir()
+	assert cache_file.suffix == '.json'
+	train, valid = [{name: meta for name, (key, meta) in entries.items()} for entries in json.loads(cache_file.read_text())]
+	assert train == valid == train_set.metadata
+	assert [train[name]['length'] for name in metadata] == [metadata[name]['length'] for name in metadata]
+	written = cache_file.stat().st_mtime_ns
+	get_wav_datasets(args)
+	assert cache_file.stat().st_mtime_ns == written